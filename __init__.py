@@ -2,29 +2,30 @@
 # -*- coding: utf-8 -*-
 # vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
 
-# TODO:
-# - create class to parse records, access data with "get"
-# - or at least use functions
-
 from __future__ import unicode_literals
 
 __license__ = 'agpl-3.0'
 __copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
 __docformat__ = 'en'
 
+import os
 import re
+import json
+import time
+import hashlib
 import datetime
+import unicodedata
+from io import BytesIO
+from collections import deque
+from itertools import chain, islice
 
 try:
     # Python 2
     from urllib import quote
-    from urllib2 import Request, urlopen, HTTPError
     from Queue import Queue, Empty
 except ImportError:
     # Python3
     from urllib.parse import quote
-    from urllib.request import Request, urlopen
-    from urllib.error import HTTPError
     from queue import Queue, Empty
 
 from lxml import etree
@@ -33,10 +34,18 @@ from calibre.ebooks.metadata.sources.base import Source
 from calibre.ebooks.metadata import check_isbn
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.library.comments import sanitize_comments_html
-from calibre.utils.localization import lang_as_iso639_1
-from calibre.ebooks import normalize
-
-from calibre_plugins.DNB_DE.helper import clean_series, uniq, remove_sorting_characters, clean_title, iso639_2b_as_iso639_3, strip_german_joiners, guess_series_from_title
+from calibre.constants import cache_dir
+from calibre import random_user_agent, get_proxies
+
+from calibre_plugins.DNB_DE.helper import uniq, remove_sorting_characters, strip_german_joiners, isbn_as_isbn13, compile_unwanted_series
+from calibre_plugins.DNB_DE.executor import submit, ImmediateResult
+from calibre_plugins.DNB_DE.cache import open_cache, open_tiered_cache, open_file_cache
+from calibre_plugins.DNB_DE.network import get_client, HTTPError
+from calibre_plugins.DNB_DE.offline import open_index
+from calibre_plugins.DNB_DE.replay import Recorder
+from calibre_plugins.DNB_DE.tracing import Tracer, TracingLog, get_tracer, span, phases, remove_old_traces
+from calibre_plugins.DNB_DE.marc import MarcRecord
+from calibre_plugins.DNB_DE.record import DNBRecord, Alternate, metadata_as_json, metadata_from_json
 
 class DNB_DE(Source):
     name = 'DNB_DE'
@@ -58,8 +67,37 @@ class DNB_DE(Source):
     ignore_ssl_errors = True
 
     MAXIMUMRECORDS = 10
-    QUERYURL = 'https://services.dnb.de/sru/dnb?version=1.1&maximumRecords=%s&operation=searchRetrieve&recordSchema=MARC21-xml&query=%s'
-    COVERURL = 'https://portal.dnb.de/opac/mvb/cover?isbn=%s'
+    # page size of searches for authors only
+    MAXIMUMAUTHORRECORDS = 50
+    # stop fetching further pages of a search for authors only after this many records
+    MAXIMUMRESULTS = 100
+    # only this many records of a query get their covers checked, comments downloaded and other issues fetched
+    MAXIMUMENRICHEDRESULTS = 10
+    # number of alternate editions resolved with a single query
+    MAXIMUMALTERNATES = 20
+    # maximum length of query URLs combining many identifiers, see identify_many()
+    MAXIMUMQUERYURLLENGTH = 2000
+    # size of the cache of ISBNs without cover, in MB
+    NEGATIVECOVERCACHESIZE = 5
+    # cached comments are kept for revalidation this many times as long as cfg_comments_cache_ttl, and size of that cache in MB
+    COMMENTSCACHERETENTION = 12
+    COMMENTSCACHESIZE = 20
+    # size of the cache of parsed records in MB, and number of them kept in memory
+    RECORDCACHESIZE = 50
+    RECORDMEMORYCACHEENTRIES = 1000
+    # hours to remember the ISBNs of all issues of a book, and size of that cache in MB
+    ISSUESCACHERETENTION = 24 * 365
+    ISSUESCACHESIZE = 10
+    # hours to keep cover images, and size of the index of cover URLs in MB (images are limited by cfg_cover_image_cache_size)
+    COVERCACHERETENTION = 24 * 90
+    COVERINDEXSIZE = 5
+    # number of trace files to keep, older ones are removed
+    MAXIMUMTRACES = 100
+    # the URLs can be pointed to a stand-in server with environment variables, see replay.py
+    QUERYURL = os.environ.get('DNB_DE_QUERYURL', 'https://services.dnb.de/sru/dnb?version=1.1&maximumRecords=%s&startRecord=%s&operation=searchRetrieve&recordSchema=MARC21-xml&query=%s')
+    COVERURL = os.environ.get('DNB_DE_COVERURL', 'https://portal.dnb.de/opac/mvb/cover?isbn=%s')
+    # comments are only downloaded from URLs starting with one of these
+    COMMENTSURLS = tuple(os.environ.get('DNB_DE_COMMENTSURLS', 'http://deposit.dnb.de/ https://deposit.dnb.de/').split())
 
     def load_config(self):
         """
@@ -76,6 +114,58 @@ class DNB_DE(Source):
             cfg.KEY_SKIP_SERIES_STARTING_WITH_PUBLISHERS_NAME, True)
         self.cfg_unwanted_series_names = cfg.plugin_prefs[cfg.STORE_NAME].get(
             cfg.KEY_UNWANTED_SERIES_NAMES, [])
+        self.unwanted_series = compile_unwanted_series(self.cfg_unwanted_series_names)
+
+        # settings added by later versions are missing in configurations saved before: use their defaults
+        self.cfg_parallel_queries = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_PARALLEL_QUERIES, cfg.DEFAULT_STORE_VALUES[cfg.KEY_PARALLEL_QUERIES])
+        self.cfg_query_cache_ttl = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_QUERY_CACHE_TTL, cfg.DEFAULT_STORE_VALUES[cfg.KEY_QUERY_CACHE_TTL])
+        self.cfg_query_cache_size = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_QUERY_CACHE_SIZE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_QUERY_CACHE_SIZE])
+        self.cfg_cover_cache_ttl = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_COVER_CACHE_TTL, cfg.DEFAULT_STORE_VALUES[cfg.KEY_COVER_CACHE_TTL])
+        self.cfg_comments_cache_ttl = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_COMMENTS_CACHE_TTL, cfg.DEFAULT_STORE_VALUES[cfg.KEY_COMMENTS_CACHE_TTL])
+        self.cfg_max_requests_per_second = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_MAX_REQUESTS_PER_SECOND, cfg.DEFAULT_STORE_VALUES[cfg.KEY_MAX_REQUESTS_PER_SECOND])
+        self.cfg_probe_selectivity = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_PROBE_SELECTIVITY, cfg.DEFAULT_STORE_VALUES[cfg.KEY_PROBE_SELECTIVITY])
+        self.cfg_offline_index = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_OFFLINE_INDEX, cfg.DEFAULT_STORE_VALUES[cfg.KEY_OFFLINE_INDEX])
+        self.cfg_trace = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_TRACE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_TRACE])
+
+        self.cfg_record_cache_ttl = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_RECORD_CACHE_TTL, cfg.DEFAULT_STORE_VALUES[cfg.KEY_RECORD_CACHE_TTL])
+        self.cfg_cover_image_cache_size = cfg.plugin_prefs[cfg.STORE_NAME].get(
+            cfg.KEY_COVER_IMAGE_CACHE_SIZE, cfg.DEFAULT_STORE_VALUES[cfg.KEY_COVER_IMAGE_CACHE_SIZE])
+
+        # fields that are thrown away are not extracted at all
+        self.ignored_fields = self.get_ignored_fields()
+
+        # parsed records are only valid for the settings they were built with
+        self.record_cache_version = hashlib.sha1(json.dumps([
+            self.version, self.QUERYURL, self.COVERURL, self.cfg_guess_series, self.cfg_append_edition_to_title,
+            self.cfg_fetch_subjects, self.cfg_skip_series_starting_with_publishers_name, self.cfg_unwanted_series_names,
+            sorted(self.ignored_fields)]).encode('utf-8')).hexdigest()[:12]
+
+    def get_ignored_fields(self):
+        """
+        Get the fields not to fetch: the fields calibre ignores for this source or for all sources,
+        and "tags" if no subjects are wanted
+        """
+        from calibre.ebooks.metadata.sources.prefs import msprefs
+        ignored = set(self.prefs['ignore_fields']) | set(msprefs['ignore_fields'])
+        if self.cfg_fetch_subjects == 5:
+            ignored.add('tags')
+        return frozenset(ignored)
+
+    def wanted(self, field):
+        """
+        Check if a field (as in touched_fields) is to be fetched
+        """
+        return field not in self.ignored_fields
 
     def config_widget(self):
         self.cw = None
@@ -88,6 +178,30 @@ class DNB_DE(Source):
     def identify(self, log, result_queue, abort, title=None, authors=None, identifiers=None, timeout=30):
         self.load_config()
 
+        if not self.cfg_trace:
+            return self.identify_book(log, result_queue, abort, title, authors, identifiers, timeout)
+
+        # write timing of all phases into a trace file
+        tracer = Tracer()
+        try:
+            with tracer.span('identify', title=title, authors=authors, identifiers=identifiers):
+                return self.identify_book(TracingLog(log, tracer), result_queue, abort, title, authors, identifiers, timeout)
+        finally:
+            directory = os.path.join(cache_dir(), 'DNB_DE', 'traces')
+            path = os.path.join(directory, 'identify-%s-%s.json' % (
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid()))
+            try:
+                tracer.export(path)
+                log.info("Trace written to %s" % path)
+            except (IOError, OSError) as e:
+                log.error("Could not write trace to %s: %s" % (path, e))
+            remove_old_traces(directory, self.MAXIMUMTRACES)
+
+
+    def identify_book(self, log, result_queue, abort, title=None, authors=None, identifiers=None, timeout=30):
+        """
+        Search for a book, put Metadata objects of all results into result_queue
+        """
         if authors is None:
             authors = []
 
@@ -106,686 +220,442 @@ class DNB_DE(Source):
         for i in ignored_authors:
             authors = [x for x in authors if x.lower() != i.lower()]
 
+        # patterns saved before they were validated by the config dialog
+        for pattern, error in self.unwanted_series.invalid:
+            log.warn("[Series Cleaning] Regular expression %s caused an error, ignoring: %s" % (pattern, error))
+
         # exit on insufficient inputs
         if not isbn and not idn and not title and not authors:
             log.info(
                 "This plugin requires at least either ISBN, IDN, Title or Author(s).")
             return None
 
-        # process queries
-        results = None
-        query_success = False
+        # books identified by IDN that were parsed before need no query at all
+        if idn:
+            mi = self.get_cached_record(log, idn)
+            if mi is not None:
+                log.info("Final formatted result: \n%s\n-----" % mi)
+                result_queue.put(mi)
+                return None
 
-        for query in self.create_query_variations(log, idn, isbn, authors, title):
-            results = self.execute_query(log, query, timeout)
-            if not results:
-                continue
-
-            log.info("Parsing records")
-
-            ns = {'marc21': 'http://www.loc.gov/MARC21/slim'}
-
-            for record in results:
-                book = {
-                    'series': None,
-                    'series_index': None,
-                    'pubdate': None,
-                    'languages': [],
-                    'title': None,
-                    'title_sort': None,
-                    'authors': [],
-                    'author_sort': None,
-                    'edition': None,
-                    'comments': None,
-                    'idn': None,
-                    'urn': None,
-                    'isbn': None,
-                    'ddc': [],
-                    'subjects_gnd': [],
-                    'subjects_non_gnd': [],
-                    'publisher_name': None,
-                    'publisher_location': None,
-
-                    'alternative_xmls': [],
-                }
-
-
-
-                ##### Field 336: "Content Type" #####
-                # Skip Audio Books
-                try:
-                    mediatype = record.xpath("./marc21:datafield[@tag='336']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns)[0].text.strip().lower()
-                    if mediatype in ('gesprochenes wort'):
-                        continue
-                except IndexError:
-                    pass
+        for host, limits in self.get_http_client().get_limits().items():
+            log.info("Request limits for %s: %s requests/s, %s parallel requests (%s active)" % (host, limits['rate'], limits['concurrency'], limits['active']))
 
+        # process queries
+        query_success = False
 
-                ##### Field 337: "Media Type" #####
-                # Skip Audio and Video
-                try:
-                    mediatype = record.xpath("./marc21:datafield[@tag='337']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns)[0].text.strip().lower()
-                    if mediatype in ('audio', 'video'):
+        # alternate editions (field 776) already resolved during this identify call, by IDN
+        alternates = {}
+        # cover checks started during this identify call, by ISBN
+        cover_probes = {}
+        # comments downloads started during this identify call, by URL
+        comments_downloads = {}
+        # records parsed during this identify call, by IDN: Metadata object, or None for skipped records
+        parsed = {}
+        # IDNs of the results put into result_queue
+        returned = set()
+
+        queries = self.create_query_variations(log, idn, isbn, authors, title)
+        window = self.cfg_parallel_queries
+        if self.cfg_probe_selectivity and len(queries) > 1:
+            queries = self.plan_queries(log, queries, abort, timeout)
+            # the planned order is good enough, fetch one variation after the other
+            window = 1
+
+        for query, pages in self.run_queries(log, queries, abort, timeout, window):
+            # further pages are only fetched if there are more results and we want them
+            num_results = 0
+            maximum_results = self.maximum_results(query)
+            for results in pages:
+                log.info("Parsing records")
+
+                # records beyond the maximum are not read at all
+                results = islice(results, maximum_results - num_results)
+                enrich = max(0, self.MAXIMUMENRICHEDRESULTS - num_results)
+                for record, mi in self.parse_page(log, results, alternates, cover_probes, comments_downloads, parsed, timeout, enrich):
+                    num_results += 1
+                    if mi is None:
                         continue
-                except IndexError:
-                    pass
-
-
-                ##### Field 16: "National Bibliographic Agency Control Number" #####
-                # Get Identifier "IDN" (dnb-idn)
-                try:
-                    book['idn'] = record.xpath("./marc21:datafield[@tag='016']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns)[0].text.strip()
-                    log.info("[016.a] Identifier IDN: %s" % book['idn'])
-                except IndexError:
-                    pass
-
-
-                ##### Field 776: "Additional Physical Form Entry" #####
-                # References from ebook's entry to paper book's entry (and vice versa)
-                # Often only one of them contains comments or a cover
-                # Example: dnb-idb=1136409025
-                for i in record.xpath("./marc21:datafield[@tag='776']/marc21:subfield[@code='w' and string-length(text())>0]", namespaces=ns):
-                    other_idn = re.sub(r"^\(.*\)", "", i.text.strip())
-                    log.info("[776.w] Found other issue with IDN %s" % other_idn)
-                    altquery = 'num=%s NOT (mat=film OR mat=music OR mat=microfiches OR cod=tt)' % other_idn
-                    altresults = self.execute_query(log, altquery, timeout)
-                    if altresults:
-                        book['alternative_xmls'].append(altresults[0])
-
-
-                ##### Field 264: "Production, Publication, Distribution, Manufacture, and Copyright Notice" #####
-                # Get Publisher Name, Publishing Location, Publishing Date
-                # Subfields:
-                # a: publishing location
-                # b: publisher name
-                # c: publishing date
-                for field in record.xpath("./marc21:datafield[@tag='264']", namespaces=ns):
-                    if book['publisher_name'] and book['publisher_location'] and book['pubdate']:
-                        break
-
-                    if not book['publisher_location']:
-                        location_parts = []
-                        for i in field.xpath("./marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                            location_parts.append(i.text.strip())
-                        if location_parts:
-                            book['publisher_location'] = ' '.join(location_parts).strip('[]')
-
-                    if not book['publisher_name']:
-                        try:
-                            book['publisher_name'] = field.xpath("./marc21:subfield[@code='b' and string-length(text())>0]", namespaces=ns)[0].text.strip()
-                            log.info("[264.b] Publisher: %s" % book['publisher_name'])
-                        except IndexError:
-                            pass
-
-                    if not book['pubdate']:
-                        try:
-                            pubdate = field.xpath("./marc21:subfield[@code='c' and string-length(text())>=4]", namespaces=ns)[0].text.strip()
-                            match = re.search(r"(\d{4})", pubdate)
-                            year = match.group(1)
-                            book['pubdate'] = datetime.datetime(int(year), 1, 1, 12, 30, 0)
-                            log.info("[264.c] Publication Year: %s" % book['pubdate'])
-                        except (IndexError, AttributeError):
-                            pass
-
-
-                ##### Field 245: "Title Statement" #####
-                # Get Title, Series, Series_Index, Subtitle
-                # Subfields: a: title, b: subtitle 1, n: number of part, p: name of part
-                # See: https://www.loc.gov/marc/bibliographic/bd245.html
-
-                # Examples:
-                # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime", n[2] = 4, p[2] = "The Return of Foobar"	Example: dnb-id 1008774839
-                # ->	Title:		"The Return Of Foobar"
-                #	Series:		"The Endless Book 2 - Second Season 3 - Summertime"
-                #	Series Index:	4
-
-                # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime", n[2] = 4"
-                # ->	Title:		"Summertime 4"
-                #	Series:		"The Endless Book 2 - Second Season 3 - Summertime"
-                #	Series Index:	4
-
-                # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime"
-                # ->	Title:		"Summertime"
-                #	Series:		"The Endless Book 2 - Second Season"
-                #	Series Index:	3
-
-                # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3"	Example: 956375146
-                # ->	Title:		"Second Season 3"	n=2, p =1
-                #	Series:		"The Endless Book 2 - Second Season"
-                #	Series Index:	3
-
-                # a = "The Endless Book", n[0] = 2, p[0] = "Second Season"
-                # ->	Title:		"Second Season"	n=1,p=1
-                #	Series:		"The Endless Book"
-                #	Series Index:	2
-
-                # a = "The Endless Book", n[0] = 2"
-                # ->	Title: 		"The Endless Book 2"
-                #	Series:		"The Endless Book"
-                #	Series Index:	2
-
-                title_parts = []
-                for field in record.xpath("./marc21:datafield[@tag='245']", namespaces=ns):
-
-                    code_a = []
-                    for i in field.xpath("./marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        code_a.append(i.text.strip())
-
-                    code_n = []
-                    for i in field.xpath("./marc21:subfield[@code='n' and string-length(text())>0]", namespaces=ns):
-                        match = re.search(r"(\d+([,\.]\d+)?)", i.text.strip())
-                        if match:
-                            code_n.append(match.group(1))
-                        else:
-                            # looks like sometimes DNB does not know the series_index and uses something like "[...]"
-                            match = re.search(r"\[\.\.\.\]", i.text.strip())
-                            if match:
-                                code_n.append('0')
-
-                    code_p = []
-                    for i in field.xpath("./marc21:subfield[@code='p' and string-length(text())>0]", namespaces=ns):
-                        code_p.append(i.text.strip())
-
-                    # Title
-                    title_parts = code_a
-
-                    # Looks like we have a series
-                    if code_a and code_n:
-                        # set title ("Name of this Book")
-                        if code_p:
-                            title_parts = [code_p[-1]]
-
-                        # build series name
-                        series_parts = [code_a[0]]
-                        for i in range(0, min(len(code_p), len(code_n)) - 1):
-                            series_parts.append(code_p[i])
-
-                        for i in range(0, min(len(series_parts), len(code_n) - 1)):
-                            series_parts[i] += ' ' + code_n[i]
-
-                        book['series'] = ' - '.join(series_parts)
-                        log.info("[245] Series: %s" % book['series'])
-                        book['series'] = clean_series(log, book['series'],
-                                                      book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                                      self.cfg_unwanted_series_names)
-
-                        # build series index
-                        if code_n:
-                            book['series_index'] = code_n[-1]
-                            log.info("[245] Series_Index: %s" % book['series_index'])
-
-                    # subtitle 1: Field 245, Subfield b
-                    try:
-                        title_parts.append(field.xpath("./marc21:subfield[@code='b' and string-length(text())>0]", namespaces=ns)[0].text.strip())
-                    except IndexError:
-                        pass
-
-                #### Field 249: "Additional Titles for Compilations"
-                additional_titles_parts = []
-                for field in record.xpath("./marc21:datafield[@tag='249']", namespaces=ns):
-                    for i in field.xpath("./marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        additional_titles_parts.append(i.text.strip())
-
-
-                # Merge Title and Additional Titles
-                title = " : ".join(title_parts)
-                log.info("[245] Title: %s" % title)
-
-                additional_titles = " / ".join(additional_titles_parts)
-                log.info("[249] Additional Titles: %s" % additional_titles)
-
-                book['title'] = " / ".join(filter(None, [title, additional_titles]))
-                book['title'] = clean_title(log, book['title'])
-
-
-                # Title_Sort
-                if title_parts:
-                    title_sort_parts = list(title_parts)
-
-                    try:  # Python2
-                        title_sort_regex = re.match(r'^(.*?)(' + unichr(152) + '.*' + unichr(156) + ')?(.*?)$', title_parts[0])
-                    except:  # Python3
-                        title_sort_regex = re.match(r'^(.*?)(' + chr(152) + '.*' + chr(156) + ')?(.*?)$', title_parts[0])
-                    sortword = title_sort_regex.group(2)
-                    if sortword:
-                        title_sort_parts[0] = ''.join(filter(None, [title_sort_regex.group(1).strip(), title_sort_regex.group(3).strip(), ", " + sortword]))
-
-                    book['title_sort'] = " : ".join(title_sort_parts)
-                    log.info("[245/249] Title_Sort: %s" % book['title_sort'])
-
-
-                ##### Field 100: "Main Entry-Personal Name"  #####
-                ##### Field 700: "Added Entry-Personal Name" #####
-                # Get Authors ####
-
-                # primary authors
-                primary_authors = []
-                for i in record.xpath("./marc21:datafield[@tag='100']/marc21:subfield[@code='4' and text()='aut']/../marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    name = re.sub(r" \[.*\]$", "", i.text.strip())
-                    primary_authors.append(name)
-
-                if primary_authors:
-                    book['authors'].extend(primary_authors)
-                    log.info("[100.a] Primary Authors: %s" % " & ".join(primary_authors))
-
-                # secondary authors
-                secondary_authors = []
-                for i in record.xpath("./marc21:datafield[@tag='700']/marc21:subfield[@code='4' and text()='aut']/../marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    name = re.sub(r" \[.*\]$", "", i.text.strip())
-                    secondary_authors.append(name)
-
-                if secondary_authors:
-                    book['authors'].extend(secondary_authors)
-                    log.info("[700.a] Secondary Authors: %s" % " & ".join(secondary_authors))
-
-                # if no "real" author was found use all involved persons as authors
-                if not book['authors']:
-                    involved_persons = []
-                    for i in record.xpath("./marc21:datafield[@tag='700']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        name = re.sub(r" \[.*\]$", "", i.text.strip())
-                        involved_persons.append(name)
-
-                    if involved_persons:
-                        book['authors'].extend(involved_persons)
-                        log.info("[700.a] Involved Persons: %s" % " & ".join(involved_persons))
-
-
-                ##### Field 856: "Electronic Location and Access" #####
-                # Get Comments, either from this book or from one of its other "Physical Forms"
-                # Field contains an URL to an HTML file with the comments
-                # Example: dnb-idn:1256023949
-                for x in [record] + book['alternative_xmls']:
-                    try:
-                        url = x.xpath("./marc21:datafield[@tag='856']/marc21:subfield[@code='u' and string-length(text())>21]", namespaces=ns)[0].text.strip()
-                        if url.startswith("http://deposit.dnb.de/") or url.startswith("https://deposit.dnb.de/"):
-                            br = self.browser
-                            log.info('[856.u] Trying to download Comments from: %s' % url)
-                            try:
-                                comments = br.open_novisit(url, timeout=30).read()
-
-                                # Decode bytes to string for processing
-                                comments_text = comments.decode('utf-8')
-
-                                # Skip service outage information web page
-                                if 'Zugriff derzeit nicht möglich // Access currently unavailable' in comments_text:
-                                    raise Exception("Access currently unavailable")
-
-                                # Process the text version
-                                comments_text = re.sub(
-                                    r'(\s|<br>|<p>|\n)*Angaben aus der Verlagsmeldung(\s|<br>|<p>|\n)*(<h3>.*?</h3>)*(\s|<br>|<p>|\n)*',
-                                    '', comments_text, flags=re.IGNORECASE)
-                                book['comments'] = sanitize_comments_html(comments_text)
-                                log.info('[856.u] Got Comments: %s' % book['comments'])
-                                break
-                            except Exception as e:
-                                log.info("[856.u] Could not download Comments from %s: %s" % (url, e))
-                    except IndexError:
-                        pass
-
-
-                ##### Field 24: "Other Standard Identifier" #####
-                # Get Identifier "URN"
-                for i in record.xpath("./marc21:datafield[@tag='024']/marc21:subfield[@code='2' and text()='urn']/../marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    try:
-                        urn = i.text.strip()
-                        match = re.search(r"^urn:(.+)$", urn)
-                        book['urn'] = match.group(1)
-                        log.info("[024.a] Identifier URN: %s" % book['urn'])
-                        break
-                    except AttributeError:
-                        pass
-
-
-                ##### Field 20: "International Standard Book Number" #####
-                # Get Identifier "ISBN"
-                for i in record.xpath("./marc21:datafield[@tag='020']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    try:
-                        isbn_regex = "(?:ISBN(?:-1[03])?:? )?(?=[-0-9 ]{17}|[-0-9X ]{13}|[0-9X]{10})(?:97[89][- ]?)?[0-9]{1,5}[- ]?(?:[0-9]+[- ]?){2}[0-9X]"
-                        match = re.search(isbn_regex, i.text.strip())
-                        isbn = match.group()
-                        book['isbn'] = isbn.replace('-', '')
-                        log.info("[020.a] Identifier ISBN: %s" % book['isbn'])
-                        break
-                    except AttributeError:
-                        pass
-
-
-                ##### Field 82: "Dewey Decimal Classification Number" #####
-                # Get Identifier "Sachgruppen (DDC)" (ddc)
-                for i in record.xpath("./marc21:datafield[@tag='082']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    book['ddc'].append(i.text.strip())
-                if book['ddc']:
-                    log.info("[082.a] Indentifiers DDC: %s" % ",".join(book['ddc']))
-
-
-                # Field 490: "Series Statement"
-                # Get Series and Series_Index
-                # In theory book series are in field 830, but sometimes they are in 490, 246, 800 or nowhere
-                # So let's look here if we could not extract series/series_index from 830 above properly
-                # Subfields:
-                # v: Series name and index
-                # a: Series name
-                for i in record.xpath("./marc21:datafield[@tag='490']/marc21:subfield[@code='v' and string-length(text())>0]/../marc21:subfield[@code='a' and string-length(text())>0]/..", namespaces=ns):
-
-                    if book['series'] and book['series_index'] and book['series_index'] != "0":
-                        break
-
-                    series = None
-                    series_index = None
-
-                    # "v" is something like "Nr. 220", "220", "This great Seriestitle : Nr. 220", "Bd. 220, Abth. 1 = [1]"
-                    attr_v = i.xpath("./marc21:subfield[@code='v']", namespaces=ns)[0].text.strip()
-
-                    # Assume we have "This great Seriestitle : Nr. 220"
-                    # -> Split at " : ", the part without digits is the series, the digits in the other part are the series_index
-                    parts = re.split(" : ", attr_v)
-                    if len(parts) == 2:
-                        if bool(re.search(r"\d", parts[0])) != bool(re.search(r"\d", parts[1])):
-                            # figure out which part contains the index number
-                            if bool(re.search(r"\d", parts[0])):
-                                indexpart = parts[0]
-                                textpart = parts[1]
-                            else:
-                                indexpart = parts[1]
-                                textpart = parts[0]
-
-                            match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", indexpart)
-                            if match:
-                                series_index = match.group(1)
-                                series = textpart.strip()
-                                log.info("[490.v] Series: %s" % series)
-                                log.info("[490.v] Series_Index: %s" % series_index)
-
-                    else:
-                        # Assumption above was wrong. Try to extract at least the series_index
-                        match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", attr_v)
-
-                        if match:
-                            series_index = match.group(1)
-                            log.info("[490.v] Series_Index: %s" % series_index)
-
-                    # Use Series Name from attribute "a" if not already found in attribute "v"
-                    if not series:
-                        series = i.xpath("./marc21:subfield[@code='a']", namespaces=ns)[0].text.strip()
-                        log.info("[490.a] Series: %s" % series)
-
-                    if series:
-                        series = clean_series(log, series,
-                                              book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                              self.cfg_unwanted_series_names)
-
-                        if series and series_index:
-                            book['series'] = series
-                            book['series_index'] = series_index
-
-
-                ##### Field 246: "Varying Form of Title" #####
-                # Series and Series_Index
-                for i in record.xpath("./marc21:datafield[@tag='246']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-
-                    if book['series'] and book['series_index'] and book['series_index'] != "0":
-                        break
-
-                    match = re.search(r"^(.+?) ; (\d+[\.,]?(?:(?<=[\.,])\d*)?)$", i.text.strip())
-                    if match:
-                        series = match.group(1)
-                        series_index = match.group(2)
-                        log.info("[246.a] Series: %s" % series)
-                        log.info("[246.a] Series_Index: %s" % book['series_index'])
-                        series = clean_series(log, match.group(1),
-                                              book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                              self.cfg_unwanted_series_names)
-
-                        if series and series_index:
-                            book['series'] = series
-                            book['series_index'] = series_index
-
-
-                ##### Field 800: "Series Added Entry-Personal Name" #####
-                # Series and Series_Index
-                for i in record.xpath("./marc21:datafield[@tag='800']/marc21:subfield[@code='v' and string-length(text())>0]/../marc21:subfield[@code='t' and string-length(text())>0]/..", namespaces=ns):
-
-                    if book['series'] and book['series_index'] and book['series_index'] != "0":
-                        break
-
-                    # Series Index
-                    match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", i.xpath("./marc21:subfield[@code='v']", namespaces=ns)[0].text.strip())
-                    if match:
-                        series_index = match.group(1)
-                        log.info("[800.v] Series_Index: %s" % series_index)
-
-                    # Series
-                    series = i.xpath("./marc21:subfield[@code='t']", namespaces=ns)[0].text.strip()
-                    log.info("[800.t] Series: %s" % series)
-                    series = clean_series(log, series,
-                                          book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                          self.cfg_unwanted_series_names)
-
-                    if series and series_index:
-                        book['series'] = series
-                        book['series_index'] = series_index
-
-
-                ##### Field 830: "Series Added Entry-Uniform Title" #####
-                # Series and Series_Index
-                for i in record.xpath("./marc21:datafield[@tag='830']/marc21:subfield[@code='v' and string-length(text())>0]/../marc21:subfield[@code='a' and string-length(text())>0]/..", namespaces=ns):
 
-                    if book['series'] and book['series_index'] and book['series_index'] != "0":
-                        break
-
-                    # Series Index
-                    match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", i.xpath("./marc21:subfield[@code='v']", namespaces=ns)[0].text.strip())
-                    if match:
-                        series_index = match.group(1)
-                        log.info("[830.v] Series_Index: %s" % series_index)
-
-                    # Series
-                    series = i.xpath("./marc21:subfield[@code='a']", namespaces=ns)[0].text.strip()
-                    log.info("[830.a] Series: %s" % series)
-                    series = clean_series(log, series,
-                                          book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                          self.cfg_unwanted_series_names)
-
-                    if series and series_index:
-                        book['series'] = series
-                        book['series_index'] = series_index
-
-
-                ##### Field 689 #####
-                # Get GND Subjects
-                for i in record.xpath("./marc21:datafield[@tag='689']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    book['subjects_gnd'].append(i.text.strip())
-
-                for f in range(600, 656):
-                    for i in record.xpath("./marc21:datafield[@tag='" + str(f) + "']/marc21:subfield[@code='2' and text()='gnd']/../marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        # skip entries starting with "(":
-                        if i.text.startswith("("):
-                            continue
-                        book['subjects_gnd'].append(i.text)
-
-                if book['subjects_gnd']:
-                    log.info("[689.a] GND Subjects: %s" % " ".join(book['subjects_gnd']))
-
-
-                ##### Fields 600-655 #####
-                # Get non-GND Subjects
-                for f in range(600, 656):
-                    for i in record.xpath("./marc21:datafield[@tag='" + str(f) + "']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        # skip entries starting with "(":
-                        if i.text.startswith("("):
+                    # already returned for an earlier query variation
+                    idn = self.get_idn(record)
+                    if idn is not None:
+                        if idn in returned:
                             continue
-                        # skip one-character subjects:
-                        if len(i.text) < 2:
-                            continue
-
-                        book['subjects_non_gnd'].extend(re.split(',|;', remove_sorting_characters(i.text)))
-
-                if book['subjects_non_gnd']:
-                    log.info("[600.a-655.a] Non-GND Subjects: %s" % " ".join(book['subjects_non_gnd']))
+                        returned.add(idn)
 
+                    # put current result's metdata into result queue
+                    log.info("Final formatted result: \n%s\n-----" % mi)
+                    result_queue.put(mi)
+                    query_success = True
 
-                ##### Field 250: "Edition Statement" #####
-                # Get Edition
-                try:
-                    book['edition'] = record.xpath("./marc21:datafield[@tag='250']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns)[0].text.strip()
-                    log.info("[250.a] Edition: %s" % book['edition'])
-                except IndexError:
-                    pass
-
-
-                ##### Field 41: "Language Code" #####
-                # Get Languages (unfortunately in ISO-639-2/B ("ger" for German), while Calibre uses ISO-639-1 ("de"))
-                # ISO-639-2/B is very close to ISO-639-3, which can be converted to ISO-639-1 with Calibre's "lang_as_iso639_1" function
-                # So we translate ISO-639-2/B to ISO-639-3 and feed that to Calibre
-                for i in record.xpath("./marc21:datafield[@tag='041']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                    book['languages'].append(
-                        lang_as_iso639_1(
-                            iso639_2b_as_iso639_3(i.text.strip())
-                        )
-                    )
+                if num_results >= maximum_results or abort.is_set():
+                    break
 
-                try:
-                    if book['languages']:
-                        log.info("[041.a] Languages: %s" % ",".join(book['languages']))
-                except TypeError:
-                    pass
+            # Stop on first successful query
+            if query_success:
+                break
 
 
-                ##### SERIES GUESSER #####
-                # DNB's metadata often lacks proper series/series_index data
-                # If wanted by user: Try to retrieve Series, Series Index and "real" Title from the fetched Title
-                if self.cfg_guess_series is True and not book['series'] or not book['series_index'] or book['series_index'] == "0":
-                    try:
-                        (guessed_title, guessed_series, guessed_series_index) = guess_series_from_title(log, book['title'])
+    def identify_many(self, log, identifiers, abort, timeout=30):
+        """
+        Identify many books by IDN or ISBN with few requests
+        "identifiers" is a list of dicts like the one identify() takes, only 'dnb-idn' and 'isbn' are used.
+        The identifiers are combined into OR-queries, the records are mapped back to the books
+        asking for them by their IDN (field 16) and ISBNs (field 20).
+        Books asked for by IDN that are in the record cache need no query, parsed records are added to it.
+        Returns a list with a list of Metadata objects for each entry of "identifiers".
+        Every entry gets Metadata objects of its own, even if several entries ask for the same book.
+        """
+        self.load_config()
 
-                        guessed_title = clean_title(log, guessed_title)
-                        guessed_series = clean_series(log, guessed_series,
-                                                      book['publisher_name'] if self.cfg_skip_series_starting_with_publishers_name else None,
-                                                      self.cfg_unwanted_series_names)
+        found = [[] for i in identifiers]
+
+        # search term -> indexes of the books asking for it
+        wanted = {}
+        for index, ids in enumerate(identifiers):
+            idn = ids.get('dnb-idn', None)
+            isbn = check_isbn(ids.get('isbn', None))
+            # like identify(): the IDN wins if both are given
+            if idn:
+                key = 'idn:' + idn
+                term = 'num=' + idn
+            elif isbn:
+                key = 'isbn:' + isbn_as_isbn13(isbn)
+                term = 'num=' + isbn
+            else:
+                log.info("Book %s has neither IDN nor ISBN, skipping" % index)
+                continue
+            wanted.setdefault(key, (term, []))[1].append(index)
 
-                        if guessed_title and guessed_series and guessed_series_index:
-                            book['title'] = guessed_title
-                            book['series'] = guessed_series
-                            book['series_index'] = guessed_series_index
+        # like identify(): books identified by IDN that were parsed before need no query at all
+        for key in [k for k in wanted if k.startswith('idn:')]:
+            mi = self.get_cached_record(log, key[len('idn:'):])
+            if mi is not None:
+                for index in wanted.pop(key)[1]:
+                    found[index].append(mi.deepcopy())
 
-                    except TypeError:
-                        pass
+        alternates = {}
+        cover_probes = {}
+        comments_downloads = {}
+        parsed = {}
 
+        for query, num_terms in self.create_batch_queries(v[0] for v in wanted.values()):
+            if abort.is_set():
+                break
 
-                ##### Figure out working URL to cover #####
-                # Cover URL is basically fixed and takes ISBN as an argument
-                # So get all ISBNs we have for this book...
-                cover_isbns = [ book['isbn'] ]
-                # loop through all alternative "physical forms"
-                for altxml in book['alternative_xmls']:
-                    for identifier in altxml.xpath("./marc21:datafield[@tag='020']/marc21:subfield[@code='a' and string-length(text())>0]", namespaces=ns):
-                        try:
-                            isbn_regex = "(?:ISBN(?:-1[03])?:? )?(?=[-0-9 ]{17}|[-0-9X ]{13}|[0-9X]{10})(?:97[89][- ]?)?[0-9]{1,5}[- ]?(?:[0-9]+[- ]?){2}[0-9X]"
-                            match = re.search(isbn_regex, identifier.text.strip())
-                            isbn = match.group()
-                            isbn = isbn.replace('-', '')
-                            log.info("[020.a ALTERNATE] Identifier ISBN: %s" % isbn)
-                            cover_isbns.append(isbn)
-                            self.cache_isbn_to_identifier(isbn, book['idn'])
-                            break
-                        except AttributeError:
-                            pass
-
-                # ...and check for each ISBN if the server has a cover
-                for i in cover_isbns:
-                    url = self.COVERURL % i
-                    request = Request(url)
-                    request.get_method = lambda : 'HEAD'
-                    try:
-                        urlopen(request)
-                        self.cache_identifier_to_cover_url(book['idn'], url)
-                        break
-                    except HTTPError:
+            # an ISBN may match more than one record, execute_query() fetches the rest with further pages
+            for results in self.execute_query(log, query, timeout, maximum_records=min(num_terms, self.MAXIMUMRESULTS)):
+                for record, mi in self.parse_page(log, results, alternates, cover_probes, comments_downloads, parsed, timeout):
+                    if mi is None:
                         continue
 
+                    keys = ['isbn:' + isbn_as_isbn13(i) for i in self.get_isbns(record)]
+                    idn = self.get_idn(record)
+                    if idn:
+                        keys.append('idn:' + idn)
+
+                    indexes = set()
+                    for key in keys:
+                        indexes.update(wanted.get(key, (None, []))[1])
+                    if not indexes:
+                        # e.g. found by a term of the query, but with its ISBN only in another field
+                        log.warn("Record with IDN %s and ISBNs %s matches none of the books asked for, ignoring it"
+                                 % (idn, ', '.join(self.get_isbns(record)) or '-'))
+                    for index in sorted(indexes):
+                        found[index].append(mi.deepcopy())
+
+                if abort.is_set():
+                    break
 
-                ##### Put it all together #####
-                if self.cfg_append_edition_to_title and book['edition']:
-                    book['title'] = book['title'] + " : " + book['edition']
+        return found
 
-                authors = list(map(lambda i: remove_sorting_characters(i), book['authors']))
 
-                mi = Metadata(
-                    remove_sorting_characters(book['title']),
-                    list(map(lambda i: re.sub(r"^(.+), (.+)$", r"\2 \1", i), authors))
-                )
+    def create_batch_queries(self, terms):
+        """
+        Combine search terms into OR-queries whose URLs stay below MAXIMUMQUERYURLLENGTH
+        Returns a list of (query, number of terms in query)
+        """
+        queries = []
+        batch = []
+        for term in terms:
+            if batch and len(self.batch_query_url(batch + [term])) > self.MAXIMUMQUERYURLLENGTH:
+                queries.append((self.batch_query(batch), len(batch)))
+                batch = []
+            batch.append(term)
+        if batch:
+            queries.append((self.batch_query(batch), len(batch)))
+        return queries
 
-                mi.author_sort = " & ".join(authors)
 
-                mi.title_sort = remove_sorting_characters(book['title_sort'])
+    def batch_query(self, terms):
+        return self.exclude_media('(%s)' % ' OR '.join(terms))
 
-                if book['languages']:
-                    mi.language = book['languages'][0]
-                    mi.languages = book['languages']
 
-                mi.pubdate = book['pubdate']
-                mi.publisher = " ; ".join(filter(
-                    None, [book['publisher_location'], remove_sorting_characters(book['publisher_name'])]))
+    def batch_query_url(self, terms):
+        return self.QUERYURL % (self.MAXIMUMRESULTS, 1, quote(self.batch_query(terms).encode('utf-8')))
 
-                if book['series']:
-                    mi.series = remove_sorting_characters(book['series'].replace(',', '.'))
-                    mi.series_index = book['series_index'] or "0"
 
-                mi.comments = book['comments']
+    def parse_page(self, log, results, alternates, cover_probes, comments_downloads, parsed, timeout=30, enrich=None):
+        """
+        Parse a page of records, yield (record, Metadata object or None) for each of them, in the order of the page
+        Records are parsed while the response is read, each record is handed out as soon as it and the records
+        before it are done. Checking for covers and downloading comments of each record is started as soon as
+        it is read, in the background. Its other issues are fetched in the background, too: with one query at a time,
+        for all records read while the previous query was running.
+        Only the first "enrich" records parsed get covers, comments and other issues (None: all of them),
+        the others are neither put into the record cache.
+        Records are read into MarcRecord objects, their XML is cleared right away.
+        Results are remembered in the dict "parsed" (IDN -> Metadata object or None),
+        records already in there are not parsed again. Records found in the record cache are not parsed at all.
+        """
+        def complete(record, enriched):
+            with span(log, 'parse_record'):
+                mi = self.parse_record(log, record, alternates, cover_probes, comments_downloads, enriched)
+            idn = self.get_idn(record)
+            if idn is not None:
+                parsed[idn] = mi
+                if mi is not None and enriched:
+                    self.cache_record(log, record, alternates, mi)
+            return mi
+
+        def other_issues_known(batch, wait):
+            # covers and comments of the other issues are looked up as soon as they are known
+            if batch[0] is None or not (wait or batch[0].done()):
+                return False
+            if not batch[2]:
+                batch[0].result()
+                batch[2] = True
+                self.start_cover_probes(log, batch[1], alternates, cover_probes, timeout)
+                if self.wanted('comments'):
+                    self.start_comments_downloads(log, batch[1], alternates, comments_downloads)
+            return True
+
+        # records read but not handed out yet, in order: (record, batch it is in or None if it is done, Metadata object or None)
+        pending = deque()
+        # records whose other issues are fetched with the same query: [Future of resolve_alternates() or None
+        # until it is started, records, covers and comments of the other issues started]
+        batch = [None, [], False]
+        running = None
+        enriched = 0
+        handed_out = False
+
+        for element in results:
+            record = MarcRecord(element)
+            # the XML of the record is not needed anymore
+            element.clear()
+            idn = self.get_idn(record)
+            if idn in parsed:
+                log.info("Record with IDN %s was already parsed" % idn)
+                pending.append((record, None, parsed[idn]))
+            else:
+                mi = self.get_cached_record(log, idn)
+                if mi is not None:
+                    parsed[idn] = mi
+                    pending.append((record, None, mi))
+                elif self.is_audio_or_video(record):
+                    if idn is not None:
+                        parsed[idn] = None
+                    pending.append((record, None, None))
+                elif enrich is not None and enriched >= enrich:
+                    pending.append((record, None, complete(record, False)))
+                else:
+                    enriched += 1
+                    self.start_cover_probes(log, [record], alternates, cover_probes, timeout)
+                    if self.wanted('comments'):
+                        self.start_comments_downloads(log, [record], alternates, comments_downloads)
+                    batch[1].append(record)
+                    pending.append((record, batch, None))
+
+            # one query for other issues at a time, records read in the meantime are batched into the next one
+            if batch[1] and (running is None or running[0].done()):
+                batch[0] = submit(self.resolve_alternates, log, batch[1], alternates, timeout)
+                running, batch = batch, [None, [], False]
+
+            # hand out the records that are done, only the first one is waited for, the others while reading on
+            while pending and (pending[0][1] is None or other_issues_known(pending[0][1], not handed_out)):
+                record, record_batch, mi = pending.popleft()
+                if record_batch is not None:
+                    mi = complete(record, True)
+                handed_out = True
+                yield record, mi
+
+        # the whole page is read: fetch the other issues of the last records right away and wait for the rest
+        # (records of a batch are only parsed after those of the batches before, whose queries are done by then)
+        if batch[1]:
+            batch[0] = ImmediateResult(self.resolve_alternates, log, batch[1], alternates, timeout)
+        while pending:
+            record, record_batch, mi = pending.popleft()
+            if record_batch is not None:
+                other_issues_known(record_batch, True)
+                mi = complete(record, True)
+            yield record, mi
+
+
+    def parse_record(self, log, record, alternates, cover_probes, comments_downloads, enrich=True):
+        """
+        Create Metadata object from a MarcRecord, return None for records to skip
+        Other issues, cover checks and comments downloads must have been started for the record already.
+        With "enrich" False, other issues are not looked at and comments and covers are left out.
+        The fields of the book are extracted by DNBRecord when they are read, ignored fields are never read.
+        """
+        phase = phases(log)
+
+        ##### Field 336: "Content Type" #####
+        ##### Field 337: "Media Type" #####
+        # Skip Audio Books, Audio and Video
+        phase.start('field 336/337')
+        if self.is_audio_or_video(record):
+            phase.end()
+            return None
 
-                mi.has_cover = self.cached_identifier_to_cover_url(book['idn']) is not None
 
-                mi.isbn = book['isbn']
-                mi.set_identifier('urn', book['urn'])
-                mi.set_identifier('dnb-idn', book['idn'])
-                mi.set_identifier('ddc', ",".join(book['ddc']))
+        ##### Field 776: "Additional Physical Form Entry" #####
+        # References from ebook's entry to paper book's entry (and vice versa)
+        # Often only one of them contains comments or a cover
+        # Example: dnb-idb=1136409025
+        # The other issues were already fetched by resolve_alternates() while the response was read
+        phase.start('field 776')
+        alternatives = []
+        for other_idn in (self.get_alternate_idns(record) if enrich else []):
+            log.info("[776.w] Found other issue with IDN %s" % other_idn)
+            if alternates.get(other_idn) is not None:
+                alternatives.append(alternates[other_idn])
+
+
+        ##### Field 16: "National Bibliographic Agency Control Number" #####
+        ##### Field 20: "International Standard Book Number" #####
+        phase.start('field 016/020')
+        book = DNBRecord(log, record, self, alternatives)
+
+
+        ##### Field 856: "Electronic Location and Access" #####
+        # Get Comments, either from this book or from one of its other "Physical Forms"
+        # Field contains an URL to an HTML file with the comments
+        # Example: dnb-idn:1256023949
+        # The first download was started in the background by start_comments_downloads() above,
+        # the other URLs are only tried if it fails
+        phase.start('field 856')
+        comments = None
+        urls = self.get_comments_urls(record, alternates) if self.wanted('comments') and enrich else []
+        for url in urls:
+            if url not in comments_downloads:
+                comments_downloads[url] = submit(self.download_comments, log, url)
+            comments = comments_downloads[url].result()
+            if comments is not None:
+                break
 
-                # cfg_subjects:
-                # 0: use only subjects_gnd
-                if self.cfg_fetch_subjects == 0:
-                    mi.tags = uniq(book['subjects_gnd'])
-                # 1: use only subjects_gnd if found, else subjects_non_gnd
-                elif self.cfg_fetch_subjects == 1:
-                    if book['subjects_gnd']:
-                        mi.tags = uniq(book['subjects_gnd'])
-                    else:
-                        mi.tags = uniq(book['subjects_non_gnd'])
-                # 2: subjects_gnd and subjects_non_gnd
-                elif self.cfg_fetch_subjects == 2:
-                    mi.tags = uniq(book['subjects_gnd'] + book['subjects_non_gnd'])
-                # 3: use only subjects_non_gnd if found, else subjects_gnd
-                elif self.cfg_fetch_subjects == 3:
-                    if book['subjects_non_gnd']:
-                        mi.tags = uniq(book['subjects_non_gnd'])
-                    else:
-                        mi.tags = uniq(book['subjects_gnd'])
-                # 4: use only subjects_non_gnd
-                elif self.cfg_fetch_subjects == 4:
-                    mi.tags = uniq(book['subjects_non_gnd'])
-                # 5: use no subjects at all
-                elif self.cfg_fetch_subjects == 5:
-                    mi.tags = []
-
-                # put current result's metdata into result queue
-                log.info("Final formatted result: \n%s\n-----" % mi)
-                result_queue.put(mi)
-                query_success = True
 
-            # Stop on first successful query
-            if query_success:
+        ##### Figure out working URL to cover #####
+        # Cover URL is basically fixed and takes ISBN as an argument
+        # So get all ISBNs we have for this book, including the ones of all alternative "physical forms"...
+        phase.start('cover')
+        for alternative in book.alternatives:
+            if alternative.isbn:
+                log.info("[020.a ALTERNATE] Identifier ISBN: %s" % alternative.isbn)
+                self.cache_isbn_to_identifier(alternative.isbn, book.idn)
+
+        # ...remember them for download_cover()...
+        cover_isbns = self.get_cover_isbns(record, alternates) if enrich else []
+        if enrich:
+            self.remember_issues(book.idn, self.get_isbns(record), cover_isbns)
+
+        # ...and take the first one the server has a cover for (checks were started by start_cover_probes() above)
+        for i in cover_isbns:
+            url = cover_probes[i].result()
+            if url:
+                self.cache_identifier_to_cover_url(book.idn, url)
                 break
 
 
+        ##### Put it all together #####
+        # reading the fields of the book extracts them
+        phase.start('Metadata')
+        title = book.title
+        if self.cfg_append_edition_to_title and book.edition:
+            title = title + " : " + book.edition
+
+        authors = list(map(lambda i: remove_sorting_characters(i), book.authors))
+
+        mi = Metadata(
+            remove_sorting_characters(title),
+            list(map(lambda i: re.sub(r"^(.+), (.+)$", r"\2 \1", i), authors))
+        )
+
+        mi.author_sort = " & ".join(authors)
+
+        mi.title_sort = remove_sorting_characters(book.title_sort)
+
+        if self.wanted('languages') and book.languages:
+            mi.language = book.languages[0]
+            mi.languages = book.languages
+
+        if self.wanted('pubdate'):
+            mi.pubdate = book.pubdate
+        if self.wanted('publisher'):
+            mi.publisher = " ; ".join(filter(
+                None, [book.publisher_location, remove_sorting_characters(book.publisher_name)]))
+
+        if self.wanted('series') and book.series:
+            mi.series = remove_sorting_characters(book.series.replace(',', '.'))
+            mi.series_index = book.series_index or "0"
+
+        mi.comments = comments
+
+        mi.has_cover = self.cached_identifier_to_cover_url(book.idn) is not None
+
+        mi.isbn = book.isbn
+        if self.wanted('identifier:urn'):
+            mi.set_identifier('urn', book.urn)
+        mi.set_identifier('dnb-idn', book.idn)
+        if self.wanted('identifier:ddc'):
+            mi.set_identifier('ddc', ",".join(book.ddc))
+
+        # cfg_subjects:
+        # 5: use no subjects at all (tags are ignored then, see get_ignored_fields())
+        if not self.wanted('tags'):
+            mi.tags = []
+        # 0: use only subjects_gnd
+        elif self.cfg_fetch_subjects == 0:
+            mi.tags = uniq(book.subjects_gnd)
+        # 1: use only subjects_gnd if found, else subjects_non_gnd
+        elif self.cfg_fetch_subjects == 1:
+            if book.subjects_gnd:
+                mi.tags = uniq(book.subjects_gnd)
+            else:
+                mi.tags = uniq(book.subjects_non_gnd)
+        # 2: subjects_gnd and subjects_non_gnd
+        elif self.cfg_fetch_subjects == 2:
+            mi.tags = uniq(book.subjects_gnd + book.subjects_non_gnd)
+        # 3: use only subjects_non_gnd if found, else subjects_gnd
+        elif self.cfg_fetch_subjects == 3:
+            if book.subjects_non_gnd:
+                mi.tags = uniq(book.subjects_non_gnd)
+            else:
+                mi.tags = uniq(book.subjects_gnd)
+        # 4: use only subjects_non_gnd
+        elif self.cfg_fetch_subjects == 4:
+            mi.tags = uniq(book.subjects_non_gnd)
+
+        # all fields are read, whether or not all groups of fields were needed
+        book.release()
+
+        phase.end()
+        return mi
+
+
     def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers=None, timeout=30, get_best_cover=False):
         """
         Download Cover image
         gets called directly from Calibre
         """
+        self.load_config()
+
         if identifiers is None:
             identifiers = {}
 
-        cached_url = self.get_cached_cover_url(identifiers)
-        if cached_url is None:
+        cached_url = self.resolve_cover_url(log, identifiers, abort, timeout)
+        if cached_url is None and not identifiers.get('dnb-idn') and not check_isbn(identifiers.get('isbn')):
             log.info('No cached cover found, running identify')
             rq = Queue()
             self.identify(log, rq, abort, title=title,
@@ -813,15 +683,121 @@ class DNB_DE(Source):
         if abort.is_set():
             return
 
-        br = self.browser
+        cdata = self.load_cover(cached_url)
+        if cdata is not None:
+            log('Got cover from cache:', cached_url)
+            result_queue.put((self, cdata))
+            return
+
         log('Downloading cover from:', cached_url)
         try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+            cdata = self.get_http_client().get(cached_url, timeout=timeout).read()
+            self.store_cover(cached_url, cdata)
             result_queue.put((self, cdata))
         except Exception as e:
             log.info("Could not download Cover, ERROR %s" % e)
 
 
+    def resolve_cover_url(self, log, identifiers, abort, timeout=30):
+        """
+        Find the cover URL of a book by its IDN or ISBN, without parsing records
+        Checks the cached URL first, then the ISBNs of the book and of its other issues known from earlier
+        searches. Only then the record is looked up by its identifier, for the ISBNs of its other issues.
+        Returns None if there is no cover, or if the book has neither IDN nor ISBN.
+        """
+        url = self.get_cached_cover_url(identifiers)
+        if url:
+            return url
+
+        idn = identifiers.get('dnb-idn', None)
+        isbn = check_isbn(identifiers.get('isbn', None))
+        if not idn and not isbn:
+            return None
+
+        # parsed before: the record cache knows whether there is a cover
+        if idn and self.get_cached_record(log, idn) is not None:
+            return self.cached_identifier_to_cover_url(idn)
+
+        probed = set()
+
+        def probe(isbns):
+            for i in isbns:
+                if i in probed or abort.is_set():
+                    continue
+                probed.add(i)
+                # the first cover found is the one to download
+                url = self.probe_cover(log, i, timeout, True)
+                if url:
+                    return url
+            return None
+
+        url = probe(([isbn] if isbn else []) + self.get_issues(idn, isbn))
+        if url:
+            if idn:
+                self.cache_identifier_to_cover_url(idn, url)
+            return url
+
+        # look up the record itself, for the ISBNs of its other issues
+        if abort.is_set():
+            return None
+        log.info('Looking up ISBNs of %s' % (idn or isbn))
+        alternates = {}
+        for results in self.execute_query(log, self.exclude_media('num=%s' % (idn or isbn)), timeout):
+            if abort.is_set():
+                return None
+            records = []
+            for element in results:
+                record = MarcRecord(element)
+                element.clear()
+                if not self.is_audio_or_video(record):
+                    records.append(record)
+            self.resolve_alternates(log, records, alternates, timeout)
+            if abort.is_set():
+                return None
+
+            for record in records:
+                record_idn = self.get_idn(record)
+                cover_isbns = self.get_cover_isbns(record, alternates)
+                self.remember_issues(record_idn, self.get_isbns(record), cover_isbns)
+                url = probe(cover_isbns)
+                if url:
+                    if record_idn:
+                        self.cache_identifier_to_cover_url(record_idn, url)
+                    return url
+            # the first page has the best matches
+            break
+        return None
+
+
+    def remember_issues(self, idn, isbns, issue_isbns):
+        """
+        Store the ISBNs of all issues of a book (see get_cover_isbns()), by its IDN and by all of its own ISBNs
+        """
+        cache = self.get_cache('issues', self.ISSUESCACHERETENTION, self.ISSUESCACHESIZE)
+        if not cache or not issue_isbns:
+            return
+        value = json.dumps(issue_isbns).encode('utf-8')
+        keys = ['isbn:' + isbn_as_isbn13(i) for i in isbns]
+        if idn:
+            keys.append('idn:' + idn)
+        for key in keys:
+            cache.set(key, value)
+
+
+    def get_issues(self, idn=None, isbn=None):
+        """
+        Get the ISBNs of all issues of a book stored by remember_issues(), or []
+        """
+        cache = self.get_cache('issues', self.ISSUESCACHERETENTION, self.ISSUESCACHESIZE)
+        if not cache:
+            return []
+        for key in (['idn:' + idn] if idn else []) + (['isbn:' + isbn_as_isbn13(isbn)] if isbn else []):
+            value = cache.get(key)
+            if value is not None:
+                return json.loads(value.decode('utf-8'))
+        return []
+
+
     def create_query_variations(self, log, idn=None, isbn=None, authors=None, title=None):
         """
         Create a number of SRU query variations, with increasing fuzziness
@@ -952,57 +928,706 @@ class DNB_DE(Source):
         if isbn:
             uniqueQueries = [ i + ' AND num=' + isbn for i in uniqueQueries ]
 
-        # do not search in films, music, microfiches or audiobooks
-        uniqueQueries = [ i + ' NOT (mat=film OR mat=music OR mat=microfiches OR cod=tt)' for i in uniqueQueries ]
+        uniqueQueries = [ self.exclude_media(i) for i in uniqueQueries ]
 
         return uniqueQueries
 
 
+    def exclude_media(self, query):
+        """
+        Add the media types to leave out to a query
+        """
+        # do not search in films, music, microfiches or audiobooks
+        return query + ' NOT (mat=film OR mat=music OR mat=microfiches OR cod=tt)'
+
+
+
+    def plan_queries(self, log, queries, abort, timeout=30):
+        """
+        Reorder query variations by selectivity
+        Probes the number of hits of a batch of variations in parallel, without fetching records.
+        Variations with hits come first, the most selective one (fewest hits) first, ties keep their order.
+        Variations without hits are dropped, variations not probed stay at the end.
+        """
+        batch_size = max(2, self.cfg_parallel_queries)
+        for start in range(0, len(queries), batch_size):
+            if abort.is_set():
+                break
+
+            batch = queries[start:start + batch_size]
+            counts = [(query, submit(self.count_query, log, query, timeout)) for query in batch]
+            counts = [(query, future.result()) for query, future in counts]
+
+            hits = [(count, i, query) for i, (query, count) in enumerate(counts) if count]
+            if hits:
+                hits.sort()
+                log.info("Query selectivity: %s" % ", ".join("%s hits for %s" % (count, query) for count, i, query in hits))
+                return [query for count, i, query in hits] + queries[start + batch_size:]
+
+            # keep variations we could not probe (e.g. due to network errors), drop those without hits
+            queries = queries[:start] + [query for query, count in counts if count is None] + queries[start + batch_size:]
+
+        return queries
+
 
-    def execute_query(self, log, query, timeout=30):
+    def run_queries(self, log, queries, abort, timeout=30, window=1):
         """
-        Query DNB SRU API
+        Execute SRU queries and yield (query, iterator over pages of results), keeping the order of the queries
+        Up to "window" queries are running at once. Queries still running
+        when the caller stops iterating are cancelled or their results are ignored.
+        The first query of the window is run by the caller, its response is parsed while it is read. Queries running
+        in the background read their responses completely, they do not keep connections busy until the caller gets to them.
+        """
+        window = max(1, window)
+        queries = iter(queries)
+        pending = deque()
+        try:
+            while not abort.is_set():
+                # keep the window filled
+                while len(pending) < window:
+                    try:
+                        query = next(queries)
+                    except StopIteration:
+                        break
+                    if window == 1 or not pending:
+                        pending.append((query, None))
+                    else:
+                        pending.append((query, submit(self.start_query, log, query, timeout, True)))
+
+                if not pending:
+                    break
+
+                query, future = pending.popleft()
+                if future is None:
+                    yield query, self.start_query(log, query, timeout)
+                else:
+                    yield query, future.result()
+        finally:
+            for query, future in pending:
+                if future is not None:
+                    future.cancel()
+
+
+    def is_audio_or_video(self, record):
+        """
+        Check if a record is an audio book, audio or video (fields 336 and 337)
+        """
+        ##### Field 336: "Content Type" #####
+        # Skip Audio Books
+        mediatype = record.value('336', 'a')
+        if mediatype and mediatype.lower() in ('gesprochenes wort'):
+            return True
+
+        ##### Field 337: "Media Type" #####
+        # Skip Audio and Video
+        mediatype = record.value('337', 'a')
+        if mediatype and mediatype.lower() in ('audio', 'video'):
+            return True
+
+        return False
+
+
+    def get_isbn(self, record):
+        """
+        Get first ISBN of a record (field 020, subfield a), without dashes
+        """
+        isbns = self.get_isbns(record)
+        if isbns:
+            return isbns[0]
+        return None
+
+
+    def get_isbns(self, record):
+        """
+        Get all ISBNs of a record (field 020, subfield a), without dashes
+        """
+        isbn_regex = "(?:ISBN(?:-1[03])?:? )?(?=[-0-9 ]{17}|[-0-9X ]{13}|[0-9X]{10})(?:97[89][- ]?)?[0-9]{1,5}[- ]?(?:[0-9]+[- ]?){2}[0-9X]"
+        isbns = []
+        for i in record.values('020', 'a'):
+            match = re.search(isbn_regex, i)
+            if match:
+                isbns.append(match.group().replace('-', ''))
+        return isbns
+
+
+    def get_idn(self, record):
+        """
+        Get IDN of a record (field 016, subfield a)
+        """
+        return record.value('016', 'a')
+
+
+    def get_cover_isbns(self, record, alternates):
+        """
+        Get all ISBNs to check for a cover: the record's own one first, then those of its other issues
+        """
+        candidates = [self.get_isbn(record)]
+        for other_idn in self.get_alternate_idns(record):
+            if alternates.get(other_idn) is not None:
+                candidates.append(alternates[other_idn].isbn)
+
+        isbns = []
+        for isbn in candidates:
+            if isbn and isbn not in isbns:
+                isbns.append(isbn)
+        return isbns
+
+
+    def start_cover_probes(self, log, records, alternates, cover_probes, timeout=30):
+        """
+        Check for covers of all ISBNs of all records concurrently
+        The Futures are stored in the dict "cover_probes" (ISBN -> Future of cover URL or None),
+        ISBNs already in there are not checked again.
+        """
+        for record in records:
+            if self.is_audio_or_video(record):
+                continue
+            for position, isbn in enumerate(self.get_cover_isbns(record, alternates)):
+                if isbn not in cover_probes:
+                    # the cover of the first ISBN is the one used if there is one: download it right away
+                    cover_probes[isbn] = submit(self.probe_cover, log, isbn, timeout, position == 0)
+
+
+    def probe_cover(self, log, isbn, timeout=30, download=False):
+        """
+        Check if the server has a cover for an ISBN, return the cover's URL or None
+        ISBNs without cover are remembered for some time in the negative cover cache.
+        With "download" and the cover cache enabled the cover is downloaded with the same request and stored,
+        download_cover() takes it from there. Otherwise only its existence is checked.
+        """
+        cache = self.get_cache('nocover', self.cfg_cover_cache_ttl, self.NEGATIVECOVERCACHESIZE)
+        if cache and cache.get(isbn) is not None:
+            log.info("No cover for ISBN %s (cached)" % isbn)
+            return None
+
+        url = self.COVERURL % isbn
+        if self.load_cover(url) is not None:
+            log.info("Cover for ISBN %s (cached)" % isbn)
+            return url
+
+        try:
+            with span(log, 'cover probe', isbn=isbn):
+                if download and self.get_cover_files():
+                    self.store_cover(url, self.get_http_client().get(url, timeout=timeout).read())
+                else:
+                    self.get_http_client().head(url, timeout=timeout)
+            return url
+        except HTTPError as e:
+            if cache and e.code in (404, 410):
+                cache.set(isbn, b'')
+        except Exception as e:
+            log.info("Could not check for cover at %s: %s" % (url, e))
+        return None
+
+
+    def get_comments_urls(self, record, alternates):
+        """
+        Get URLs of comments (field 856, subfield u), of the record itself first, then of its other issues
+        Only URLs pointing to deposit.dnb.de (COMMENTSURLS) are used.
+        """
+        urls = [self.get_comments_url(record)]
+        for other_idn in self.get_alternate_idns(record):
+            if alternates.get(other_idn) is not None:
+                urls.append(alternates[other_idn].comments_url)
+        return [url for url in urls if url]
+
+
+    def get_comments_url(self, record):
+        """
+        Get URL of comments of a record (first URL in field 856, subfield u), None if it does not point to COMMENTSURLS
+        """
+        try:
+            url = [u for u in record.values('856', 'u') if len(u) > 21][0]
+            if url.startswith(self.COMMENTSURLS):
+                return url
+        except IndexError:
+            pass
+        return None
+
+
+    def start_comments_downloads(self, log, records, alternates, comments_downloads):
+        """
+        Download comments of all records concurrently
+        Only the first URL of each record is downloaded, the others are fallbacks.
+        The Futures are stored in the dict "comments_downloads" (URL -> Future of comments or None),
+        URLs already in there are not downloaded again.
+        """
+        for record in records:
+            if self.is_audio_or_video(record):
+                continue
+            urls = self.get_comments_urls(record, alternates)
+            if urls and urls[0] not in comments_downloads:
+                comments_downloads[urls[0]] = submit(self.download_comments, log, urls[0])
+
+
+    def download_comments(self, log, url, timeout=30):
+        """
+        Get comments from an URL, or None if that fails
+        """
+        log.info('[856.u] Trying to download Comments from: %s' % url)
+        try:
+            with span(log, 'comments download', url=url):
+                comments = self.fetch_comments(log, url, timeout)
+            log.info('[856.u] Got Comments: %s' % comments)
+            return comments
+        except Exception as e:
+            log.info("[856.u] Could not download Comments from %s: %s" % (url, e))
+        return None
+
+
+    def fetch_comments(self, log, url, timeout=30):
+        """
+        Download comments from deposit.dnb.de and sanitize them
+        Comments are kept in an on-disk cache, unless cfg_comments_cache_ttl is 0. Entries older than
+        cfg_comments_cache_ttl are revalidated with a conditional request instead of being downloaded again.
+        """
+        cache = self.get_cache('comments', self.cfg_comments_cache_ttl * self.COMMENTSCACHERETENTION, self.COMMENTSCACHESIZE)
+
+        entry = None
+        if cache:
+            value, age = cache.get_with_age(url)
+            if value is not None:
+                entry = json.loads(value.decode('utf-8'))
+                if age < self.cfg_comments_cache_ttl * 3600:
+                    log.info('[856.u] Got Comments from cache')
+                    return entry['comments']
+
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.get_http_client().get(url, headers=headers, timeout=timeout)
+
+        if response.status == 304 and entry:
+            log.info('[856.u] Comments not modified')
+            # store again to restart the entry's lifetime
+            cache.set(url, value)
+            return entry['comments']
+
+        # Decode bytes to string for processing
+        comments_text = response.read().decode('utf-8')
+
+        # Skip service outage information web page
+        if 'Zugriff derzeit nicht möglich // Access currently unavailable' in comments_text:
+            raise Exception("Access currently unavailable")
+
+        # Process the text version
+        comments_text = re.sub(
+            r'(\s|<br>|<p>|\n)*Angaben aus der Verlagsmeldung(\s|<br>|<p>|\n)*(<h3>.*?</h3>)*(\s|<br>|<p>|\n)*',
+            '', comments_text, flags=re.IGNORECASE)
+        comments = sanitize_comments_html(comments_text)
+
+        if cache:
+            cache.set(url, json.dumps({
+                'comments': comments,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+            }).encode('utf-8'))
+        return comments
+
+
+    def get_alternate_idns(self, record):
+        """
+        Get IDNs of the other issues of a record (field 776, subfield w)
+        """
+        idns = []
+        for i in record.values('776', 'w'):
+            # remove prefix, e.g. "(DE-101)"
+            idns.append(re.sub(r"^\(.*\)", "", i))
+        return idns
+
+
+    def resolve_alternates(self, log, records, alternates, timeout=30):
+        """
+        Fetch the other issues of all records with OR-combined queries
+        Results are stored in the dict "alternates" (IDN -> Alternate, or None if not found),
+        IDNs already in there are not fetched again.
+        """
+        wanted = []
+        for record in records:
+            for other_idn in self.get_alternate_idns(record):
+                if other_idn and other_idn not in alternates and other_idn not in wanted:
+                    wanted.append(other_idn)
+
+        for i in range(0, len(wanted), self.MAXIMUMALTERNATES):
+            chunk = wanted[i:i + self.MAXIMUMALTERNATES]
+            for other_idn in chunk:
+                alternates[other_idn] = None
+
+            altquery = self.batch_query(['num=%s' % x for x in chunk])
+            with span(log, 'other issues (776)', idns=' '.join(chunk)):
+                for altresults in self.execute_query(log, altquery, timeout, maximum_records=len(chunk)):
+                    for element in altresults:
+                        altrecord = MarcRecord(element)
+                        element.clear()
+                        altidn = self.get_idn(altrecord)
+                        if altidn in chunk and alternates[altidn] is None:
+                            alternates[altidn] = Alternate(altidn, self.get_isbn(altrecord), self.get_comments_url(altrecord))
+
+
+    def start_query(self, log, query, timeout=30, prefetch=False):
+        """
+        Execute query and fetch its first page right away, return iterator over all pages
+        Only the response is fetched here, its records are parsed by the thread iterating over the page.
+        With "prefetch" (for queries started in the background) the response is read completely, otherwise
+        it is read while its records are parsed.
+        """
+        pages = self.execute_query(log, query, timeout, prefetch=prefetch)
+        first_page = next(pages, None)
+        if first_page is None:
+            return iter([])
+        return chain([first_page], pages)
+
+
+    def query_terms(self, query):
+        """
+        Get the search terms of a query, without the excluded media types
+        """
+        return re.sub(r" NOT \(.*\)$", '', query).split(' AND ')
+
+
+    def page_size(self, query):
+        """
+        Get number of records to fetch with the first page of a query
+        """
+        terms = self.query_terms(query)
+
+        # identifier lookups (e.g. "num=<ISBN> AND num=<ISBN>"): usually a single record
+        if all(t.startswith('num=') for t in terms):
+            return 1
+
+        # searches for authors only: many records are to be expected
+        if all(t.startswith('per=') for t in terms):
+            return self.MAXIMUMAUTHORRECORDS
+
+        return self.MAXIMUMRECORDS
+
+
+    def maximum_results(self, query):
+        """
+        Get the number of records of a query to parse, over all of its pages
+        Only searches for authors only are paged through, other queries are expected to find the book on their first page.
+        An identifier may match more than one record, fetched with a second page.
+        """
+        terms = self.query_terms(query)
+        if all(t.startswith('per=') for t in terms):
+            return self.MAXIMUMRESULTS
+        return self.MAXIMUMRECORDS
+
+
+    def execute_query(self, log, query, timeout=30, maximum_records=None, prefetch=False):
+        """
+        Query DNB SRU API, yield pages
+        Each page is an iterator over MARC21 records, which are handed out while the response is read and parsed.
+        With "prefetch" the response of the first page is read completely before it is handed out (see start_query()).
+        The next page is only fetched when the caller asks for it.
+        """
+        if maximum_records is None:
+            maximum_records = self.page_size(query)
+
+        start_record = 1
+        while True:
+            with span(log, 'execute_query', query=query, start_record=start_record):
+                response, store = self.send_query(log, query, maximum_records, timeout, start_record, prefetch and start_record == 1)
+            if response is None:
+                return
+
+            position = {}
+            records = self.iter_records(log, response, position)
+            stopped = True
+            try:
+                yield records
+                stopped = False
+            finally:
+                if stopped and not store:
+                    # the caller stopped early and the rest of the response is not needed
+                    records.close()
+                else:
+                    # parse what the caller did not look at: nextRecordPosition comes after the records,
+                    # and only completely parsed responses are cached
+                    for record in records:
+                        pass
+                    if store and not position.get('invalid'):
+                        self.store_query(query, maximum_records, start_record, response.data)
+
+            if position.get('invalid') or not position.get('count') or not position.get('next'):
+                return
+            start_record = position['next']
+
+            # there are more records than expected: fetch the rest with bigger pages
+            maximum_records = min(max(maximum_records, self.MAXIMUMRECORDS), position['count'] - start_record + 1)
+
+
+    def iter_records(self, log, response, position):
+        """
+        Yield MARC21 records of an SRU response while it is read and parsed
+        Records handed out earlier are detached from the tree, so it does not grow with the page size.
+        The number of records (numberOfRecords) and the position of the next page (nextRecordPosition)
+        are stored in the dict "position" as 'count' and 'next'. A response that is no valid answer
+        of the SRU service, or with diagnostics, sets position['invalid']. The response is closed at the end.
+        The parser is created when the first record is asked for, so it is only used by the thread reading the records.
+        """
+        tracer = get_tracer(log)
+        try:
+            started = time.time()
+            # the response is parsed as it is, MarcRecord normalizes the texts of the records (from decomposed to composed)
+            events = etree.iterparse(response, events=('end',), tag=(
+                '{http://www.loc.gov/zing/srw/}numberOfRecords', '{http://www.loc.gov/zing/srw/}nextRecordPosition',
+                '{http://www.loc.gov/zing/srw/}diagnostics', '{http://www.loc.gov/MARC21/slim}record'))
+            for event, elem in events:
+                if tracer:
+                    tracer.add('xml parse', started, time.time())
+
+                if elem.tag == '{http://www.loc.gov/zing/srw/}numberOfRecords':
+                    position['count'] = int(elem.text.strip())
+                    log.info('Got records: %s' % position['count'])
+                    continue
+
+                if elem.tag == '{http://www.loc.gov/zing/srw/}nextRecordPosition':
+                    position['next'] = int(elem.text.strip())
+                    continue
+
+                if elem.tag == '{http://www.loc.gov/zing/srw/}diagnostics':
+                    self.log_diagnostics(log, elem)
+                    position['invalid'] = True
+                    continue
+
+                yield elem
+
+                # zs:record > zs:recordData > marc21:record
+                wrapper = elem.getparent().getparent()
+                while wrapper.getprevious() is not None:
+                    del wrapper.getparent()[0]
+                started = time.time()
+
+            if 'count' not in position:
+                raise ValueError('No numberOfRecords in response')
+        except Exception as e:
+            # also errors reading the response
+            log.error('ERROR: Got invalid response: %s' % e)
+            position['invalid'] = True
+            # got an answer, but not from the SRU service (e.g. an error page of a proxy): slow down
+            self.get_http_client().report_problem(self.QUERYURL)
+        finally:
+            response.close()
+
+
+    def log_diagnostics(self, log, diagnostics):
+        """
+        Log the diagnostics of an SRU response
+        """
+        namespaces = {'diag': 'http://www.loc.gov/zing/srw/diagnostic/'}
+        for diagnostic in diagnostics.findall('diag:diagnostic', namespaces=namespaces):
+            log.error('ERROR: %s' % ": ".join(filter(None, [
+                diagnostic.findtext('diag:details', namespaces=namespaces),
+                diagnostic.findtext('diag:message', namespaces=namespaces)])))
+
+            # "general system error" and "system temporarily unavailable": slow down
+            uri = diagnostic.findtext('diag:uri', namespaces=namespaces)
+            if uri and uri.strip() in ('info:srw/diagnostic/1/1', 'info:srw/diagnostic/1/2'):
+                self.get_http_client().report_problem(self.QUERYURL)
+
+
+    def count_query(self, log, query, timeout=30):
+        """
+        Get number of records matching a query, without fetching any of them
+        """
+        response, store = self.send_query(log, query, 0, timeout)
+        if response is None:
+            return None
+        position = {}
+        for record in self.iter_records(log, response, position):
+            pass
+        if position.get('invalid'):
+            return None
+        if store:
+            self.store_query(query, 0, 1, response.data)
+        return position['count']
+
+
+    def send_query(self, log, query, maximum_records, timeout=30, start_record=1, prefetch=False):
+        """
+        Send query to DNB SRU API, return (response, store), or (None, False) on errors
+        The response is a file-like object, read it with iter_records() to get the records. Responses of DNB are
+        read from the network while they are parsed, unless "prefetch" is set: then they are read completely right away.
+        "store" tells if the response is to be put into the query cache with store_query() once it was parsed completely,
+        its body is kept in "data" then.
         """
         # SRU does not work with "+" or "?" characters in query, so we simply remove them
         query =  re.sub(r"[\+\?]", '', query)
 
         log.info('Query String: %s' % query)
 
-        queryUrl = self.QUERYURL % (self.MAXIMUMRECORDS, quote(query.encode('utf-8')))
+        queryUrl = self.QUERYURL % (maximum_records, start_record, quote(query.encode('utf-8')))
+
+        offline_index = self.get_offline_index(log)
+        if offline_index:
+            log.info('Searching in offline index %s' % offline_index.path)
+            return BytesIO(offline_index.sru_response(query, maximum_records, start_record)), False
+
         log.info('Query URL: %s' % queryUrl)
+        cache = self.get_cache('sru', self.cfg_query_cache_ttl, self.cfg_query_cache_size)
+        if cache:
+            raw_data = cache.get(self.query_cache_key(query, maximum_records, start_record))
+            if raw_data is not None:
+                log.info('Got response from cache (hits: %(hits)s, misses: %(misses)s)' % cache.stats())
+                return BytesIO(raw_data), False
 
-        xmlData = None
         try:
-            data = self.browser.open_novisit(queryUrl, timeout=timeout).read()
+            with span(log, 'sru request', url=queryUrl):
+                response = self.get_http_client().open(queryUrl, timeout=timeout)
+                if cache:
+                    response.keep_data()
+                if prefetch:
+                    response.buffer()
+            return response, bool(cache)
+        except Exception as e:
+            log.error('ERROR: Query failed: %s' % e)
+            return None, False
 
-            # "data" is of type "bytes", decode it to an utf-8 string, normalize the UTF-8 encoding (from decomposed to composed), and convert it back to bytes
-            data = normalize(data.decode('utf-8')).encode('utf-8')
-            #log.info('Got some data : %s' % data)
 
-            xmlData = etree.XML(data)
-            #log.info(etree.tostring(xmlData,pretty_print=True))
+    def store_query(self, query, maximum_records, start_record, raw_data):
+        """
+        Put the response of an SRU query into the query cache
+        """
+        cache = self.get_cache('sru', self.cfg_query_cache_ttl, self.cfg_query_cache_size)
+        if cache:
+            cache.set(self.query_cache_key(re.sub(r"[\+\?]", '', query), maximum_records, start_record), raw_data)
 
-            numOfRecords = xmlData.xpath("./zs:numberOfRecords", namespaces={"zs": "http://www.loc.gov/zing/srw/"})[0].text.strip()
-            log.info('Got records: %s' % numOfRecords)
 
-            if int(numOfRecords) == 0:
-                return None
+    def query_cache_key(self, query, maximum_records, start_record=1):
+        """
+        Create cache key for an SRU query
+        """
+        query = unicodedata.normalize('NFC', query)
+        query = re.sub(r"\s+", ' ', query).strip().lower()
+        return '%s|%s|%s' % (maximum_records, start_record, query)
 
-            return xmlData.xpath("./zs:records/zs:record/zs:recordData/marc21:record", namespaces={'marc21': 'http://www.loc.gov/MARC21/slim', "zs": "http://www.loc.gov/zing/srw/"})
-        except:
-            try:
-                diag = ": ".join([
-                    xmlData.find('diagnostics/diag:diagnostic/diag:details', namespaces={
-                        None: 'http://www.loc.gov/zing/srw/', 'diag': 'http://www.loc.gov/zing/srw/diagnostic/'}).text,
-                    xmlData.find('diagnostics/diag:diagnostic/diag:message', namespaces={
-                        None: 'http://www.loc.gov/zing/srw/', 'diag': 'http://www.loc.gov/zing/srw/diagnostic/'}).text
-                ])
-                log.error('ERROR: %s' % diag)
-                return None
-            except:
-                log.error('ERROR: Got invalid response:')
-                log.error(data)
-                return None
+
+    def get_cache(self, table, ttl, max_size):
+        """
+        Get persistent cache, shared with other calibre processes
+        ttl is given in hours, max_size in MB. Returns None if the cache is disabled.
+        """
+        if not ttl or not max_size:
+            return None
+        return open_cache(os.path.join(cache_dir(), 'DNB_DE', 'cache.sqlite'), table, ttl * 3600, max_size * 1024 * 1024)
+
+
+    def get_record_cache(self):
+        """
+        Get the two-tier (memory and disk) cache of parsed records, or None if it is disabled
+        """
+        disk = self.get_cache('records', self.cfg_record_cache_ttl, self.RECORDCACHESIZE)
+        if disk is None:
+            return None
+        return open_tiered_cache(disk, self.RECORDMEMORYCACHEENTRIES)
+
+
+    def get_cached_record(self, log, idn):
+        """
+        Get a new Metadata object for a record parsed before, or None
+        """
+        cache = self.get_record_cache()
+        if not cache or not idn:
+            return None
+        entry = cache.get('%s:%s' % (self.record_cache_version, idn))
+        if entry is None:
+            return None
+
+        log.info("Got record with IDN %s from cache" % idn)
+        for isbn in entry['alternative_isbns']:
+            self.cache_isbn_to_identifier(isbn, idn)
+        if entry['cover_url']:
+            self.cache_identifier_to_cover_url(idn, entry['cover_url'])
+        return metadata_from_json(entry['metadata'])
+
+
+    def cache_record(self, log, record, alternates, mi):
+        """
+        Store the Metadata object of a record, with its cover URL and the ISBNs of its other issues
+        """
+        cache = self.get_record_cache()
+        idn = self.get_idn(record)
+        if not cache or not idn:
+            return
+
+        # comments could not be downloaded this time, try again next time
+        if mi.comments is None and self.wanted('comments') and self.get_comments_urls(record, alternates):
+            return
+
+        isbn = self.get_isbn(record)
+        cache.set('%s:%s' % (self.record_cache_version, idn), {
+            'metadata': metadata_as_json(mi),
+            'cover_url': self.cached_identifier_to_cover_url(idn),
+            'alternative_isbns': [i for i in self.get_cover_isbns(record, alternates) if i != isbn],
+        })
+
+
+    def get_cover_files(self):
+        """
+        Get the on-disk store of cover images, or None if it is disabled
+        """
+        if not self.cfg_cover_image_cache_size:
+            return None
+        return open_file_cache(os.path.join(cache_dir(), 'DNB_DE', 'covers'), self.cfg_cover_image_cache_size * 1024 * 1024)
+
+
+    def store_cover(self, url, data):
+        """
+        Store a cover image downloaded from an URL
+        """
+        files = self.get_cover_files()
+        index = self.get_cache('covers', self.COVERCACHERETENTION, self.COVERINDEXSIZE)
+        if files and index and data:
+            index.set(url, files.put(data).encode('ascii'))
+
+
+    def load_cover(self, url):
+        """
+        Get the stored cover image downloaded from an URL, or None
+        """
+        files = self.get_cover_files()
+        index = self.get_cache('covers', self.COVERCACHERETENTION, self.COVERINDEXSIZE)
+        if not files or not index:
+            return None
+        digest = index.get(url)
+        if digest is None:
+            return None
+        return files.get(digest.decode('ascii'))
+
+
+    def get_offline_index(self, log):
+        """
+        Get the offline index to answer queries from, or None if DNB is to be asked
+        """
+        if not self.cfg_offline_index:
+            return None
+        if not os.path.isfile(self.cfg_offline_index):
+            log.error('Offline index %s does not exist, asking DNB' % self.cfg_offline_index)
+            return None
+        try:
+            return open_index(self.cfg_offline_index)
+        except Exception as e:
+            log.error('Could not open offline index %s, asking DNB: %s' % (self.cfg_offline_index, e))
+            return None
+
+
+    def get_http_client(self):
+        """
+        Get HTTP client with persistent connections to the DNB servers, shared by all threads of this process
+        """
+        client = get_client(user_agent=random_user_agent(allow_ie=False),
+                            verify_ssl_certificates=not self.ignore_ssl_errors,
+                            proxies=get_proxies())
+        client.set_max_requests_per_second(self.cfg_max_requests_per_second)
+        if os.environ.get('DNB_DE_RECORD') and client.recorder is None:
+            # record responses for the stand-in server
+            client.recorder = Recorder(os.environ['DNB_DE_RECORD'])
+        return client
 
 
     def get_cached_cover_url(self, identifiers):
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Benchmarks of the identify pipeline, run against recorded responses (see replay.py).
+#
+# Record the responses for the benchmark cases once (needs the live DNB servers):
+#   calibre-debug -e benchmark.py -- record <fixture directory>
+# Run the benchmarks, store the results and compare them with an earlier run:
+#   calibre-debug -e benchmark.py -- run <fixture directory> --output results.json --baseline baseline.json
+# The exit status is 1 if a result got worse than the baseline by more than the tolerance.
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+
+try:
+    # Python 2
+    from Queue import Queue, Empty
+except ImportError:
+    # Python3
+    from queue import Queue, Empty
+
+from lxml import etree
+
+from calibre_plugins.DNB_DE import DNB_DE
+from calibre_plugins.DNB_DE.config import DEFAULT_STORE_VALUES, KEY_UNWANTED_SERIES_NAMES
+from calibre_plugins.DNB_DE.helper import guess_series_from_title, clean_series, UnwantedSeries
+from calibre_plugins.DNB_DE.executor import ImmediateResult
+from calibre_plugins.DNB_DE.marc import MarcRecord
+from calibre_plugins.DNB_DE.replay import ReplayServer, load_fixtures, QUERYURL, COVERURL
+
+
+# books to identify, by input shape; taken from the tests in __init__.py
+CASES = [
+    {'shape': 'isbn', 'identifiers': {'isbn': '9783404285266'}},
+    {'shape': 'isbn', 'identifiers': {'isbn': '9783492303279'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1207331961'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1256023949'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1160947511'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1315080028'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '458320129'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1283230224'}},
+    {'shape': 'idn', 'identifiers': {'dnb-idn': '1205560297'}},
+    {'shape': 'title_author', 'title': 'kapital im 21. jahrhundert', 'authors': ['piketty']},
+    {'shape': 'title_author', 'title': 'Glutstrom', 'authors': ['Daniel Holbe', 'Ben Kryst Tomasson']},
+    {'shape': 'title_author', 'title': 'Der Rabbiner ohne Schuh', 'authors': ['Barbara Bišický-Ehrlich']},
+    {'shape': 'title', 'title': 'Der Mann mit dem dritten Auge'},
+    {'shape': 'title', 'title': 'Zar und Zimmermann'},
+    {'shape': 'title', 'title': 'junipeei - der pfad der gestrandeten'},
+]
+
+MARC21 = {'marc21': 'http://www.loc.gov/MARC21/slim'}
+
+
+class NullLog(object):
+    """
+    Log swallowing all messages, logging must not dominate the numbers
+    """
+    def __call__(self, *args, **kwargs):
+        pass
+    info = debug = warn = warning = error = exception = __call__
+
+
+class BenchmarkPlugin(DNB_DE):
+    """
+    Plugin without caches, so every run does the full work
+    """
+    # set when talking to the stand-in server instead of DNB
+    stand_in = False
+
+    def load_config(self):
+        DNB_DE.load_config(self)
+        self.cfg_offline_index = ''
+        if self.stand_in:
+            # the stand-in server does not need protection
+            self.cfg_max_requests_per_second = 1000
+
+    def get_cache(self, table, ttl, max_size):
+        return None
+
+
+def identify(plugin, case, timeout=30):
+    """
+    Identify a single book, return the number of results
+    """
+    results = Queue()
+    plugin.identify(NullLog(), results, threading.Event(), title=case.get('title'),
+                    authors=case.get('authors'), identifiers=dict(case.get('identifiers', {})), timeout=timeout)
+    return results.qsize()
+
+
+def load_records(fixtures):
+    """
+    Get all MARC21 records of the recorded SRU responses
+    """
+    records = []
+    for (method, path), (head, body) in sorted(fixtures.items()):
+        if '/sru/' not in path or head['status'] != 200:
+            continue
+        xml = etree.XML(body)
+        records.extend(xml.xpath('./zs:records/zs:record/zs:recordData/marc21:record',
+                                 namespaces=dict(MARC21, zs='http://www.loc.gov/zing/srw/')))
+    return records
+
+
+##### Benchmarks #####
+
+def bench_parse_record(plugin, records, repeat):
+    """
+    Time to turn a MARC21 record into a Metadata object (reading the XML included), in milliseconds per record
+    Covers and comments are not downloaded.
+    """
+    no_result = ImmediateResult(lambda: None)
+    jobs = []
+    for element in records:
+        record = MarcRecord(element)
+        cover_probes = dict((isbn, no_result) for isbn in plugin.get_cover_isbns(record, {}))
+        comments_downloads = dict((url, no_result) for url in plugin.get_comments_urls(record, {}))
+        jobs.append((element, cover_probes, comments_downloads))
+
+    log = NullLog()
+    start = time.time()
+    for i in range(repeat):
+        for element, cover_probes, comments_downloads in jobs:
+            plugin.parse_record(log, MarcRecord(element), {}, cover_probes, comments_downloads)
+    return (time.time() - start) * 1000 / (len(jobs) * repeat)
+
+
+def bench_series(records, corpus_size, unwanted):
+    """
+    Time of guess_series_from_title() and clean_series(), in microseconds per call
+    """
+    titles = []
+    series = []
+    for element in records:
+        record = MarcRecord(element)
+        title = record.value('245', 'a')
+        subtitle = record.value('245', 'b')
+        if title:
+            titles.append('%s : %s' % (title, subtitle) if subtitle else title)
+        series.extend(record.values('490', 'a') + record.values('830', 'a'))
+    if not titles:
+        return None, None
+
+    titles = (titles * (corpus_size // len(titles) + 1))[:corpus_size]
+    series = (series * (corpus_size // max(1, len(series)) + 1))[:corpus_size] or titles
+
+    log = NullLog()
+    start = time.time()
+    for title in titles:
+        guess_series_from_title(log, title)
+    guess_time = (time.time() - start) * 1000000 / len(titles)
+
+    start = time.time()
+    for s in series:
+        clean_series(log, s, 'Goldmann', unwanted)
+    clean_time = (time.time() - start) * 1000000 / len(series)
+
+    return guess_time, clean_time
+
+
+def bench_round_trips(plugin, server, cases):
+    """
+    Average number of requests per identify, by input shape
+    """
+    requests = {}
+    for case in cases:
+        before = server.requests
+        identify(plugin, case)
+        requests.setdefault(case['shape'], []).append(server.requests - before)
+    return dict((shape, sum(counts) / len(counts)) for shape, counts in requests.items())
+
+
+def bench_throughput(plugin, cases, concurrency, rounds):
+    """
+    Books identified per second with "concurrency" identify calls at a time
+    """
+    jobs = Queue()
+    for i in range(rounds):
+        for case in cases:
+            jobs.put(case)
+
+    def worker():
+        while True:
+            try:
+                case = jobs.get_nowait()
+            except Empty:
+                return
+            identify(plugin, case)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(cases) * rounds / (time.time() - start)
+
+
+##### Results #####
+
+def higher_is_better(name):
+    return name.startswith('books_per_second')
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print results next to the baseline, return names of results that got worse by more than tolerance
+    """
+    regressions = []
+    for name in sorted(results):
+        value = results[name]
+        old = baseline.get(name)
+        if value is None or not old:
+            print('%-32s %12.3f' % (name, value or 0))
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better(name) else change
+        flag = ''
+        if worse > tolerance:
+            flag = 'WORSE'
+            regressions.append(name)
+        elif -worse > tolerance:
+            flag = 'better'
+        print('%-32s %12.3f %12.3f %+8.1f%% %s' % (name, value, old, change * 100, flag))
+    return regressions
+
+
+def run(args):
+    fixtures = load_fixtures(args.fixtures)
+    cases = CASES
+    if args.cases:
+        with open(args.cases, 'rb') as f:
+            cases = json.loads(f.read().decode('utf-8'))
+
+    server = ReplayServer(fixtures, latency=args.latency).start()
+    BenchmarkPlugin.stand_in = True
+    BenchmarkPlugin.QUERYURL = server.base_url + QUERYURL
+    BenchmarkPlugin.COVERURL = server.base_url + COVERURL
+    BenchmarkPlugin.COMMENTSURLS = (server.base_url + '/',)
+    plugin = BenchmarkPlugin(None)
+    plugin.load_config()
+
+    results = {}
+    records = load_records(fixtures)
+    if records:
+        results['parse_record_ms'] = bench_parse_record(plugin, records, args.repeat)
+        results['guess_series_us'], results['clean_series_us'] = bench_series(
+            records, args.corpus_size, UnwantedSeries(DEFAULT_STORE_VALUES[KEY_UNWANTED_SERIES_NAMES]))
+
+    # warm up connections and the rate limiter
+    identify(plugin, cases[0])
+
+    for shape, count in bench_round_trips(plugin, server, cases).items():
+        results['round_trips.%s' % shape] = count
+    for concurrency in args.concurrency:
+        results['books_per_second.%s' % concurrency] = bench_throughput(plugin, cases, concurrency, args.rounds)
+
+    if server.misses:
+        print('Warning: %s requests were not recorded, record the fixtures again' % server.misses)
+    server.shutdown()
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'rb') as f:
+            baseline = json.loads(f.read().decode('utf-8'))['results']
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(json.dumps({
+                'plugin_version': '.'.join(str(x) for x in DNB_DE.version),
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'settings': {'latency': args.latency, 'repeat': args.repeat, 'rounds': args.rounds,
+                             'corpus_size': args.corpus_size, 'cases': len(cases)},
+                'results': results,
+            }, indent=1, sort_keys=True).encode('utf-8'))
+
+    return 1 if regressions else 0
+
+
+def record(args):
+    os.environ['DNB_DE_RECORD'] = args.fixtures
+    cases = CASES
+    if args.cases:
+        with open(args.cases, 'rb') as f:
+            cases = json.loads(f.read().decode('utf-8'))
+
+    plugin = BenchmarkPlugin(None)
+    for case in cases:
+        print('%s: %s results' % (case, identify(plugin, case)))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the identify pipeline')
+    commands = parser.add_subparsers(dest='command')
+
+    record_parser = commands.add_parser('record', help='record responses of the live DNB servers for the benchmark cases')
+    record_parser.add_argument('fixtures', help='directory to store the responses in')
+    record_parser.add_argument('--cases', help='JSON file with the books to identify, default: built-in cases')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks against recorded responses')
+    run_parser.add_argument('fixtures', help='directory with recorded responses')
+    run_parser.add_argument('--cases', help='JSON file with the books to identify, default: built-in cases')
+    run_parser.add_argument('--output', help='write results to this JSON file')
+    run_parser.add_argument('--baseline', help='compare with the results in this JSON file')
+    run_parser.add_argument('--tolerance', type=float, default=0.1, help='allowed change for the worse (0.1: 10%%)')
+    run_parser.add_argument('--latency', type=float, default=0.05, help='latency of the stand-in server in seconds')
+    run_parser.add_argument('--repeat', type=int, default=20, help='parse every record this many times')
+    run_parser.add_argument('--corpus-size', type=int, default=10000, help='number of titles for the series benchmarks')
+    run_parser.add_argument('--rounds', type=int, default=3, help='identify every case this many times per concurrency level')
+    run_parser.add_argument('--concurrency', type=lambda x: [int(i) for i in x.split(',')], default=[1, 2, 4, 8],
+                            help='comma separated concurrency levels')
+
+    args = parser.parse_args()
+    if args.command == 'record':
+        sys.exit(record(args))
+    elif args.command == 'run':
+        sys.exit(run(args))
+    parser.print_help()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SQLiteCache(object):
+    """
+    Persistent key/value cache stored in a table of an SQLite database
+    The database runs in WAL mode, so it can be shared by several calibre worker processes.
+    Entries expire after "ttl" seconds. If the stored (compressed) values grow beyond "max_size"
+    bytes the least recently used entries are evicted.
+    """
+
+    # evict entries only every n-th write, summing up the table size is not free
+    EVICT_EVERY = 20
+
+    def __init__(self, path, table, ttl, max_size):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS "%s" (key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)' % table)
+        self._connection().execute(
+            'CREATE INDEX IF NOT EXISTS "%s_accessed" ON "%s" (accessed)' % (table, table))
+
+    def _connection(self):
+        """
+        Get this thread's connection to the database
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """
+        Get value for key, or None if there is no valid entry
+        """
+        return self.get_with_age(key)[0]
+
+    def get_with_age(self, key):
+        """
+        Get (value, age in seconds) for key, or (None, None) if there is no valid entry
+        """
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT value, created FROM "%s" WHERE key = ?' % self.table, (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self._count(False)
+                return None, None
+            conn.execute('UPDATE "%s" SET accessed = ? WHERE key = ?' % self.table, (now, key))
+            value = zlib.decompress(bytes(row[0]))
+        except (sqlite3.Error, zlib.error):
+            self._count(False)
+            return None, None
+        self._count(True)
+        return value, now - row[1]
+
+    def set(self, key, value):
+        """
+        Store value (bytes) for key
+        """
+        now = time.time()
+        data = zlib.compress(value)
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO "%s" (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)' % self.table,
+                (key, sqlite3.Binary(data), len(data), now, now))
+        except sqlite3.Error:
+            return
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def delete(self, key):
+        """
+        Remove entry for key
+        """
+        try:
+            self._connection().execute('DELETE FROM "%s" WHERE key = ?' % self.table, (key,))
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        """
+        Remove expired entries and, if the cache is too big, the least recently used ones
+        """
+        try:
+            conn = self._connection()
+            conn.execute('DELETE FROM "%s" WHERE created < ?' % self.table, (time.time() - self.ttl,))
+
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM "%s"' % self.table).fetchone()[0]
+            if total <= self.max_size:
+                return
+
+            # shrink to 90% of the limit, so not every write triggers an eviction
+            excess = total - self.max_size * 0.9
+            victims = []
+            for key, size in conn.execute('SELECT key, size FROM "%s" ORDER BY accessed' % self.table):
+                if excess <= 0:
+                    break
+                victims.append((key,))
+                excess -= size
+            conn.executemany('DELETE FROM "%s" WHERE key = ?' % self.table, victims)
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """
+        Get hit/miss counters of this process
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class TieredCache(object):
+    """
+    In-process LRU cache of JSON values in front of an SQLiteCache
+    Values read from disk are kept in memory, up to "max_entries" of them. Entries expire
+    after the TTL of the SQLiteCache in both tiers.
+    """
+
+    def __init__(self, disk, max_entries):
+        self.disk = disk
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get value for key, or None if there is no valid entry
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and now - entry[1] <= self.disk.ttl:
+                # most recently used entries are at the end
+                self._entries[key] = entry
+                self.disk._count(True)
+                return entry[0]
+
+        data, age = self.disk.get_with_age(key)
+        if data is None:
+            return None
+        try:
+            value = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+        self._remember(key, value, now - age)
+        return value
+
+    def set(self, key, value):
+        """
+        Store value (anything JSON can encode) for key
+        """
+        self.disk.set(key, json.dumps(value).encode('utf-8'))
+        self._remember(key, value, time.time())
+
+    def _remember(self, key, value, created):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, created)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return self.disk.stats()
+
+
+class FileCache(object):
+    """
+    Content-addressed store of files (e.g. cover images) in a directory
+    Each file is named by the SHA-1 of its content, so identical files are stored only once.
+    Files are touched when read. If they grow beyond "max_size" bytes the least recently used ones are removed.
+    """
+
+    # evict files only every n-th write, summing up the directory size is not free
+    EVICT_EVERY = 20
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, data):
+        """
+        Store data (bytes), return its digest
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest)
+        try:
+            if os.path.exists(path):
+                os.utime(path, None)
+                return digest
+
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process in the meantime
+                    pass
+            # write to a temporary file first, other threads and processes may store the same file
+            temp = '%s.%s.%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            return digest
+
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+        return digest
+
+    def get(self, digest):
+        """
+        Get data by its digest, or None if it is not stored (anymore)
+        """
+        path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def evict(self):
+        """
+        Remove the least recently used files if the cache is too big
+        """
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_size:
+            return
+
+        # shrink to 90% of the limit, so not every write triggers an eviction
+        excess = total - self.max_size * 0.9
+        for mtime, size, path in sorted(files):
+            if excess <= 0:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            excess -= size
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def open_cache(path, table, ttl, max_size):
+    """
+    Get the process wide cache for a table, and apply the current TTL and size limit
+    """
+    with _caches_lock:
+        cache = _caches.get((path, table))
+        if cache is None:
+            cache = SQLiteCache(path, table, ttl, max_size)
+            _caches[(path, table)] = cache
+        cache.ttl = ttl
+        cache.max_size = max_size
+    return cache
+
+
+def open_tiered_cache(disk, max_entries):
+    """
+    Get the process wide in-memory tier in front of a cache returned by open_cache()
+    """
+    with _caches_lock:
+        cache = _caches.get((disk.path, disk.table, 'memory'))
+        if cache is None:
+            cache = TieredCache(disk, max_entries)
+            _caches[(disk.path, disk.table, 'memory')] = cache
+        cache.max_entries = max_entries
+    return cache
+
+
+def open_file_cache(directory, max_size):
+    """
+    Get the process wide file cache for a directory, and apply the current size limit
+    """
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = FileCache(directory, max_size)
+            _caches[directory] = cache
+        cache.max_size = max_size
+    return cache
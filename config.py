@@ -4,13 +4,16 @@ from __future__ import (unicode_literals, division,
                         absolute_import, print_function)
 from calibre.utils.config import JSONConfig
 from calibre.gui2.metadata.config import ConfigWidget as DefaultConfigWidget
+from calibre.gui2 import error_dialog
 
 __license__ = 'agpl-3.0'
 __copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
 __docformat__ = 'restructuredtext en'
 
 
-from PyQt5.Qt import QLabel, QGridLayout, QGroupBox, QCheckBox, QButtonGroup, QRadioButton, QPlainTextEdit
+from PyQt5.Qt import QLabel, QGridLayout, QGroupBox, QCheckBox, QButtonGroup, QRadioButton, QPlainTextEdit, QSpinBox, QLineEdit
+
+from calibre_plugins.DNB_DE.helper import UnwantedSeries
 
 STORE_NAME = 'Options'
 
@@ -19,6 +22,17 @@ KEY_APPEND_EDITION_TO_TITLE = 'appendEditionToTitle'
 KEY_FETCH_SUBJECTS = 'subjects'
 KEY_SKIP_SERIES_STARTING_WITH_PUBLISHERS_NAME = 'skipSeriesStartingWithPublishersName'
 KEY_UNWANTED_SERIES_NAMES = 'unwantedSeriesNames'
+KEY_PARALLEL_QUERIES = 'parallelQueries'
+KEY_QUERY_CACHE_TTL = 'queryCacheTtl'
+KEY_QUERY_CACHE_SIZE = 'queryCacheSize'
+KEY_COVER_CACHE_TTL = 'coverCacheTtl'
+KEY_COMMENTS_CACHE_TTL = 'commentsCacheTtl'
+KEY_MAX_REQUESTS_PER_SECOND = 'maxRequestsPerSecond'
+KEY_PROBE_SELECTIVITY = 'probeSelectivity'
+KEY_OFFLINE_INDEX = 'offlineIndex'
+KEY_TRACE = 'trace'
+KEY_RECORD_CACHE_TTL = 'recordCacheTtl'
+KEY_COVER_IMAGE_CACHE_SIZE = 'coverImageCacheSize'
 
 DEFAULT_STORE_VALUES = {
     KEY_GUESS_SERIES: True,
@@ -38,6 +52,28 @@ DEFAULT_STORE_VALUES = {
                                 r'^Unionsverlag', r'^Ariadne-Krimi', r'^C.-Bertelsmann', r'^Phantastische Bibliothek$',
                                 r'^Beck Paperback$', r'^Beck\'sche Reihe$', r'^Knaur', r'^Volk-und-Welt', r'^Allgemeine',
                                 r'^Premium', r'^Horror-Bibliothek$'],
+    # number of query variations sent to DNB at once
+    KEY_PARALLEL_QUERIES: 3,
+    # hours to keep DNB responses in the on-disk cache, 0: no cache
+    KEY_QUERY_CACHE_TTL: 168,
+    # maximum size of cached DNB responses in MB
+    KEY_QUERY_CACHE_SIZE: 100,
+    # hours to remember ISBNs without cover, 0: check every time
+    KEY_COVER_CACHE_TTL: 168,
+    # hours cached comments are used without asking the server if they changed
+    KEY_COMMENTS_CACHE_TTL: 720,
+    # upper limit of requests per second to each DNB server, lowered automatically if the server struggles
+    KEY_MAX_REQUESTS_PER_SECOND: 10,
+    # count hits of query variations before fetching records
+    KEY_PROBE_SELECTIVITY: False,
+    # file of an offline index built from DNB's MARC21 dumps (see offline.py), empty: ask DNB
+    KEY_OFFLINE_INDEX: '',
+    # write the timing of all phases of each search into a trace file
+    KEY_TRACE: False,
+    # hours to keep parsed books, 0: parse every time
+    KEY_RECORD_CACHE_TTL: 168,
+    # maximum size of cached cover images in MB, 0: no cache
+    KEY_COVER_IMAGE_CACHE_SIZE: 200,
 }
 
 # This is where all preferences for this plugin will be stored
@@ -141,10 +177,276 @@ class ConfigWidget(DefaultConfigWidget):
         other_group_box_layout.addWidget(
             self.unwantedSeriesNames_textarea, row, 1, 1, 1)
 
+        performance_group_box = QGroupBox('Performance options', self)
+        self.l.addWidget(performance_group_box, self.l.rowCount(), 0, 1, 2)
+        performance_group_box_layout = QGridLayout()
+        performance_group_box.setLayout(performance_group_box_layout)
+
+        # Number of parallel queries
+        row = 0
+        parallel_queries_label = QLabel(
+            'Number of parallel queries:', self)
+        parallel_queries_label.setToolTip('If no identifier is known the plugin tries many query variations, from specific to fuzzy.\n'
+                                          'This many of them are sent to DNB at once. The most specific query with results still wins.\n'
+                                          'Set to 1 to send one query after the other.')
+        performance_group_box_layout.addWidget(parallel_queries_label, row, 0, 1, 1)
+
+        self.parallel_queries_spinbox = QSpinBox(self)
+        self.parallel_queries_spinbox.setRange(1, 10)
+        self.parallel_queries_spinbox.setValue(
+            c.get(KEY_PARALLEL_QUERIES, DEFAULT_STORE_VALUES[KEY_PARALLEL_QUERIES]))
+        performance_group_box_layout.addWidget(
+            self.parallel_queries_spinbox, row, 1, 1, 1)
+
+        # Maximum number of requests per second
+        row += 1
+        max_requests_per_second_label = QLabel(
+            'Maximum requests per second:', self)
+        max_requests_per_second_label.setToolTip('Upper limit of requests per second sent to each DNB server, shared by all downloads of a calibre process.\n'
+                                                 'The plugin lowers the rate automatically if DNB answers slowly or with errors,\n'
+                                                 'and raises it again up to this limit when the answers are fine.')
+        performance_group_box_layout.addWidget(max_requests_per_second_label, row, 0, 1, 1)
+
+        self.max_requests_per_second_spinbox = QSpinBox(self)
+        self.max_requests_per_second_spinbox.setRange(1, 100)
+        self.max_requests_per_second_spinbox.setValue(
+            c.get(KEY_MAX_REQUESTS_PER_SECOND, DEFAULT_STORE_VALUES[KEY_MAX_REQUESTS_PER_SECOND]))
+        performance_group_box_layout.addWidget(
+            self.max_requests_per_second_spinbox, row, 1, 1, 1)
+
+        # Probe selectivity of queries?
+        row += 1
+        probe_selectivity_label = QLabel(
+            'Count hits before fetching records:', self)
+        probe_selectivity_label.setToolTip('Without ISBN or IDN the plugin tries many query variations.\n'
+                                           'If enabled, it first asks DNB how many books match each variation (which is cheap),\n'
+                                           'and then only downloads the books of the variation with the fewest hits.')
+        performance_group_box_layout.addWidget(probe_selectivity_label, row, 0, 1, 1)
+
+        self.probe_selectivity_checkbox = QCheckBox(self)
+        self.probe_selectivity_checkbox.setChecked(
+            c.get(KEY_PROBE_SELECTIVITY, DEFAULT_STORE_VALUES[KEY_PROBE_SELECTIVITY]))
+        performance_group_box_layout.addWidget(
+            self.probe_selectivity_checkbox, row, 1, 1, 1)
+
+        # Keep query results for how long?
+        row += 1
+        query_cache_ttl_label = QLabel(
+            'Cache DNB responses for (hours):', self)
+        query_cache_ttl_label.setToolTip('Responses of DNB are stored on disk and re-used when the same query is sent again.\n'
+                                         'The cache is shared by all calibre processes. Set to 0 to disable the cache.')
+        performance_group_box_layout.addWidget(query_cache_ttl_label, row, 0, 1, 1)
+
+        self.query_cache_ttl_spinbox = QSpinBox(self)
+        self.query_cache_ttl_spinbox.setRange(0, 8760)
+        self.query_cache_ttl_spinbox.setValue(
+            c.get(KEY_QUERY_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_QUERY_CACHE_TTL]))
+        performance_group_box_layout.addWidget(
+            self.query_cache_ttl_spinbox, row, 1, 1, 1)
+
+        # Maximum size of query cache
+        row += 1
+        query_cache_size_label = QLabel(
+            'Maximum size of response cache (MB):', self)
+        query_cache_size_label.setToolTip('If the cache grows beyond this size the least recently used responses are removed.')
+        performance_group_box_layout.addWidget(query_cache_size_label, row, 0, 1, 1)
+
+        self.query_cache_size_spinbox = QSpinBox(self)
+        self.query_cache_size_spinbox.setRange(1, 10000)
+        self.query_cache_size_spinbox.setValue(
+            c.get(KEY_QUERY_CACHE_SIZE, DEFAULT_STORE_VALUES[KEY_QUERY_CACHE_SIZE]))
+        performance_group_box_layout.addWidget(
+            self.query_cache_size_spinbox, row, 1, 1, 1)
+
+        # Keep how many cover images?
+        row += 1
+        cover_image_cache_size_label = QLabel(
+            'Maximum size of cover cache (MB):', self)
+        cover_image_cache_size_label.setToolTip('Covers of the books found are downloaded while searching and stored on disk,\n'
+                                                'downloading them later takes them from there.\n'
+                                                'The least recently used covers are removed when the cache is full.\n'
+                                                'Set to 0 to disable the cover cache.')
+        performance_group_box_layout.addWidget(cover_image_cache_size_label, row, 0, 1, 1)
+
+        self.cover_image_cache_size_spinbox = QSpinBox(self)
+        self.cover_image_cache_size_spinbox.setRange(0, 10000)
+        self.cover_image_cache_size_spinbox.setValue(
+            c.get(KEY_COVER_IMAGE_CACHE_SIZE, DEFAULT_STORE_VALUES[KEY_COVER_IMAGE_CACHE_SIZE]))
+        performance_group_box_layout.addWidget(
+            self.cover_image_cache_size_spinbox, row, 1, 1, 1)
+
+        # Remember missing covers for how long?
+        row += 1
+        cover_cache_ttl_label = QLabel(
+            'Remember books without cover for (hours):', self)
+        cover_cache_ttl_label.setToolTip('ISBNs DNB has no cover for are not checked again for this time.\n'
+                                         'Set to 0 to check every time.')
+        performance_group_box_layout.addWidget(cover_cache_ttl_label, row, 0, 1, 1)
+
+        self.cover_cache_ttl_spinbox = QSpinBox(self)
+        self.cover_cache_ttl_spinbox.setRange(0, 8760)
+        self.cover_cache_ttl_spinbox.setValue(
+            c.get(KEY_COVER_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_COVER_CACHE_TTL]))
+        performance_group_box_layout.addWidget(
+            self.cover_cache_ttl_spinbox, row, 1, 1, 1)
+
+        # Keep parsed books for how long?
+        row += 1
+        record_cache_ttl_label = QLabel(
+            'Keep found books for (hours):', self)
+        record_cache_ttl_label.setToolTip('Books found on DNB are stored on disk, with their comments and cover.\n'
+                                          'Searches finding them again, or looking them up by IDN, use the stored data.\n'
+                                          'Books stored with other settings are not used.\n'
+                                          'Set to 0 to always fetch them from DNB.')
+        performance_group_box_layout.addWidget(record_cache_ttl_label, row, 0, 1, 1)
+
+        self.record_cache_ttl_spinbox = QSpinBox(self)
+        self.record_cache_ttl_spinbox.setRange(0, 8760)
+        self.record_cache_ttl_spinbox.setValue(
+            c.get(KEY_RECORD_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_RECORD_CACHE_TTL]))
+        performance_group_box_layout.addWidget(
+            self.record_cache_ttl_spinbox, row, 1, 1, 1)
+
+        # Use cached comments for how long?
+        row += 1
+        comments_cache_ttl_label = QLabel(
+            'Use cached comments for (hours):', self)
+        comments_cache_ttl_label.setToolTip('Downloaded comments are stored on disk, for 12 times as long as set here.\n'
+                                            'Older comments are only downloaded again if they were changed on the server.\n'
+                                            'Set to 0 to not store comments at all.')
+        performance_group_box_layout.addWidget(comments_cache_ttl_label, row, 0, 1, 1)
+
+        self.comments_cache_ttl_spinbox = QSpinBox(self)
+        self.comments_cache_ttl_spinbox.setRange(0, 8760)
+        self.comments_cache_ttl_spinbox.setValue(
+            c.get(KEY_COMMENTS_CACHE_TTL, DEFAULT_STORE_VALUES[KEY_COMMENTS_CACHE_TTL]))
+        performance_group_box_layout.addWidget(
+            self.comments_cache_ttl_spinbox, row, 1, 1, 1)
+
+        # Answer queries from an offline index?
+        row += 1
+        offline_index_label = QLabel(
+            'Offline index file:', self)
+        offline_index_label.setToolTip('Path of an index built from the MARC21 bulk data of DNB with\n'
+                                       '"calibre-debug -e offline.py -- import <dump> <index file>".\n'
+                                       'If set, searches are answered from this file instead of the DNB server.\n'
+                                       'Covers and comments are still downloaded from DNB. Leave empty to search at DNB.')
+        performance_group_box_layout.addWidget(offline_index_label, row, 0, 1, 1)
+
+        self.offline_index_lineedit = QLineEdit(self)
+        self.offline_index_lineedit.setText(
+            c.get(KEY_OFFLINE_INDEX, DEFAULT_STORE_VALUES[KEY_OFFLINE_INDEX]))
+        performance_group_box_layout.addWidget(
+            self.offline_index_lineedit, row, 1, 1, 1)
+
+        # Write traces?
+        row += 1
+        trace_label = QLabel(
+            'Write timing traces:', self)
+        trace_label.setToolTip('Write the timing of all phases of each search (queries, parsing, covers, comments)\n'
+                               'into a trace file in calibre\'s cache directory, the log shows its name.\n'
+                               'Only the newest 100 trace files are kept.\n'
+                               'Open the file with chrome://tracing or https://ui.perfetto.dev to see where the time went.')
+        performance_group_box_layout.addWidget(trace_label, row, 0, 1, 1)
+
+        self.trace_checkbox = QCheckBox(self)
+        self.trace_checkbox.setChecked(
+            c.get(KEY_TRACE, DEFAULT_STORE_VALUES[KEY_TRACE]))
+        performance_group_box_layout.addWidget(
+            self.trace_checkbox, row, 1, 1, 1)
+
+        # Problems with the settings, shown while editing them
+        self.invalid_settings_label = QLabel(self)
+        self.invalid_settings_label.setStyleSheet('color: red')
+        self.invalid_settings_label.setWordWrap(True)
+        self.l.addWidget(self.invalid_settings_label, self.l.rowCount(), 0, 1, 2)
+
+        # number fields: (label, spin box, stored value if it was out of range)
+        self.spinboxes = []
+        for label, spinbox, key in [
+                (parallel_queries_label, self.parallel_queries_spinbox, KEY_PARALLEL_QUERIES),
+                (max_requests_per_second_label, self.max_requests_per_second_spinbox, KEY_MAX_REQUESTS_PER_SECOND),
+                (query_cache_ttl_label, self.query_cache_ttl_spinbox, KEY_QUERY_CACHE_TTL),
+                (query_cache_size_label, self.query_cache_size_spinbox, KEY_QUERY_CACHE_SIZE),
+                (cover_image_cache_size_label, self.cover_image_cache_size_spinbox, KEY_COVER_IMAGE_CACHE_SIZE),
+                (cover_cache_ttl_label, self.cover_cache_ttl_spinbox, KEY_COVER_CACHE_TTL),
+                (record_cache_ttl_label, self.record_cache_ttl_spinbox, KEY_RECORD_CACHE_TTL),
+                (comments_cache_ttl_label, self.comments_cache_ttl_spinbox, KEY_COMMENTS_CACHE_TTL)]:
+            stored = c.get(key, DEFAULT_STORE_VALUES[key])
+            self.spinboxes.append((label, spinbox, stored if stored != spinbox.value() else None))
+            spinbox.lineEdit().textChanged.connect(self.show_invalid_settings)
+        self.unwantedSeriesNames_textarea.textChanged.connect(self.show_invalid_settings)
+        self.show_invalid_settings()
+
+
+    def unwanted_series_names(self):
+        """
+        Get the patterns for unwanted series names, without empty lines
+        """
+        return [x for x in self.unwantedSeriesNames_textarea.toPlainText().split("\n") if x.strip()]
+
+
+    def invalid_settings(self):
+        """
+        Get the problems of the settings as entered, as list of (widget, message)
+        """
+        problems = []
+        for pattern, error in UnwantedSeries(self.unwanted_series_names()).invalid:
+            problems.append((self.unwantedSeriesNames_textarea,
+                             'Pattern "%s" for unwanted series names is not a valid regular expression: %s' % (pattern, error)))
+
+        for label, spinbox, stored in self.spinboxes:
+            if not spinbox.hasAcceptableInput():
+                problems.append((spinbox, '%s must be a number between %s and %s, "%s" is not' % (
+                    label.text().rstrip(':'), spinbox.minimum(), spinbox.maximum(), spinbox.text())))
+        return problems
+
+
+    def changed_settings(self):
+        """
+        Get the stored numbers that were out of range and were changed to fit, as list of (widget, message)
+        """
+        changes = []
+        for label, spinbox, stored in self.spinboxes:
+            if stored is not None and spinbox.hasAcceptableInput() and spinbox.value() in (spinbox.minimum(), spinbox.maximum()):
+                changes.append((spinbox, '%s was %s, which is out of range. Saving changes it to %s' % (
+                    label.text().rstrip(':'), stored, spinbox.value())))
+        return changes
+
+
+    def show_invalid_settings(self):
+        """
+        Highlight fields with invalid or changed settings and list their problems
+        """
+        problems = self.invalid_settings() + self.changed_settings()
+        invalid_widgets = [widget for widget, message in problems]
+        for widget in [self.unwantedSeriesNames_textarea] + [spinbox for label, spinbox, stored in self.spinboxes]:
+            widget.setStyleSheet('border: 1px solid red' if widget in invalid_widgets else '')
+        self.invalid_settings_label.setText('\n'.join(message for widget, message in problems))
+        self.invalid_settings_label.setVisible(bool(problems))
+
+
+    def validate(self):
+        """
+        Reject invalid settings: patterns for unwanted series names that are no regular expressions,
+        and numbers out of range
+        """
+        problems = self.invalid_settings()
+        if problems:
+            self.show_invalid_settings()
+            error_dialog(self, 'Invalid settings',
+                         'Some settings are not valid. Invalid patterns are not saved, the previous ones are kept. For invalid numbers the last valid value is saved.',
+                         det_msg='\n'.join(message for widget, message in problems),
+                         show=True, show_copy_button=False)
+            return False
+        return True
+
 
     def commit(self):
         """
         Save settings
+        Invalid settings are shown to the user by validate(). Invalid patterns for unwanted series names
+        are not saved, the previous ones are kept.
         """
         DefaultConfigWidget.commit(self)
         new_prefs = {}
@@ -152,6 +454,21 @@ class ConfigWidget(DefaultConfigWidget):
         new_prefs[KEY_APPEND_EDITION_TO_TITLE] = self.append_edition_to_title_checkbox.isChecked()
         new_prefs[KEY_FETCH_SUBJECTS] = self.fetch_subjects_radios_group.checkedId()
         new_prefs[KEY_SKIP_SERIES_STARTING_WITH_PUBLISHERS_NAME] = self.skipSeriesStartingWithPublishersName_checkbox.isChecked()
-        new_prefs[KEY_UNWANTED_SERIES_NAMES] = self.unwantedSeriesNames_textarea.toPlainText().split("\n")
+        if self.validate():
+            new_prefs[KEY_UNWANTED_SERIES_NAMES] = self.unwanted_series_names()
+        else:
+            new_prefs[KEY_UNWANTED_SERIES_NAMES] = plugin_prefs[STORE_NAME].get(
+                KEY_UNWANTED_SERIES_NAMES, DEFAULT_STORE_VALUES[KEY_UNWANTED_SERIES_NAMES])
+        new_prefs[KEY_PARALLEL_QUERIES] = self.parallel_queries_spinbox.value()
+        new_prefs[KEY_QUERY_CACHE_TTL] = self.query_cache_ttl_spinbox.value()
+        new_prefs[KEY_QUERY_CACHE_SIZE] = self.query_cache_size_spinbox.value()
+        new_prefs[KEY_COVER_CACHE_TTL] = self.cover_cache_ttl_spinbox.value()
+        new_prefs[KEY_COMMENTS_CACHE_TTL] = self.comments_cache_ttl_spinbox.value()
+        new_prefs[KEY_MAX_REQUESTS_PER_SECOND] = self.max_requests_per_second_spinbox.value()
+        new_prefs[KEY_PROBE_SELECTIVITY] = self.probe_selectivity_checkbox.isChecked()
+        new_prefs[KEY_OFFLINE_INDEX] = self.offline_index_lineedit.text().strip()
+        new_prefs[KEY_TRACE] = self.trace_checkbox.isChecked()
+        new_prefs[KEY_RECORD_CACHE_TTL] = self.record_cache_ttl_spinbox.value()
+        new_prefs[KEY_COVER_IMAGE_CACHE_SIZE] = self.cover_image_cache_size_spinbox.value()
 
         plugin_prefs[STORE_NAME] = new_prefs
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the "futures" backport: everything runs in the calling thread
+    ThreadPoolExecutor = None
+
+# Upper bound of worker threads shared by all plugin instances in this process
+MAX_WORKERS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class ImmediateResult(object):
+    """
+    Stand-in for a Future if no thread pool is available: runs the job right away
+    """
+    def __init__(self, fn, *args, **kwargs):
+        self._result = None
+        self._exception = None
+        try:
+            self._result = fn(*args, **kwargs)
+        except Exception as e:
+            self._exception = e
+
+    def result(self, timeout=None):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def done(self):
+        return True
+
+    def cancel(self):
+        return False
+
+
+def get_executor():
+    """
+    Get the thread pool shared by all plugin instances of this process
+    """
+    global _executor
+    if ThreadPoolExecutor is None:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run a job on the shared thread pool, return a Future
+    """
+    executor = get_executor()
+    if executor is None:
+        return ImmediateResult(fn, *args, **kwargs)
+    return executor.submit(fn, *args, **kwargs)
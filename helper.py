@@ -23,9 +23,10 @@ def clean_title(log, title):
     return title
 
 
-def clean_series(log, series, publisher_name, unwanted_regex):
+def clean_series(log, series, publisher_name, unwanted_series):
     """
     Clean up series
+    unwanted_series: UnwantedSeries matcher, or None
     """
     if series:
         # series must at least contain a single character
@@ -43,28 +44,89 @@ def clean_series(log, series, publisher_name, unwanted_regex):
                 return None
 
             # Skip series info if it starts with the first word of the publisher's name (which must be at least 4 characters long)
-            match = re.search(
-                r'^(\w\w\w\w+)', remove_sorting_characters(publisher_name))
+            match = PUBLISHER_FIRST_WORD.search(remove_sorting_characters(publisher_name))
             if match:
-                pubcompany = match.group(1)
-                if re.search(r'^\W*' + pubcompany, series, flags=re.IGNORECASE):
+                pubcompany = match.group(1).lower()
+                if series[LEADING_NON_WORD.match(series).end():].lower().startswith(pubcompany):
                     log.info("[Series Cleaning] Series %s starts with publisher, ignoring" % series)
                     return None
 
         # do not accept some other unwanted series names
-        # try...except, log errors!
-        if unwanted_regex:
-            for i in unwanted_regex:
-                try:
-                    if re.search(r'' + i, series, flags=re.IGNORECASE):
-                        log.info("[Series Cleaning] Series %s contains unwanted string %s, ignoring" % (series, i))
-                        return None
-                except:
-                    log.warn("[Series Cleaning] Regular expression %s caused an error, ignoring" % i)
-                    pass
+        if unwanted_series:
+            pattern = unwanted_series.search(series)
+            if pattern is not None:
+                log.info("[Series Cleaning] Series %s contains unwanted string %s, ignoring" % (series, pattern))
+                return None
     return series
 
 
+PUBLISHER_FIRST_WORD = re.compile(r'^(\w\w\w\w+)')
+LEADING_NON_WORD = re.compile(r'\W*')
+
+
+class UnwantedSeries(object):
+    """
+    Patterns of unwanted series names, compiled once into a single case-insensitive regular expression
+    Patterns with groups or inline flags can not be combined safely and are checked one by one.
+    Empty patterns are ignored, invalid ones are listed in "invalid" as (pattern, error message).
+    """
+    def __init__(self, patterns):
+        self.patterns = []
+        self.invalid = []
+        separate = []
+        combinable = []
+        for pattern in patterns:
+            if not pattern.strip():
+                continue
+            try:
+                compiled = re.compile(pattern, flags=re.IGNORECASE)
+            except re.error as e:
+                self.invalid.append((pattern, '%s' % e))
+                continue
+            self.patterns.append((pattern, compiled))
+            if compiled.groups or '(?' in pattern:
+                separate.append(compiled)
+            else:
+                combinable.append(pattern)
+
+        self.combined = None
+        if combinable:
+            self.combined = re.compile('|'.join('(?:%s)' % x for x in combinable), flags=re.IGNORECASE)
+        self.separate = separate
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    __nonzero__ = __bool__
+
+    def search(self, series):
+        """
+        Get the first pattern (in list order) matching a series, or None
+        """
+        if (self.combined is None or not self.combined.search(series)) and not any(x.search(series) for x in self.separate):
+            return None
+        # only for series to skip: find out which pattern it was, for the log
+        for pattern, compiled in self.patterns:
+            if compiled.search(series):
+                return pattern
+        return None
+
+
+_unwanted_series = {}
+
+def compile_unwanted_series(patterns):
+    """
+    Get the UnwantedSeries matcher for a list of patterns, compiled only if the list changed
+    """
+    key = tuple(patterns)
+    matcher = _unwanted_series.get(key)
+    if matcher is None:
+        matcher = UnwantedSeries(key)
+        _unwanted_series.clear()
+        _unwanted_series[key] = matcher
+    return matcher
+
+
 def uniq(list_with_duplicates):
     """
     Remove duplicates from a list
@@ -76,6 +138,18 @@ def uniq(list_with_duplicates):
     return unique_list
 
 
+def isbn_as_isbn13(isbn):
+    """
+    Convert an ISBN-10 to ISBN-13, other ISBNs are returned unchanged (without dashes)
+    """
+    isbn = isbn.replace('-', '').replace(' ', '').upper()
+    if len(isbn) != 10:
+        return isbn
+    isbn = '978' + isbn[:9]
+    checksum = sum(int(c) * (3 if i % 2 else 1) for i, c in enumerate(isbn))
+    return isbn + str((10 - checksum % 10) % 10)
+
+
 def iso639_2b_as_iso639_3(lang):
     """
     Convert ISO 639-2/B to ISO 639-3
@@ -121,108 +195,139 @@ def strip_german_joiners(wordlist):
     return tokens
 
 
+##### Series Guesser #####
+
+# Words marking the series index, as written in the rules below ("[B|b]and" also matches "|and", as it always did).
+# A rule can only match if its part of the title contains one of its words and a digit.
+SERIES_INDEX_WORDS = re.compile(r"#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Vol|Episode|Bd\.|[B|b]and|Part|Kapitel|[Tt]eil|Folge")
+
+# All words found by SERIES_INDEX_WORDS, except "Vol" and "Episode" on their own, which only 2P1 knows
+COMMON_SERIES_INDEX_WORDS = 'common'
+ALL_SERIES_INDEX_WORDS = frozenset((COMMON_SERIES_INDEX_WORDS, 'Vol', 'Episode'))
+
+DIGIT = re.compile(r"\d")
+TITLE_PARTS_SEPARATOR = re.compile("[:]")
+TEXTPART_TRIM = re.compile(r"^[\s\-–—:]*(.+?)[\s\-–—:]*$")
+SERIES_AND_TITLE = re.compile(r"^\s*(\w+.+?)\s?[\.;\-–:]+\s(\w+.+)\s*$")
+
+
+def series_from_indexpart_2p1(match, textpart):
+    # if indexparts looks like "Name of the series - Episode 2": extract series and series_index
+    guessed_series_index = match.group(2)
+    guessed_series = match.group(1)
+
+    # sometimes books with multiple volumes are detected as series without series name -> Add the volume to the title if no series was found
+    if not guessed_series:
+        return textpart + " : Band " + guessed_series_index, textpart, guessed_series_index
+    return textpart, guessed_series, guessed_series_index
+
+
+def series_from_indexpart_2p2(match, textpart):
+    # if indexpart looks like "Episode 2 Name of the series": extract series and series_index
+    guessed_series_index = match.group(1)
+    guessed_series = match.group(2)
+
+    # sometimes books with multiple volumes are detected as series without series name -> Add the volume to the title if no series was found
+    if not guessed_series:
+        return textpart + " : Band " + guessed_series_index, textpart, guessed_series_index
+    return textpart, guessed_series, guessed_series_index
+
+
+def series_from_textpart_2p3(match, textpart):
+    # if indexpart looks like "Band 2": extract series_index
+    # if textpart looks like "Name of the Series - Book Title": extract series and title
+    textmatch = SERIES_AND_TITLE.match(textpart)
+    if textmatch:
+        return textmatch.group(2), textmatch.group(1), match.group(1)
+    return None
+
+
+def series_from_title_1p1(match, textpart):
+    # if title looks like: "Name of the series - Title (Episode 2)"
+    return match.group(2), match.group(1), match.group(3)
+
+
+def series_from_title_1p2(match, textpart):
+    # if title looks like "Name of the series - Episode 2"
+    return match.group(1) + " : Band " + match.group(2), match.group(1), match.group(2)
+
+
+# Rules by number of title parts, tried in order: (name, pattern, words of SERIES_INDEX_WORDS it needs, result)
+# The first rule whose pattern matches decides, its result function returns (title, series, series_index) or None.
+SERIES_GUESSER_RULES = {
+    2: [
+        ('2P1', re.compile(r"^\s*(\S\D*?[a-zA-Z]\D*?)\W[\(\/\.,\s\-–—:]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?|Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$"),
+         ALL_SERIES_INDEX_WORDS, series_from_indexpart_2p1),
+        ('2P2', re.compile(r"^\s*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*(\S\D*?[a-zA-Z]\D*?)[\/\.,\-–—\s]*$"),
+         frozenset((COMMON_SERIES_INDEX_WORDS,)), series_from_indexpart_2p2),
+        ('2P3', re.compile(r"^[\s\(]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*[\/\.,\-–—\s]*$"),
+         frozenset((COMMON_SERIES_INDEX_WORDS,)), series_from_textpart_2p3),
+    ],
+    1: [
+        ('1P1', re.compile(r"^\s*(\S.+?) \- (\S.+?) [\(\/\.,\s\-–:](?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$"),
+         frozenset((COMMON_SERIES_INDEX_WORDS,)), series_from_title_1p1),
+        ('1P2', re.compile(r"^\s*(\S.+?)[\(\/\.,\s\-–—:]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$"),
+         frozenset((COMMON_SERIES_INDEX_WORDS,)), series_from_title_1p2),
+    ],
+}
+
+
+def series_index_words(text):
+    """
+    Get the kinds of words marking a series index in text, in a single pass
+    """
+    words = set()
+    for word in SERIES_INDEX_WORDS.findall(text):
+        words.add(word if word in ('Vol', 'Episode') else COMMON_SERIES_INDEX_WORDS)
+    return words
+
+
 def guess_series_from_title(log, title):
     """
     Try to extract Series and Series Index from a book's title
+    Every rule needs a digit and one of its words in the title, titles without them are rejected before any rule runs.
     """
-    guessed_series = None
-    guessed_series_index = None
-    guessed_title = None
-
-    parts = re.split("[:]", remove_sorting_characters(title))
+    parts = TITLE_PARTS_SEPARATOR.split(remove_sorting_characters(title))
 
     if len(parts) == 2:
         # make sure only one part of the two parts contains digits
-        if bool(re.search(r"\d", parts[0])) != bool(re.search(r"\d", parts[1])):
-
-            # call the part with the digits "indexpart" as it contains the series_index, the one without digits "textpart"
-            if bool(re.search(r"\d", parts[0])):
-                indexpart = parts[0]
-                textpart = parts[1]
-            else:
-                indexpart = parts[1]
-                textpart = parts[0]
-
-            # remove odd characters from start and end of the textpart
-            match = re.match(
-                r"^[\s\-–—:]*(.+?)[\s\-–—:]*$", textpart)
-            if match:
-                textpart = match.group(1)
+        if bool(DIGIT.search(parts[0])) == bool(DIGIT.search(parts[1])):
+            return None
 
-            # if indexparts looks like "Name of the series - Episode 2": extract series and series_index
-            match = re.match(
-                r"^\s*(\S\D*?[a-zA-Z]\D*?)\W[\(\/\.,\s\-–—:]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?|Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$", indexpart)
-            if match:
-                guessed_series_index = match.group(2)
-                guessed_series = match.group(1)
+        # call the part with the digits "indexpart" as it contains the series_index, the one without digits "textpart"
+        if DIGIT.search(parts[0]):
+            indexpart = parts[0]
+            textpart = parts[1]
+        else:
+            indexpart = parts[1]
+            textpart = parts[0]
 
-                # sometimes books with multiple volumes are detected as series without series name -> Add the volume to the title if no series was found
-                if not guessed_series:
-                    guessed_series = textpart
-                    guessed_title = textpart + " : Band " + guessed_series_index
-                else:
-                    guessed_title = textpart
+    elif len(parts) == 1:
+        indexpart = textpart = parts[0]
+        if not DIGIT.search(indexpart):
+            return None
 
-                log.info("[Series Guesser] 2P1 matched: Title: %s, Series: %s[%s]" % (guessed_title, guessed_series, guessed_series_index))
-                return guessed_title, guessed_series, guessed_series_index
+    else:
+        return None
 
-            else:
-                # if indexpart looks like "Episode 2 Name of the series": extract series and series_index
-                match = re.match(
-                    r"^\s*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*(\S\D*?[a-zA-Z]\D*?)[\/\.,\-–—\s]*$", indexpart)
-                if match:
-                    guessed_series_index = match.group(1)
-                    guessed_series = match.group(2)
-
-                    # sometimes books with multiple volumes are detected as series without series name -> Add the volume to the title if no series was found
-                    if not guessed_series:
-                        guessed_series = textpart
-                        guessed_title = textpart + " : Band " + guessed_series_index
-                    else:
-                        guessed_title = textpart
-
-                    log.info("[Series Guesser] 2P2 matched: Title: %s, Series: %s[%s]" % (guessed_title, guessed_series, guessed_series_index))
-                    return guessed_title, guessed_series, guessed_series_index
-
-                else:
-                    # if indexpart looks like "Band 2": extract series_index
-                    match = re.match(
-                        r"^[\s\(]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*[\/\.,\-–—\s]*$", indexpart)
-                    if match:
-                        guessed_series_index = match.group(1)
-
-                        # if textpart looks like "Name of the Series - Book Title": extract series and title
-                        match = re.match(
-                            r"^\s*(\w+.+?)\s?[\.;\-–:]+\s(\w+.+)\s*$", textpart)
-                        if match:
-                            guessed_series = match.group(1)
-                            guessed_title = match.group(2)
-
-                            log.info("[Series Guesser] 2P3 matched: Title: %s, Series: %s[%s]" % (guessed_title, guessed_series, guessed_series_index))
-                            return guessed_title, guessed_series, guessed_series_index
+    words = series_index_words(indexpart)
+    if not words:
+        return None
 
-    elif len(parts) == 1:
-        # if title looks like: "Name of the series - Title (Episode 2)"
-        match = re.match(
-            r"^\s*(\S.+?) \- (\S.+?) [\(\/\.,\s\-–:](?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–—:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$", parts[0])
+    if len(parts) == 2:
+        # remove odd characters from start and end of the textpart
+        match = TEXTPART_TRIM.match(textpart)
         if match:
-            guessed_series_index = match.group(3)
-            guessed_series = match.group(1)
-            guessed_title = match.group(2)
-
-            log.info("[Series Guesser] 1P1 matched: Title: %s, Series: %s[%s]" % (guessed_title, guessed_series, guessed_series_index))
-            return guessed_title, guessed_series, guessed_series_index
+            textpart = match.group(1)
 
-        else:
-            # if title looks like "Name of the series - Episode 2"
-            match = re.match(
-                r"^\s*(\S.+?)[\(\/\.,\s\-–—:]*(?:#|Reihe|Nr\.|Heft|Volume|Vol\.?Episode|Bd\.|Sammelband|[B|b]and|Part|Kapitel|[Tt]eil|Folge)[,\-–:\s#\(]*(\d+[\.,]?\d*)[\)\s\-–—:]*$", parts[0])
-            if match:
-                guessed_series_index = match.group(2)
-                guessed_series = match.group(1)
-                guessed_title = guessed_series + " : Band " + guessed_series_index
-
-                log.info("[Series Guesser] 1P2 matched: Title: %s, Series: %s[%s]" % (guessed_title, guessed_series, guessed_series_index))
-                return guessed_title, guessed_series, guessed_series_index
+    for name, pattern, needed_words, result in SERIES_GUESSER_RULES[len(parts)]:
+        if words.isdisjoint(needed_words):
+            continue
+        match = pattern.match(indexpart)
+        if match:
+            guessed = result(match, textpart)
+            if guessed:
+                log.info("[Series Guesser] %s matched: Title: %s, Series: %s[%s]" % (name, guessed[0], guessed[1], guessed[2]))
+            return guessed
 
     return None
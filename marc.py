@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+import unicodedata
+
+try:
+    # Python >= 3.8
+    from unicodedata import is_normalized
+except ImportError:
+    is_normalized = None
+
+DATAFIELD = '{http://www.loc.gov/MARC21/slim}datafield'
+SUBFIELD = '{http://www.loc.gov/MARC21/slim}subfield'
+
+
+def nfc(text):
+    """
+    Normalize text to NFC (composed characters), as calibre's normalize() does
+    Most texts are plain ASCII or NFC already, they are returned as they are.
+    """
+    try:
+        if text.isascii():
+            return text
+    except AttributeError:
+        # Python < 3.7, or a byte string: lxml returns plain ASCII texts as such on Python 2
+        if not isinstance(text, type('')):
+            return text
+    if is_normalized is not None and is_normalized('NFC', text):
+        return text
+    return unicodedata.normalize('NFC', text)
+
+
+class MarcRecord(object):
+    """
+    Data fields of a MARC21 record, read in a single pass over its XML
+    Each field is a dict mapping subfield codes to the list of their texts, stripped and normalized to NFC.
+    Empty subfields are left out. The XML element is not referenced afterwards.
+    """
+    __slots__ = ('_fields',)
+
+    def __init__(self, element):
+        fields = {}
+        for datafield in element.iterchildren(DATAFIELD):
+            subfields = {}
+            for subfield in datafield.iterchildren(SUBFIELD):
+                text = subfield.text
+                if text:
+                    subfields.setdefault(subfield.get('code'), []).append(nfc(text.strip()))
+            fields.setdefault(datafield.get('tag'), []).append(subfields)
+        self._fields = fields
+
+    def fields(self, tag):
+        """
+        Get all fields with a tag
+        """
+        return self._fields.get(tag, [])
+
+    def values(self, tag, code):
+        """
+        Get texts of all subfields "code" of all fields with a tag
+        """
+        values = []
+        for field in self._fields.get(tag, []):
+            values.extend(field.get(code, []))
+        return values
+
+    def value(self, tag, code):
+        """
+        Get text of the first subfield "code" of the fields with a tag, or None
+        """
+        for field in self._fields.get(tag, []):
+            if code in field:
+                return field[code][0]
+        return None
+
+    def tags(self, first, last):
+        """
+        Get the tags between first and last (inclusive) the record has, in order
+        """
+        return sorted(t for t in self._fields if first <= t <= last)
@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+import ssl
+import time
+import zlib
+import socket
+import threading
+from io import BytesIO
+
+try:
+    # Python 2
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit, urljoin
+except ImportError:
+    # Python3
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit, urljoin
+
+
+class HTTPError(Exception):
+    """
+    Server answered with an error status
+    """
+    def __init__(self, url, code, reason, response=None):
+        Exception.__init__(self, 'HTTP Error %s: %s (%s)' % (code, reason, url))
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.response = response
+
+
+class Response(object):
+    """
+    Completely read response of a server
+    """
+    def __init__(self, url, status, reason, headers, data):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        # header names in lower case
+        self.headers = headers
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class StreamingResponse(object):
+    """
+    Response of a server whose body is read by the caller, see HTTPClient.open()
+    The connection goes back to the pool once the body was read completely, close() drops it before.
+    """
+
+    # bytes read at once by read() without size
+    CHUNK_SIZE = 65536
+
+    def __init__(self, url, status, reason, headers, resp, gzipped, release):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        # header names in lower case
+        self.headers = headers
+        # the whole body once it was read, if asked for with keep_data()
+        self.data = None
+
+        self._resp = resp
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        self._release = release
+        self._buffer = None
+        self._chunks = None
+        self._callbacks = []
+
+    def keep_data(self, callback=None):
+        """
+        Keep a copy of the body in "data", callback(response) is called once it was read completely
+        """
+        if self._chunks is None and self.data is None:
+            self._chunks = []
+        if callback is not None:
+            self._callbacks.append(callback)
+
+    def buffer(self):
+        """
+        Read the whole body right away and give the connection back, read() hands it out from memory then
+        """
+        if self._buffer is None:
+            self._buffer = BytesIO(self.read())
+
+    def read(self, size=-1):
+        if self._buffer is not None:
+            return self._buffer.read(size)
+
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(self.CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+
+        while self._resp is not None:
+            try:
+                raw = self._resp.read(size)
+            except:
+                self.close()
+                raise
+            if raw:
+                chunk = self._decompressor.decompress(raw) if self._decompressor else raw
+            else:
+                chunk = self._decompressor.flush() if self._decompressor else b''
+            if chunk and self._chunks is not None:
+                self._chunks.append(chunk)
+            if not raw:
+                self._finish()
+            if chunk:
+                return chunk
+        return b''
+
+    def _finish(self):
+        """
+        The body was read completely
+        """
+        self._resp = None
+        self._release(True)
+        if self._chunks is not None:
+            self.data = b''.join(self._chunks)
+            self._chunks = None
+        for callback in self._callbacks:
+            callback(self)
+
+    def close(self):
+        """
+        Stop reading, the connection is closed if the body was not read completely
+        """
+        if self._resp is not None:
+            resp, self._resp = self._resp, None
+            resp.close()
+            self._release(False)
+
+
+class PooledHTTPSConnection(HTTPSConnection):
+    """
+    HTTPS connection that resumes the TLS session of the previous connection to the same host
+    """
+    def __init__(self, host, port=None, pool=None, **kwargs):
+        HTTPSConnection.__init__(self, host, port, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        # plain TCP connection (and proxy tunnel), TLS is added below
+        HTTPConnection.connect(self)
+
+        server_hostname = self._tunnel_host or self.host
+        session = self.pool.tls_session if self.pool else None
+        try:
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=session)
+        except TypeError:
+            # Python < 3.6 does not know about TLS sessions
+            self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname)
+
+
+class RateLimiter(object):
+    """
+    Token bucket plus concurrency limit for a single host
+    Both limits adapt to the server's health: they are halved on slow or failed responses
+    and raised step by step again while responses are healthy (AIMD).
+    """
+
+    MIN_RATE = 0.5
+    # responses taking longer than this (seconds) count as a sign of overload
+    SLOW_RESPONSE = 5.0
+    # back off at most once in this many seconds, responses already underway would halve the limits again
+    BACKOFF_INTERVAL = 2.0
+
+    def __init__(self, max_rate, max_concurrency):
+        self.max_rate = float(max_rate)
+        self.max_concurrency = max_concurrency
+        self.rate = self.max_rate
+        self.concurrency = float(max_concurrency)
+
+        self.tokens = max(1.0, self.rate)
+        self.updated = time.time()
+        self.active = 0
+        self.last_backoff = 0
+
+        self._condition = threading.Condition()
+
+    def configure(self, max_rate):
+        with self._condition:
+            self.max_rate = float(max_rate)
+            self.rate = min(self.rate, self.max_rate)
+
+    def refill(self, now):
+        # the bucket holds at most one second worth of tokens
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout):
+        """
+        Wait until a request may be sent
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                now = time.time()
+                self.refill(now)
+                if self.active < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise socket.timeout('Request rate limit reached')
+                if self.tokens < 1:
+                    remaining = min(remaining, (1 - self.tokens) / self.rate)
+                self._condition.wait(remaining)
+
+    def release(self, latency, healthy):
+        """
+        Request finished: adapt limits to the response
+        """
+        with self._condition:
+            self.active -= 1
+            if healthy and latency < self.SLOW_RESPONSE:
+                self.rate = min(self.max_rate, self.rate + 0.5)
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            else:
+                self.backoff()
+            self._condition.notify_all()
+
+    def backoff(self):
+        now = time.time()
+        if now - self.last_backoff > self.BACKOFF_INTERVAL:
+            self.rate = max(self.MIN_RATE, self.rate / 2)
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.last_backoff = now
+
+    def report_problem(self):
+        """
+        A response looked fine on the HTTP level, but its content shows the server is in trouble
+        """
+        with self._condition:
+            self.backoff()
+
+    def limits(self):
+        with self._condition:
+            return {'rate': round(self.rate, 2), 'concurrency': int(self.concurrency), 'active': self.active}
+
+
+class HostPool(object):
+    """
+    Persistent connections to a single host, limited to "max_connections" sockets
+    """
+
+    # connections idle for longer than this are closed by the DNB servers anyway
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, scheme, host, port, max_connections, ssl_context, proxy=None):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.ssl_context = ssl_context
+        self.proxy = proxy
+        self.tls_session = None
+
+        self._idle = []
+        self._active = 0
+        self._condition = threading.Condition()
+
+    def new_connection(self, timeout):
+        if self.proxy:
+            proxy_host, proxy_port = self.proxy
+        else:
+            proxy_host, proxy_port = self.host, self.port
+
+        if self.scheme == 'https':
+            conn = PooledHTTPSConnection(proxy_host, proxy_port, pool=self, timeout=timeout, context=self.ssl_context)
+        else:
+            conn = HTTPConnection(proxy_host, proxy_port, timeout=timeout)
+
+        if self.proxy and self.scheme == 'https':
+            conn.set_tunnel(self.host, self.port)
+        return conn
+
+    def acquire(self, timeout):
+        """
+        Get an idle connection, or a new one if less than max_connections are in use
+        Returns (connection, reused)
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self._active >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('No free connection to %s' % self.host)
+                self._condition.wait(remaining)
+            self._active += 1
+
+            now = time.time()
+            while self._idle:
+                conn, since = self._idle.pop()
+                if now - since < self.IDLE_TIMEOUT:
+                    return conn, True
+                conn.close()
+
+        return self.new_connection(timeout), False
+
+    def release(self, conn, reusable):
+        """
+        Put a connection back into the pool, or close it
+        """
+        sock = getattr(conn, 'sock', None)
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self.tls_session = session
+
+        with self._condition:
+            self._active -= 1
+            if reusable and sock is not None:
+                self._idle.append((conn, time.time()))
+            else:
+                conn.close()
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            for conn, since in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class HTTPClient(object):
+    """
+    HTTP client with keep-alive connection pools per host, gzip and TLS session reuse
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, user_agent=None, verify_ssl_certificates=True, max_connections_per_host=4, max_requests_per_second=10, proxies=None):
+        self.user_agent = user_agent
+        self.max_connections_per_host = max_connections_per_host
+        self.max_requests_per_second = max_requests_per_second
+        self.proxies = proxies or {}
+
+        if verify_ssl_certificates:
+            self.ssl_context = ssl.create_default_context()
+        else:
+            self.ssl_context = ssl._create_unverified_context()
+
+        # records all responses, see replay.Recorder
+        self.recorder = None
+
+        self._pools = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, scheme, host, port):
+        """
+        Get connection pool for a host
+        """
+        with self._lock:
+            pool = self._pools.get((scheme, host, port))
+            if pool is None:
+                pool = HostPool(scheme, host, port, self.max_connections_per_host, self.ssl_context, self.get_proxy(scheme))
+                self._pools[(scheme, host, port)] = pool
+        return pool
+
+    def get_limiter(self, host):
+        """
+        Get rate limiter for a host
+        """
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = RateLimiter(self.max_requests_per_second, self.max_connections_per_host)
+                self._limiters[host] = limiter
+        return limiter
+
+    def set_max_requests_per_second(self, max_requests_per_second):
+        with self._lock:
+            self.max_requests_per_second = max_requests_per_second
+            limiters = list(self._limiters.values())
+        for limiter in limiters:
+            limiter.configure(max_requests_per_second)
+
+    def report_problem(self, url):
+        """
+        Tell the rate limiter that the server had trouble answering a request to url
+        """
+        self.get_limiter(urlsplit(url).hostname).report_problem()
+
+    def get_limits(self):
+        """
+        Get current limits of all hosts: {host: {'rate': ..., 'concurrency': ..., 'active': ...}}
+        """
+        with self._lock:
+            limiters = list(self._limiters.items())
+        return dict((host, limiter.limits()) for host, limiter in limiters)
+
+    def get_proxy(self, scheme):
+        """
+        Get (host, port) of the proxy to use for scheme, if any
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy:
+            return None
+        parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        return parts.hostname, parts.port or 80
+
+    def request(self, method, url, headers=None, timeout=30, stream=False):
+        """
+        Send request, follow redirects, return Response (StreamingResponse with "stream")
+        Raises HTTPError if the server answers with an error status
+        """
+        requested_url = url
+        for i in range(self.MAX_REDIRECTS + 1):
+            response = self.send(method, url, headers, timeout, stream)
+            location = response.headers.get('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                # read the (short) body, so the connection can be used again
+                response.read()
+                response.close()
+                url = urljoin(url, location)
+                continue
+            if stream and response.status >= 400:
+                # error pages are read completely
+                response = Response(response.url, response.status, response.reason, response.headers, response.read())
+            if self.recorder and not headers:
+                # conditional requests would record a "304 Not modified"
+                if isinstance(response, StreamingResponse):
+                    recorder = self.recorder
+                    response.keep_data(lambda r: recorder.record(method, requested_url, r))
+                else:
+                    self.recorder.record(method, requested_url, response)
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason, response)
+            return response
+        raise HTTPError(url, response.status, 'Too many redirects', response)
+
+    def get(self, url, headers=None, timeout=30):
+        return self.request('GET', url, headers, timeout)
+
+    def open(self, url, headers=None, timeout=30):
+        """
+        Send GET request, return StreamingResponse: the body is read from the connection while the caller reads it
+        The rate limiter only sees the time to the response's head. Close the response if it is not read completely.
+        """
+        return self.request('GET', url, headers, timeout, stream=True)
+
+    def head(self, url, headers=None, timeout=30):
+        return self.request('HEAD', url, headers, timeout)
+
+    def send(self, method, url, headers, timeout, stream=False):
+        """
+        Send a single request over a pooled connection
+        With "stream" the body is not read, the connection stays in use until the returned StreamingResponse is read or closed.
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        pool = self.get_pool(scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        if pool.proxy and scheme == 'http':
+            # plain HTTP proxies want the absolute URL
+            path = url
+
+        request_headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        if self.user_agent:
+            request_headers['User-Agent'] = self.user_agent
+        if headers:
+            request_headers.update(headers)
+
+        limiter = self.get_limiter(parts.hostname)
+        limiter.acquire(timeout)
+        start = time.time()
+        try:
+            while True:
+                conn, reused = pool.acquire(timeout)
+                try:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    conn.request(method, path, headers=request_headers)
+                    resp = conn.getresponse()
+                    data = None if stream else resp.read()
+                except (HTTPException, socket.error) as e:
+                    pool.release(conn, False)
+                    # the server may have closed an idle connection in the meantime: retry with a new connection
+                    if reused and not isinstance(e, socket.timeout):
+                        continue
+                    raise
+                except:
+                    pool.release(conn, False)
+                    raise
+                if not stream:
+                    pool.release(conn, not resp.will_close)
+                break
+        except:
+            limiter.release(time.time() - start, False)
+            raise
+        limiter.release(time.time() - start, resp.status < 500 and resp.status != 429)
+
+        response_headers = dict((k.lower(), v) for k, v in resp.getheaders())
+        gzipped = response_headers.get('content-encoding', '').lower() == 'gzip'
+        if stream:
+            return StreamingResponse(url, resp.status, resp.reason, response_headers, resp, gzipped,
+                                     lambda reusable: pool.release(conn, reusable and not resp.will_close))
+        if data and gzipped:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return Response(url, resp.status, resp.reason, response_headers, data)
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(**kwargs):
+    """
+    Get the HTTP client shared by all plugin instances of this process
+    Arguments are only used when the client is created.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient(**kwargs)
+    return _client
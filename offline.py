@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Offline index of DNB records, built from the MARC21-xml bulk dumps DNB publishes.
+#
+# Build it with:
+#   calibre-debug -e offline.py -- import <dump.xml or dump.xml.gz> [<dump> ...] <index.sqlite>
+# and set its path in the plugin's configuration. SRU queries are then answered from the
+# index, in the same format the DNB server uses.
+
+import re
+import sys
+import gzip
+import zlib
+import sqlite3
+import threading
+import unicodedata
+
+from lxml import etree
+
+try:
+    from calibre_plugins.DNB_DE.helper import isbn_as_isbn13
+    from calibre_plugins.DNB_DE.marc import MarcRecord
+except ImportError:
+    # run as a script
+    from helper import isbn_as_isbn13
+    from marc import MarcRecord
+
+from xml.sax.saxutils import escape
+
+
+MARC21 = '{http://www.loc.gov/MARC21/slim}'
+
+# SRU indexes -> columns of the full text index, None: any column
+INDEXES = {
+    'tit': 'tit',
+    'tst': 'tit',
+    'per': 'per',
+    'vlg': 'pub',
+    'sw': 'sub',
+    'num': 'num',
+    '': None,
+}
+
+# material and code filters: records of these kinds are not imported at all
+IGNORED_INDEXES = ('mat', 'cod')
+
+# fields (tag, subfield codes) going into each column
+COLUMNS = (
+    ('tit', (('245', 'abnp'), ('246', 'abnp'), ('490', 'a'))),
+    ('per', (('100', 'a'), ('110', 'a'), ('700', 'a'), ('710', 'a'))),
+    ('pub', (('260', 'b'), ('264', 'b'))),
+    ('sub', (('600', 'a'), ('650', 'a'), ('653', 'a'), ('689', 'a'))),
+    ('num', (('016', 'a'), ('020', 'a'), ('024', 'a'))),
+)
+
+
+class QueryError(ValueError):
+    """
+    SRU query the offline index can not answer
+    """
+
+
+class OfflineIndex(object):
+    """
+    SQLite FTS5 index of MARC21 records
+    """
+
+    # records written per transaction during import
+    BATCH_SIZE = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, idn TEXT UNIQUE, xml BLOB)')
+        try:
+            conn.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(tit, per, pub, sub, num, '
+                'content="", tokenize="unicode61 remove_diacritics 2")')
+        except sqlite3.OperationalError as e:
+            raise RuntimeError('SQLite of this Python has no FTS5 support: %s' % e)
+
+    def _connection(self):
+        """
+        Get this thread's connection to the database
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            self._local.conn = conn
+        return conn
+
+    ##### Import #####
+
+    def import_dump(self, source, log=print):
+        """
+        Add all records of a MARC21-xml dump (file name or file object, may be gzip compressed) to the index
+        The dump is streamed, memory use does not depend on its size. Returns the number of imported records.
+        """
+        if not hasattr(source, 'read'):
+            source = gzip.open(source, 'rb') if source.endswith('.gz') else open(source, 'rb')
+
+        conn = self._connection()
+        count = 0
+        batch = []
+        for event, record in etree.iterparse(source, events=('end',), tag=MARC21 + 'record'):
+            entry = self.index_entry(record)
+            if entry:
+                batch.append(entry)
+
+            # the record is done, free it and the ones before
+            record.clear()
+            while record.getprevious() is not None:
+                del record.getparent()[0]
+
+            if len(batch) >= self.BATCH_SIZE:
+                count += self.write_batch(conn, batch)
+                batch = []
+                log('Imported %s records' % count)
+
+        if batch:
+            count += self.write_batch(conn, batch)
+        log('Imported %s records' % count)
+        return count
+
+    def index_entry(self, record):
+        """
+        Get (IDN, compressed XML, column values) of a record, or None if it is not to be imported
+        """
+        marc = MarcRecord(record)
+
+        idn = marc.value('016', 'a')
+        if not idn:
+            return None
+
+        # audio books, audio, video and microfiches are never wanted, see the NOT clause of the plugin's queries
+        if [x for x in marc.values('336', 'a') if x.lower() == 'gesprochenes wort']:
+            return None
+        if [x for x in marc.values('337', 'a') if x.lower() in ('audio', 'video', 'mikroform')]:
+            return None
+
+        values = []
+        for column, sources in COLUMNS:
+            words = []
+            for tag, codes in sources:
+                for code in codes:
+                    words.extend(marc.values(tag, code))
+            if column == 'num':
+                # ISBNs without dashes, in both forms
+                for isbn in marc.values('020', 'a'):
+                    isbn = isbn.split(' ')[0].replace('-', '')
+                    words.extend([isbn, isbn_as_isbn13(isbn)])
+            values.append(unicodedata.normalize('NFC', ' '.join(words)))
+
+        xml = etree.tostring(record, encoding='utf-8', with_tail=False)
+        return idn, sqlite3.Binary(zlib.compress(xml)), values
+
+    def write_batch(self, conn, batch):
+        with conn:
+            for idn, xml, values in batch:
+                row = conn.execute('SELECT id FROM records WHERE idn = ?', (idn,)).fetchone()
+                if row:
+                    # newer version of a record: replace it (contentless FTS tables need the old values for that)
+                    old = conn.execute('SELECT xml FROM records WHERE id = ?', (row[0],)).fetchone()[0]
+                    old_values = self.index_entry(etree.XML(zlib.decompress(bytes(old))))[2]
+                    conn.execute('INSERT INTO search (search, rowid, tit, per, pub, sub, num) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 ['delete', row[0]] + old_values)
+                    conn.execute('UPDATE records SET xml = ? WHERE id = ?', (xml, row[0]))
+                    rowid = row[0]
+                else:
+                    rowid = conn.execute('INSERT INTO records (idn, xml) VALUES (?, ?)', (idn, xml)).lastrowid
+                conn.execute('INSERT INTO search (rowid, tit, per, pub, sub, num) VALUES (?, ?, ?, ?, ?, ?)',
+                             [rowid] + values)
+        return len(batch)
+
+    ##### Search #####
+
+    def search(self, query, maximum_records, start_record=1):
+        """
+        Run an SRU query, return (number of records, list of records as XML bytes)
+        Raises QueryError if the query can not be answered from the index.
+        """
+        match = translate_query(query)
+        conn = self._connection()
+        num = conn.execute('SELECT COUNT(*) FROM search WHERE search MATCH ?', (match,)).fetchone()[0]
+        if not maximum_records or not num:
+            return num, []
+
+        rows = conn.execute(
+            'SELECT records.xml FROM search JOIN records ON records.id = search.rowid '
+            'WHERE search MATCH ? ORDER BY search.rank, search.rowid LIMIT ? OFFSET ?',
+            (match, maximum_records, start_record - 1)).fetchall()
+        return num, [zlib.decompress(bytes(row[0])) for row in rows]
+
+    def sru_response(self, query, maximum_records, start_record=1):
+        """
+        Answer an SRU query like the DNB SRU service does, return the response as bytes
+        """
+        try:
+            num, records = self.search(query, maximum_records, start_record)
+        except QueryError as e:
+            return (
+                '<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/"><version>1.1</version>'
+                '<diagnostics><diag:diagnostic xmlns:diag="http://www.loc.gov/zing/srw/diagnostic/">'
+                '<diag:uri>info:srw/diagnostic/1/10</diag:uri><diag:details>%s</diag:details>'
+                '<diag:message>Query not supported by offline index</diag:message>'
+                '</diag:diagnostic></diagnostics></searchRetrieveResponse>' % escape(str(e))).encode('utf-8')
+
+        parts = [b'<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/"><version>1.1</version>',
+                 ('<numberOfRecords>%s</numberOfRecords><records>' % num).encode('utf-8')]
+        for position, xml in enumerate(records, start_record):
+            parts.extend([b'<record><recordSchema>MARC21-xml</recordSchema><recordPacking>xml</recordPacking><recordData>',
+                          xml, ('</recordData><recordPosition>%s</recordPosition></record>' % position).encode('utf-8')])
+        parts.append(b'</records>')
+        if records and start_record + len(records) <= num:
+            parts.append(('<nextRecordPosition>%s</nextRecordPosition>' % (start_record + len(records))).encode('utf-8'))
+        parts.append(b'</searchRetrieveResponse>')
+        return b''.join(parts)
+
+
+##### Query translation #####
+
+# tokens of the CQL subset used by the plugin: parentheses, boolean operators, index=value and bare values
+QUERY_TOKEN = re.compile(r'\s*(?:(\()|(\))|(AND|OR|NOT)(?=[\s(])|(?:(\w+)\s*=\s*)?("[^"]*"|[^\s()"]+))', re.UNICODE)
+
+
+def tokenize_query(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = QUERY_TOKEN.match(query, pos)
+        if not match or match.end() == pos:
+            raise QueryError('Can not parse query at "%s"' % query[pos:])
+        pos = match.end()
+        if match.group(1):
+            tokens.append(('(', None))
+        elif match.group(2):
+            tokens.append((')', None))
+        elif match.group(3):
+            tokens.append(('op', match.group(3)))
+        else:
+            tokens.append(('term', ((match.group(4) or '').lower(), match.group(5).strip('"'))))
+    return tokens
+
+
+def describe_token(token):
+    kind, value = token
+    if kind == 'term':
+        return '%s=%s' % value if value[0] else value[1]
+    return value or kind
+
+
+def translate_query(query):
+    """
+    Translate an SRU (CQL) query into an FTS5 MATCH expression
+    Boolean operators in CQL have no precedence, they are applied from left to right.
+    """
+    tokens = tokenize_query(query)
+    expression, pos = parse_expression(tokens, 0)
+    if pos != len(tokens):
+        raise QueryError('Unexpected "%s" in query' % describe_token(tokens[pos]))
+    if expression is None:
+        raise QueryError('Query has no search terms')
+    return expression
+
+
+def parse_expression(tokens, pos):
+    left, pos = parse_term(tokens, pos)
+    while pos < len(tokens) and tokens[pos][0] == 'op':
+        op = tokens[pos][1]
+        right, pos = parse_term(tokens, pos + 1)
+        if right is None:
+            continue
+        if left is None:
+            if op == 'NOT':
+                raise QueryError('Query starts with NOT')
+            left = right
+            continue
+        left = '(%s) %s (%s)' % (left, op, right)
+    return left, pos
+
+
+def parse_term(tokens, pos):
+    if pos >= len(tokens):
+        raise QueryError('Query ends unexpectedly')
+    kind, value = tokens[pos]
+    if kind == '(':
+        expression, pos = parse_expression(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos][0] != ')':
+            raise QueryError('Missing ")" in query')
+        return expression, pos + 1
+    if kind != 'term':
+        raise QueryError('Unexpected "%s" in query' % describe_token(tokens[pos]))
+
+    index, text = value
+    if index in IGNORED_INDEXES:
+        return None, pos + 1
+    if index not in INDEXES:
+        raise QueryError('Index "%s" is not supported' % index)
+
+    words = re.findall(r'\w+', unicodedata.normalize('NFC', text), re.UNICODE)
+    if not words:
+        return None, pos + 1
+    # all words, in any order
+    phrase = ' AND '.join('"%s"' % w for w in words)
+    column = INDEXES[index]
+    if column:
+        return '%s : (%s)' % (column, phrase), pos + 1
+    return '(%s)' % phrase, pos + 1
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def open_index(path):
+    """
+    Get the process wide offline index stored at path
+    """
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = OfflineIndex(path)
+            _indexes[path] = index
+    return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[1] != 'import':
+        print('Usage: %s import <MARC21-xml dump> [<dump> ...] <index file>' % sys.argv[0])
+        sys.exit(1)
+
+    index = OfflineIndex(sys.argv[-1])
+    for dump in sys.argv[2:-1]:
+        print('Importing %s' % dump)
+        index.import_dump(dump)
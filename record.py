@@ -0,0 +1,688 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+import re
+import datetime
+
+from calibre.utils.localization import lang_as_iso639_1
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.utils.date import is_date_undefined
+
+from calibre_plugins.DNB_DE.helper import clean_series, remove_sorting_characters, clean_title, iso639_2b_as_iso639_3, guess_series_from_title
+from calibre_plugins.DNB_DE.tracing import span
+
+
+# fields of Metadata objects kept in the record cache, besides title, authors, pubdate and identifiers
+CACHED_FIELDS = ('author_sort', 'title_sort', 'language', 'languages', 'publisher', 'series', 'series_index',
+                 'comments', 'tags', 'isbn', 'has_cover')
+
+
+def metadata_as_json(mi):
+    """
+    Get the fields of a Metadata object created by parse_record() as dict that JSON can encode
+    """
+    data = dict((field, getattr(mi, field)) for field in CACHED_FIELDS)
+    data['title'] = mi.title
+    data['authors'] = mi.authors
+    data['pubdate'] = None if mi.pubdate is None or is_date_undefined(mi.pubdate) else list(mi.pubdate.timetuple())[:6]
+    data['identifiers'] = mi.get_identifiers()
+    return data
+
+
+def metadata_from_json(data):
+    """
+    Create a new Metadata object from the output of metadata_as_json()
+    """
+    mi = Metadata(data['title'], list(data['authors']))
+    for field in CACHED_FIELDS:
+        value = data[field]
+        setattr(mi, field, list(value) if isinstance(value, list) else value)
+    if data['pubdate']:
+        mi.pubdate = datetime.datetime(*data['pubdate'])
+    mi.set_identifiers(data['identifiers'])
+    return mi
+
+
+class Alternate(object):
+    """
+    What is used of another issue of a book (field 776): its IDN, ISBN and URL of comments
+    """
+    __slots__ = ('idn', 'isbn', 'comments_url')
+
+    def __init__(self, idn, isbn, comments_url):
+        self.idn = idn
+        self.isbn = isbn
+        self.comments_url = comments_url
+
+
+class DNBRecord(object):
+    """
+    Book data of a DNB record
+    Groups of fields are extracted from the MarcRecord the first time one of them is read,
+    fields that are never read are never extracted. The MarcRecord is dropped once all groups
+    the settings need are done, groups of ignored fields do not count.
+    plugin: the DNB_DE plugin, for its settings
+    alternatives: Alternate objects of the other issues of the book
+    """
+    __slots__ = ('log', 'plugin', 'marc', 'idn', 'isbn', 'alternatives', 'needed',
+                 '_publication', '_titles', '_authors', '_urn', '_ddc', '_subjects_gnd', '_subjects_non_gnd', '_edition', '_languages')
+
+    GROUPS = ('_publication', '_titles', '_authors', '_urn', '_ddc', '_subjects_gnd', '_subjects_non_gnd', '_edition', '_languages')
+
+    def __init__(self, log, marc, plugin, alternatives):
+        self.log = log
+        self.plugin = plugin
+        self.marc = marc
+        self.alternatives = alternatives
+        for group in self.GROUPS:
+            setattr(self, group, None)
+        self.needed = self.needed_groups(plugin)
+
+        ##### Field 16: "National Bibliographic Agency Control Number" #####
+        # Get Identifier "IDN" (dnb-idn)
+        self.idn = plugin.get_idn(marc)
+        if self.idn:
+            log.info("[016.a] Identifier IDN: %s" % self.idn)
+
+        ##### Field 20: "International Standard Book Number" #####
+        # Get Identifier "ISBN"
+        self.isbn = plugin.get_isbn(marc)
+        if self.isbn:
+            log.info("[020.a] Identifier ISBN: %s" % self.isbn)
+
+    @staticmethod
+    def needed_groups(plugin):
+        """
+        Get the groups of fields that may be read with the plugin's settings
+        """
+        wanted = plugin.wanted
+        needed = ['_titles', '_authors']
+        # the publisher's name is also needed to clean up series
+        if wanted('publisher') or wanted('pubdate') or plugin.cfg_skip_series_starting_with_publishers_name:
+            needed.append('_publication')
+        if wanted('identifier:urn'):
+            needed.append('_urn')
+        if wanted('identifier:ddc'):
+            needed.append('_ddc')
+        if wanted('tags') and plugin.cfg_fetch_subjects in (0, 1, 2, 3):
+            needed.append('_subjects_gnd')
+        if wanted('tags') and plugin.cfg_fetch_subjects in (1, 2, 3, 4):
+            needed.append('_subjects_non_gnd')
+        if plugin.cfg_append_edition_to_title:
+            needed.append('_edition')
+        if wanted('languages'):
+            needed.append('_languages')
+        return needed
+
+    def done(self, group, value):
+        """
+        Store the values of a group of fields, drop the MarcRecord when it is not needed anymore
+        """
+        setattr(self, group, value)
+        if all(getattr(self, x) is not None for x in self.needed):
+            self.marc = None
+        return value
+
+    def release(self):
+        """
+        Drop the MarcRecord when no more fields are going to be read
+        """
+        self.marc = None
+
+    ##### Publication #####
+
+    @property
+    def publisher_name(self):
+        return (self._publication or self.extract_publication())[0]
+
+    @property
+    def publisher_location(self):
+        return (self._publication or self.extract_publication())[1]
+
+    @property
+    def pubdate(self):
+        return (self._publication or self.extract_publication())[2]
+
+    def extract_publication(self):
+        ##### Field 264: "Production, Publication, Distribution, Manufacture, and Copyright Notice" #####
+        # Get Publisher Name, Publishing Location, Publishing Date
+        # Subfields:
+        # a: publishing location
+        # b: publisher name
+        # c: publishing date
+        log = self.log
+        publisher_name = None
+        publisher_location = None
+        pubdate = None
+        with span(log, 'field 264'):
+            for field in self.marc.fields('264'):
+                if publisher_name and publisher_location and pubdate:
+                    break
+
+                if not publisher_location:
+                    location_parts = field.get('a', [])
+                    if location_parts:
+                        publisher_location = ' '.join(location_parts).strip('[]')
+
+                if not publisher_name:
+                    try:
+                        publisher_name = field['b'][0]
+                        log.info("[264.b] Publisher: %s" % publisher_name)
+                    except KeyError:
+                        pass
+
+                if not pubdate:
+                    try:
+                        date = [x for x in field.get('c', []) if len(x) >= 4][0]
+                        match = re.search(r"(\d{4})", date)
+                        year = match.group(1)
+                        pubdate = datetime.datetime(int(year), 1, 1, 12, 30, 0)
+                        log.info("[264.c] Publication Year: %s" % pubdate)
+                    except (IndexError, AttributeError):
+                        pass
+
+        return self.done('_publication', (publisher_name, publisher_location, pubdate))
+
+    ##### Title and Series #####
+
+    @property
+    def title(self):
+        return (self._titles or self.extract_titles())[0]
+
+    @property
+    def title_sort(self):
+        return (self._titles or self.extract_titles())[1]
+
+    @property
+    def series(self):
+        return (self._titles or self.extract_titles())[2]
+
+    @property
+    def series_index(self):
+        return (self._titles or self.extract_titles())[3]
+
+    def clean_series(self, series):
+        plugin = self.plugin
+        return clean_series(self.log, series,
+                            self.publisher_name if plugin.cfg_skip_series_starting_with_publishers_name else None,
+                            plugin.unwanted_series)
+
+    def extract_titles(self):
+        """
+        Title, Title_Sort, Series and Series_Index, they depend on each other
+        """
+        log = self.log
+        marc = self.marc
+        book_series = None
+        book_series_index = None
+        title_sort = None
+
+        ##### Field 245: "Title Statement" #####
+        # Get Title, Series, Series_Index, Subtitle
+        # Subfields: a: title, b: subtitle 1, n: number of part, p: name of part
+        # See: https://www.loc.gov/marc/bibliographic/bd245.html
+
+        # Examples:
+        # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime", n[2] = 4, p[2] = "The Return of Foobar"	Example: dnb-id 1008774839
+        # ->	Title:		"The Return Of Foobar"
+        #	Series:		"The Endless Book 2 - Second Season 3 - Summertime"
+        #	Series Index:	4
+
+        # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime", n[2] = 4"
+        # ->	Title:		"Summertime 4"
+        #	Series:		"The Endless Book 2 - Second Season 3 - Summertime"
+        #	Series Index:	4
+
+        # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3, p[1] = "Summertime"
+        # ->	Title:		"Summertime"
+        #	Series:		"The Endless Book 2 - Second Season"
+        #	Series Index:	3
+
+        # a = "The Endless Book", n[0] = 2, p[0] = "Second Season", n[1] = 3"	Example: 956375146
+        # ->	Title:		"Second Season 3"	n=2, p =1
+        #	Series:		"The Endless Book 2 - Second Season"
+        #	Series Index:	3
+
+        # a = "The Endless Book", n[0] = 2, p[0] = "Second Season"
+        # ->	Title:		"Second Season"	n=1,p=1
+        #	Series:		"The Endless Book"
+        #	Series Index:	2
+
+        # a = "The Endless Book", n[0] = 2"
+        # ->	Title: 		"The Endless Book 2"
+        #	Series:		"The Endless Book"
+        #	Series Index:	2
+
+        with span(log, 'field 245'):
+            title_parts = []
+            for field in marc.fields('245'):
+
+                code_a = list(field.get('a', []))
+
+                code_n = []
+                for i in field.get('n', []):
+                    match = re.search(r"(\d+([,\.]\d+)?)", i)
+                    if match:
+                        code_n.append(match.group(1))
+                    else:
+                        # looks like sometimes DNB does not know the series_index and uses something like "[...]"
+                        match = re.search(r"\[\.\.\.\]", i)
+                        if match:
+                            code_n.append('0')
+
+                code_p = list(field.get('p', []))
+
+                # Title
+                title_parts = code_a
+
+                # Looks like we have a series
+                if code_a and code_n:
+                    # set title ("Name of this Book")
+                    if code_p:
+                        title_parts = [code_p[-1]]
+
+                    # build series name
+                    series_parts = [code_a[0]]
+                    for i in range(0, min(len(code_p), len(code_n)) - 1):
+                        series_parts.append(code_p[i])
+
+                    for i in range(0, min(len(series_parts), len(code_n) - 1)):
+                        series_parts[i] += ' ' + code_n[i]
+
+                    book_series = ' - '.join(series_parts)
+                    log.info("[245] Series: %s" % book_series)
+                    book_series = self.clean_series(book_series)
+
+                    # build series index
+                    if code_n:
+                        book_series_index = code_n[-1]
+                        log.info("[245] Series_Index: %s" % book_series_index)
+
+                # subtitle 1: Field 245, Subfield b
+                if 'b' in field:
+                    title_parts.append(field['b'][0])
+
+            #### Field 249: "Additional Titles for Compilations"
+            additional_titles_parts = marc.values('249', 'a')
+
+            # Merge Title and Additional Titles
+            title = " : ".join(title_parts)
+            log.info("[245] Title: %s" % title)
+
+            additional_titles = " / ".join(additional_titles_parts)
+            log.info("[249] Additional Titles: %s" % additional_titles)
+
+            book_title = " / ".join(filter(None, [title, additional_titles]))
+            book_title = clean_title(log, book_title)
+
+            # Title_Sort
+            if title_parts:
+                title_sort_parts = list(title_parts)
+
+                try:  # Python2
+                    title_sort_regex = re.match(r'^(.*?)(' + unichr(152) + '.*' + unichr(156) + ')?(.*?)$', title_parts[0])
+                except:  # Python3
+                    title_sort_regex = re.match(r'^(.*?)(' + chr(152) + '.*' + chr(156) + ')?(.*?)$', title_parts[0])
+                sortword = title_sort_regex.group(2)
+                if sortword:
+                    title_sort_parts[0] = ''.join(filter(None, [title_sort_regex.group(1).strip(), title_sort_regex.group(3).strip(), ", " + sortword]))
+
+                title_sort = " : ".join(title_sort_parts)
+                log.info("[245/249] Title_Sort: %s" % title_sort)
+
+        series = None
+        series_index = None
+
+        # Field 490: "Series Statement"
+        # Get Series and Series_Index
+        # In theory book series are in field 830, but sometimes they are in 490, 246, 800 or nowhere
+        # So let's look here if we could not extract series/series_index from 830 above properly
+        # Subfields:
+        # v: Series name and index
+        # a: Series name
+        with span(log, 'field 490'):
+            for field in marc.fields('490'):
+                if 'v' not in field or 'a' not in field:
+                    continue
+
+                if book_series and book_series_index and book_series_index != "0":
+                    break
+
+                series = None
+                series_index = None
+
+                # "v" is something like "Nr. 220", "220", "This great Seriestitle : Nr. 220", "Bd. 220, Abth. 1 = [1]"
+                attr_v = field['v'][0]
+
+                # Assume we have "This great Seriestitle : Nr. 220"
+                # -> Split at " : ", the part without digits is the series, the digits in the other part are the series_index
+                parts = re.split(" : ", attr_v)
+                if len(parts) == 2:
+                    if bool(re.search(r"\d", parts[0])) != bool(re.search(r"\d", parts[1])):
+                        # figure out which part contains the index number
+                        if bool(re.search(r"\d", parts[0])):
+                            indexpart = parts[0]
+                            textpart = parts[1]
+                        else:
+                            indexpart = parts[1]
+                            textpart = parts[0]
+
+                        match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", indexpart)
+                        if match:
+                            series_index = match.group(1)
+                            series = textpart.strip()
+                            log.info("[490.v] Series: %s" % series)
+                            log.info("[490.v] Series_Index: %s" % series_index)
+
+                else:
+                    # Assumption above was wrong. Try to extract at least the series_index
+                    match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", attr_v)
+
+                    if match:
+                        series_index = match.group(1)
+                        log.info("[490.v] Series_Index: %s" % series_index)
+
+                # Use Series Name from attribute "a" if not already found in attribute "v"
+                if not series:
+                    series = field['a'][0]
+                    log.info("[490.a] Series: %s" % series)
+
+                if series:
+                    series = self.clean_series(series)
+
+                    if series and series_index:
+                        book_series = series
+                        book_series_index = series_index
+
+        ##### Field 246: "Varying Form of Title" #####
+        # Series and Series_Index
+        with span(log, 'field 246'):
+            for i in marc.values('246', 'a'):
+
+                if book_series and book_series_index and book_series_index != "0":
+                    break
+
+                match = re.search(r"^(.+?) ; (\d+[\.,]?(?:(?<=[\.,])\d*)?)$", i)
+                if match:
+                    series = match.group(1)
+                    series_index = match.group(2)
+                    log.info("[246.a] Series: %s" % series)
+                    log.info("[246.a] Series_Index: %s" % book_series_index)
+                    series = self.clean_series(match.group(1))
+
+                    if series and series_index:
+                        book_series = series
+                        book_series_index = series_index
+
+        ##### Field 800: "Series Added Entry-Personal Name" #####
+        # Series and Series_Index
+        with span(log, 'field 800'):
+            for field in marc.fields('800'):
+                if 'v' not in field or 't' not in field:
+                    continue
+
+                if book_series and book_series_index and book_series_index != "0":
+                    break
+
+                # Series Index
+                match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", field['v'][0])
+                if match:
+                    series_index = match.group(1)
+                    log.info("[800.v] Series_Index: %s" % series_index)
+
+                # Series
+                series = field['t'][0]
+                log.info("[800.t] Series: %s" % series)
+                series = self.clean_series(series)
+
+                if series and series_index:
+                    book_series = series
+                    book_series_index = series_index
+
+        ##### Field 830: "Series Added Entry-Uniform Title" #####
+        # Series and Series_Index
+        with span(log, 'field 830'):
+            for field in marc.fields('830'):
+                if 'v' not in field or 'a' not in field:
+                    continue
+
+                if book_series and book_series_index and book_series_index != "0":
+                    break
+
+                # Series Index
+                match = re.search(r"^.*?(\d+[\.,]?(?:(?<=[\.,])\d*)?)", field['v'][0])
+                if match:
+                    series_index = match.group(1)
+                    log.info("[830.v] Series_Index: %s" % series_index)
+
+                # Series
+                series = field['a'][0]
+                log.info("[830.a] Series: %s" % series)
+                series = self.clean_series(series)
+
+                if series and series_index:
+                    book_series = series
+                    book_series_index = series_index
+
+        ##### SERIES GUESSER #####
+        # DNB's metadata often lacks proper series/series_index data
+        # If wanted by user: Try to retrieve Series, Series Index and "real" Title from the fetched Title
+        with span(log, 'series guesser'):
+            if self.plugin.cfg_guess_series is True and not book_series or not book_series_index or book_series_index == "0":
+                try:
+                    (guessed_title, guessed_series, guessed_series_index) = guess_series_from_title(log, book_title)
+
+                    guessed_title = clean_title(log, guessed_title)
+                    guessed_series = self.clean_series(guessed_series)
+
+                    if guessed_title and guessed_series and guessed_series_index:
+                        book_title = guessed_title
+                        book_series = guessed_series
+                        book_series_index = guessed_series_index
+
+                except TypeError:
+                    pass
+
+        return self.done('_titles', (book_title, title_sort, book_series, book_series_index))
+
+    ##### Authors #####
+
+    @property
+    def authors(self):
+        if self._authors is None:
+            self.extract_authors()
+        return self._authors
+
+    def extract_authors(self):
+        ##### Field 100: "Main Entry-Personal Name"  #####
+        ##### Field 700: "Added Entry-Personal Name" #####
+        # Get Authors ####
+        log = self.log
+        marc = self.marc
+        authors = []
+        with span(log, 'field 100/700'):
+            # primary authors
+            primary_authors = []
+            for field in marc.fields('100'):
+                if 'aut' in field.get('4', []):
+                    for i in field.get('a', []):
+                        name = re.sub(r" \[.*\]$", "", i)
+                        primary_authors.append(name)
+
+            if primary_authors:
+                authors.extend(primary_authors)
+                log.info("[100.a] Primary Authors: %s" % " & ".join(primary_authors))
+
+            # secondary authors
+            secondary_authors = []
+            for field in marc.fields('700'):
+                if 'aut' in field.get('4', []):
+                    for i in field.get('a', []):
+                        name = re.sub(r" \[.*\]$", "", i)
+                        secondary_authors.append(name)
+
+            if secondary_authors:
+                authors.extend(secondary_authors)
+                log.info("[700.a] Secondary Authors: %s" % " & ".join(secondary_authors))
+
+            # if no "real" author was found use all involved persons as authors
+            if not authors:
+                involved_persons = []
+                for i in marc.values('700', 'a'):
+                    name = re.sub(r" \[.*\]$", "", i)
+                    involved_persons.append(name)
+
+                if involved_persons:
+                    authors.extend(involved_persons)
+                    log.info("[700.a] Involved Persons: %s" % " & ".join(involved_persons))
+
+        return self.done('_authors', authors)
+
+    ##### Identifiers #####
+
+    @property
+    def urn(self):
+        # "" if the record has none
+        if self._urn is None:
+            self.extract_urn()
+        return self._urn or None
+
+    def extract_urn(self):
+        ##### Field 24: "Other Standard Identifier" #####
+        # Get Identifier "URN"
+        urn = ''
+        with span(self.log, 'field 024'):
+            urns = [a for field in self.marc.fields('024') if 'urn' in field.get('2', []) for a in field.get('a', [])]
+            for i in urns:
+                match = re.search(r"^urn:(.+)$", i)
+                if match:
+                    urn = match.group(1)
+                    self.log.info("[024.a] Identifier URN: %s" % urn)
+                    break
+        return self.done('_urn', urn)
+
+    @property
+    def ddc(self):
+        if self._ddc is None:
+            self.extract_ddc()
+        return self._ddc
+
+    def extract_ddc(self):
+        ##### Field 82: "Dewey Decimal Classification Number" #####
+        # Get Identifier "Sachgruppen (DDC)" (ddc)
+        ddc = self.marc.values('082', 'a')
+        if ddc:
+            self.log.info("[082.a] Indentifiers DDC: %s" % ",".join(ddc))
+        return self.done('_ddc', ddc)
+
+    ##### Subjects #####
+
+    @property
+    def subjects_gnd(self):
+        if self._subjects_gnd is None:
+            self.extract_subjects_gnd()
+        return self._subjects_gnd
+
+    def extract_subjects_gnd(self):
+        log = self.log
+        marc = self.marc
+        with span(log, 'field 6xx gnd'):
+            ##### Field 689 #####
+            # Get GND Subjects
+            subjects_gnd = marc.values('689', 'a')
+
+            # only the tags the record has
+            for tag in marc.tags('600', '655'):
+                for field in marc.fields(tag):
+                    if 'gnd' not in field.get('2', []):
+                        continue
+                    for i in field.get('a', []):
+                        # skip entries starting with "(":
+                        if i.startswith("("):
+                            continue
+                        subjects_gnd.append(i)
+
+            if subjects_gnd:
+                log.info("[689.a] GND Subjects: %s" % " ".join(subjects_gnd))
+
+        return self.done('_subjects_gnd', subjects_gnd)
+
+    @property
+    def subjects_non_gnd(self):
+        if self._subjects_non_gnd is None:
+            self.extract_subjects_non_gnd()
+        return self._subjects_non_gnd
+
+    def extract_subjects_non_gnd(self):
+        log = self.log
+        marc = self.marc
+        with span(log, 'field 6xx non-gnd'):
+            ##### Fields 600-655 #####
+            # Get non-GND Subjects
+            subjects_non_gnd = []
+            for tag in marc.tags('600', '655'):
+                for i in marc.values(tag, 'a'):
+                    # skip entries starting with "(":
+                    if i.startswith("("):
+                        continue
+                    # skip one-character subjects:
+                    if len(i) < 2:
+                        continue
+
+                    subjects_non_gnd.extend(re.split(',|;', remove_sorting_characters(i)))
+
+            if subjects_non_gnd:
+                log.info("[600.a-655.a] Non-GND Subjects: %s" % " ".join(subjects_non_gnd))
+
+        return self.done('_subjects_non_gnd', subjects_non_gnd)
+
+    ##### Edition and Languages #####
+
+    @property
+    def edition(self):
+        # "" if the record has none
+        if self._edition is None:
+            self.extract_edition()
+        return self._edition or None
+
+    def extract_edition(self):
+        ##### Field 250: "Edition Statement" #####
+        # Get Edition
+        edition = self.marc.value('250', 'a')
+        if edition:
+            self.log.info("[250.a] Edition: %s" % edition)
+        return self.done('_edition', edition or '')
+
+    @property
+    def languages(self):
+        if self._languages is None:
+            self.extract_languages()
+        return self._languages
+
+    def extract_languages(self):
+        ##### Field 41: "Language Code" #####
+        # Get Languages (unfortunately in ISO-639-2/B ("ger" for German), while Calibre uses ISO-639-1 ("de"))
+        # ISO-639-2/B is very close to ISO-639-3, which can be converted to ISO-639-1 with Calibre's "lang_as_iso639_1" function
+        # So we translate ISO-639-2/B to ISO-639-3 and feed that to Calibre
+        languages = []
+        with span(self.log, 'field 041'):
+            for i in self.marc.values('041', 'a'):
+                languages.append(
+                    lang_as_iso639_1(
+                        iso639_2b_as_iso639_3(i)
+                    )
+                )
+
+            try:
+                if languages:
+                    self.log.info("[041.a] Languages: %s" % ",".join(languages))
+            except TypeError:
+                pass
+
+        return self.done('_languages', languages)
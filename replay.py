@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Record responses of the DNB servers and replay them with a local stand-in server,
+# so the plugin can be tested and benchmarked without the live servers.
+#
+# Record: set DNB_DE_RECORD=<fixture directory> and run the plugin as usual, e.g. with
+#   DNB_DE_RECORD=fixtures calibre-debug -e __init__.py
+# Replay: start the stand-in server with
+#   python replay.py <fixture directory> [--port 8080] [--latency 0.2] [--error-rate 0.05]
+# and set the environment variables it prints before starting calibre.
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import hashlib
+import argparse
+import threading
+
+try:
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+except ImportError:
+    # Python3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+
+
+# URLs of the DNB servers, see DNB_DE.QUERYURL and DNB_DE.COVERURL
+QUERYURL = '/sru/dnb?version=1.1&maximumRecords=%s&startRecord=%s&operation=searchRetrieve&recordSchema=MARC21-xml&query=%s'
+COVERURL = '/opac/mvb/cover?isbn=%s'
+COMMENTSURLS = (b'http://deposit.dnb.de/', b'https://deposit.dnb.de/')
+
+# headers describing the transfer, not the content (the body is stored decoded), or set by the stand-in server itself
+SKIPPED_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length', 'date', 'server')
+
+
+def fixture_name(method, url):
+    return hashlib.sha1(('%s %s' % (method, url)).encode('utf-8')).hexdigest()
+
+
+class Recorder(object):
+    """
+    Store responses into a fixture directory: <hash>.json (request and response head) and <hash>.body
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+    def record(self, method, url, response):
+        name = os.path.join(self.directory, fixture_name(method, url))
+        head = {
+            'method': method,
+            'url': url,
+            'status': response.status,
+            'reason': response.reason,
+            'headers': dict((k, v) for k, v in response.headers.items() if k not in SKIPPED_HEADERS),
+        }
+        # write to temporary files first, other threads and processes may record the same URL
+        suffix = '.%s.%s.tmp' % (os.getpid(), threading.current_thread().ident)
+        with open(name + '.body' + suffix, 'wb') as f:
+            f.write(response.data or b'')
+        with open(name + '.json' + suffix, 'wb') as f:
+            f.write(json.dumps(head, indent=1, sort_keys=True).encode('utf-8'))
+        for ext in ('.body', '.json'):
+            if os.path.exists(name + ext):
+                os.remove(name + ext)
+            os.rename(name + ext + suffix, name + ext)
+
+
+def load_fixtures(directory):
+    """
+    Load all recorded responses: {(method, path and query): (head, body)}
+    """
+    fixtures = {}
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as f:
+            head = json.loads(f.read().decode('utf-8'))
+        with open(os.path.join(directory, filename[:-5] + '.body'), 'rb') as f:
+            body = f.read()
+        parts = urlsplit(head['url'])
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        fixtures[(head['method'], path)] = (head, body)
+    return fixtures
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in for the DNB servers answering with recorded responses
+    latency: seconds to wait before each answer, plus a random jitter of up to "jitter" seconds
+    error_rate: share of requests answered with "error_status" instead
+    """
+    daemon_threads = True
+    # log every request
+    verbose = False
+
+    def __init__(self, fixtures, port=0, latency=0, jitter=0, error_rate=0, error_status=503, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), ReplayHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.base_url = 'http://%s:%s' % (host, self.server_address[1])
+
+        self.requests = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def environment(self):
+        """
+        Get environment variables pointing the plugin to this server
+        """
+        return {
+            'DNB_DE_QUERYURL': self.base_url + QUERYURL,
+            'DNB_DE_COVERURL': self.base_url + COVERURL,
+            'DNB_DE_COMMENTSURLS': self.base_url + '/',
+        }
+
+    def rewrite(self, body):
+        # links to comments in SRU responses point to this server, too
+        for url in COMMENTSURLS:
+            body = body.replace(url, self.base_url.encode('utf-8') + b'/')
+        return body
+
+    def start(self):
+        """
+        Serve in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer(send_body=True)
+
+    def do_HEAD(self):
+        self.answer(send_body=False)
+
+    def answer(self, send_body):
+        server = self.server
+        with server._lock:
+            server.requests += 1
+
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_bytes(server.error_status, 'Injected error', {'content-type': 'text/plain'}, b'Injected error', send_body)
+            return
+
+        fixture = server.fixtures.get((self.command, self.path))
+        if fixture is None and self.command == 'HEAD':
+            # a recorded GET answers a HEAD, too
+            fixture = server.fixtures.get(('GET', self.path))
+        if fixture is None:
+            with server._lock:
+                server.misses += 1
+            self.send_bytes(404, 'Not recorded', {'content-type': 'text/plain'}, b'Not recorded', send_body)
+            return
+
+        head, body = fixture
+        self.send_bytes(head['status'], head['reason'], head['headers'], server.rewrite(body), send_body)
+
+    def send_bytes(self, status, reason, headers, body, send_body):
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers = dict(headers, **{'content-encoding': 'gzip'})
+
+        self.send_response(status, reason)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded responses of the DNB servers')
+    parser.add_argument('fixtures', help='directory with recorded responses (see DNB_DE_RECORD)')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='seconds to wait before each answer')
+    parser.add_argument('--jitter', type=float, default=0, help='additional random delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with an error (0-1)')
+    parser.add_argument('--error-status', type=int, default=503, help='HTTP status of injected errors')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    server = ReplayServer(load_fixtures(args.fixtures), args.port, args.latency, args.jitter, args.error_rate, args.error_status)
+    server.verbose = args.verbose
+    print('Serving %s recorded responses at %s' % (len(server.fixtures), server.base_url))
+    print('Point the plugin to this server with:')
+    for name, value in sorted(server.environment().items()):
+        print("  export %s='%s'" % (name, value))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests of the caches, run in the plugin's directory with:
+#   python -m unittest discover -p 'test_*.py'
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+try:
+    from calibre_plugins.DNB_DE.cache import SQLiteCache, TieredCache, FileCache
+except ImportError:
+    # run outside of calibre
+    from cache import SQLiteCache, TieredCache, FileCache
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_get_set_delete(self):
+        cache = SQLiteCache(self.path, 'test', 3600, 1024 * 1024)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'value')
+        self.assertEqual(cache.get('a'), b'value')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_shared_by_instances(self):
+        SQLiteCache(self.path, 'test', 3600, 1024 * 1024).set('a', b'value')
+        self.assertEqual(SQLiteCache(self.path, 'test', 3600, 1024 * 1024).get('a'), b'value')
+        self.assertIsNone(SQLiteCache(self.path, 'other', 3600, 1024 * 1024).get('a'))
+
+    def test_expiry(self):
+        cache = SQLiteCache(self.path, 'test', 3600, 1024 * 1024)
+        cache.set('a', b'value')
+        self.assertEqual(cache.get_with_age('a')[0], b'value')
+
+        # entries older than the TTL are not returned, and are removed by evict()
+        cache.ttl = 0.05
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        cache.evict()
+        cache.ttl = 3600
+        self.assertIsNone(cache.get('a'))
+
+    def test_eviction_of_least_recently_used(self):
+        value = os.urandom(1000)
+        cache = SQLiteCache(self.path, 'test', 3600, 1000000)
+        for i in range(10):
+            cache.set('key%s' % i, value)
+            # access times must differ
+            time.sleep(0.01)
+        # reading an entry makes it the most recently used one
+        cache.get('key0')
+
+        # random data does not compress: each entry takes a bit more than 1000 bytes
+        cache.max_size = 5500
+        cache.evict()
+        kept = [i for i in range(10) if cache.get('key%s' % i) is not None]
+        # shrinks to 90% of the limit: the four newest entries
+        self.assertEqual(kept, [0, 7, 8, 9])
+
+    def test_evicts_every_nth_write(self):
+        cache = SQLiteCache(self.path, 'test', 3600, 5000)
+        for i in range(SQLiteCache.EVICT_EVERY):
+            cache.set('key%s' % i, os.urandom(1000))
+        kept = [i for i in range(SQLiteCache.EVICT_EVERY) if cache.get('key%s' % i) is not None]
+        self.assertTrue(0 < len(kept) <= 5)
+        self.assertIn(SQLiteCache.EVICT_EVERY - 1, kept)
+
+
+class TieredCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.disk = SQLiteCache(os.path.join(self.directory, 'cache.sqlite'), 'test', 3600, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_values_go_to_disk(self):
+        TieredCache(self.disk, 10).set('a', {'title': 'Der Goblin-Held', 'isbns': ['9783404285266']})
+        # a new memory tier (e.g. of another process) reads the value from disk
+        cache = TieredCache(self.disk, 10)
+        self.assertEqual(cache.get('a'), {'title': 'Der Goblin-Held', 'isbns': ['9783404285266']})
+        self.assertIsNone(cache.get('b'))
+
+    def test_memory_hit_does_not_read_disk(self):
+        cache = TieredCache(self.disk, 10)
+        cache.set('a', [1, 2])
+        self.disk.delete('a')
+        self.assertEqual(cache.get('a'), [1, 2])
+        self.assertEqual(self.disk.stats()['hits'], 1)
+
+    def test_least_recently_used_leave_memory(self):
+        cache = TieredCache(self.disk, 2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(list(cache._entries), ['a', 'c'])
+
+        # still on disk
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(list(cache._entries), ['c', 'b'])
+
+    def test_expiry_in_both_tiers(self):
+        cache = TieredCache(self.disk, 10)
+        cache.set('a', 1)
+        self.disk.ttl = 0.05
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_age_of_disk_entries_is_kept(self):
+        TieredCache(self.disk, 10).set('a', 1)
+        time.sleep(0.1)
+        cache = TieredCache(self.disk, 10)
+        self.assertEqual(cache.get('a'), 1)
+        # taken into memory with the time it was stored, not the time it was read
+        self.disk.ttl = 0.05
+        self.assertIsNone(cache.get('a'))
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_put_get(self):
+        cache = FileCache(self.directory, 1024 * 1024)
+        digest = cache.put(b'image')
+        # identical data is stored once
+        self.assertEqual(cache.put(b'image'), digest)
+        self.assertEqual(cache.get(digest), b'image')
+        self.assertIsNone(cache.get('0' * 40))
+
+    def test_eviction_of_least_recently_used(self):
+        cache = FileCache(self.directory, 1000000)
+        digests = []
+        for i in range(10):
+            digests.append(cache.put(os.urandom(1000)))
+            # modification times must differ
+            time.sleep(0.01)
+        cache.get(digests[0])
+
+        cache.max_size = 5500
+        cache.evict()
+        kept = [i for i in range(10) if cache.get(digests[i]) is not None]
+        self.assertEqual(kept, [0, 7, 8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
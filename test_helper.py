@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests of the helpers, run in the plugin's directory with:
+#   python -m unittest discover -p 'test_*.py'
+
+import re
+import unittest
+
+try:
+    from calibre_plugins.DNB_DE import helper
+except ImportError:
+    # run outside of calibre
+    import helper
+
+
+class Log(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+
+class GuessSeriesTest(unittest.TestCase):
+    def guess(self, title):
+        log = Log()
+        result = helper.guess_series_from_title(log, title)
+        return result, log.messages
+
+    def test_rules(self):
+        for title, rule, expected in [
+                # 2P1: "Name of the series - Episode 2"
+                ('Die Reise : Harry Potter Band 3', '2P1', ('Die Reise', 'Harry Potter', '3')),
+                ('Harry Potter Episode 3 : Der Titel', '2P1', ('Der Titel', 'Harry Potter', '3')),
+                # 2P2: "Episode 2 Name of the series"
+                ('Band 3 Die Chroniken : Der Anfang', '2P2', ('Der Anfang', 'Die Chroniken', '3')),
+                ('Sammelband 2 Die Hexer : Der Titel', '2P2', ('Der Titel', 'Die Hexer', '2')),
+                # 2P3: "Band 2", series and title in the other part
+                ('Die Chroniken - Der Anfang : Band 3', '2P3', ('Der Anfang', 'Die Chroniken', '3')),
+                ('Die Chroniken - Der Anfang : #3', '2P3', ('Der Anfang', 'Die Chroniken', '3')),
+                # 1P1: "Name of the series - Title (Episode 2)"
+                ('Die drei ??? - Die Rückkehr (Folge 5)', '1P1', ('Die Rückkehr', 'Die drei ???', '5')),
+                # 1P2: "Name of the series - Episode 2"
+                ('Perry Rhodan - Band 12', '1P2', ('Perry Rhodan : Band 12', 'Perry Rhodan', '12')),
+                ('Hexer Teil 2', '1P2', ('Hexer : Band 2', 'Hexer', '2'))]:
+            result, messages = self.guess(title)
+            self.assertEqual(result, expected, title)
+            self.assertEqual(messages, ['[Series Guesser] %s matched: Title: %s, Series: %s[%s]' % (
+                rule, expected[0], expected[1], expected[2])], title)
+
+    def test_no_series(self):
+        for title in [
+                'Zar und Zimmermann', '1984', 'Sommer 1999 : Erinnerungen',
+                # 2P3 without series in the other part
+                'Der Anfang : Band 3',
+                # both parts with digits
+                'Kapitel 1 : Kapitel 2',
+                # more than two parts
+                'a : b : Band 3',
+                # "Vol" and "Episode" on their own are only known to 2P1
+                'Vol. 3 : Der Titel', 'Der Titel : Episode 3']:
+            self.assertEqual(self.guess(title), (None, []), title)
+
+    def test_series_index_words(self):
+        self.assertEqual(helper.series_index_words('Zar und Zimmermann'), set())
+        self.assertEqual(helper.series_index_words('Perry Rhodan - Band 12'), {helper.COMMON_SERIES_INDEX_WORDS})
+        self.assertEqual(helper.series_index_words('Vol.Episode 3'), {helper.COMMON_SERIES_INDEX_WORDS})
+        self.assertEqual(helper.series_index_words('Vol. 3 Episode'), {'Vol', 'Episode'})
+        self.assertEqual(helper.series_index_words('Volume 3'), {helper.COMMON_SERIES_INDEX_WORDS})
+
+    def test_rules_run_only_with_their_words(self):
+        rules = helper.SERIES_GUESSER_RULES
+        tried = []
+
+        def result(match, textpart):
+            tried.append(textpart)
+            return None
+
+        # a rule matching everything, for titles with one of the common words
+        anything = re.compile('.*')
+        helper.SERIES_GUESSER_RULES = {
+            1: [('TEST', anything, frozenset((helper.COMMON_SERIES_INDEX_WORDS,)), result)],
+            2: [('TEST', anything, frozenset((helper.COMMON_SERIES_INDEX_WORDS,)), result)]}
+        try:
+            for title in ['Zar und Zimmermann', 'Sommer 1999', 'Der Titel : Episode 3', 'Vol 3']:
+                self.guess(title)
+            self.assertEqual(tried, [])
+
+            self.guess('Der Titel : Folge 3')
+            self.guess('Heft 3')
+            self.assertEqual(tried, ['Der Titel', 'Heft 3'])
+        finally:
+            helper.SERIES_GUESSER_RULES = rules
+
+
+class UnwantedSeriesTest(unittest.TestCase):
+    def test_search(self):
+        unwanted = helper.UnwantedSeries([r'^Roman$', r'^dtv', '', r'^(Edition|Reihe) Suhrkamp$', r'(?i)^knaur'])
+        self.assertEqual(unwanted.search('Roman'), r'^Roman$')
+        # case-insensitive
+        self.assertEqual(unwanted.search('DTV premium'), r'^dtv')
+        # patterns with groups or inline flags are checked one by one
+        self.assertEqual(unwanted.search('Edition Suhrkamp'), r'^(Edition|Reihe) Suhrkamp$')
+        self.assertEqual(unwanted.search('Knaur Taschenbuch'), r'(?i)^knaur')
+        self.assertIsNone(unwanted.search('Die Chroniken'))
+        self.assertEqual(len(unwanted.separate), 2)
+
+    def test_first_pattern_wins(self):
+        unwanted = helper.UnwantedSeries([r'Taschenbuch$', r'^Heyne'])
+        self.assertEqual(unwanted.search('Heyne Taschenbuch'), r'Taschenbuch$')
+
+    def test_invalid_and_empty_patterns(self):
+        unwanted = helper.UnwantedSeries(['(broken', '  ', r'^Roman$'])
+        self.assertEqual([pattern for pattern, error in unwanted.invalid], ['(broken'])
+        self.assertEqual([pattern for pattern, compiled in unwanted.patterns], [r'^Roman$'])
+        self.assertTrue(unwanted)
+        self.assertFalse(helper.UnwantedSeries(['', '(broken']))
+
+    def test_compiled_once(self):
+        patterns = [r'^Roman$', r'^dtv']
+        self.assertIs(helper.compile_unwanted_series(patterns), helper.compile_unwanted_series(list(patterns)))
+
+    def test_clean_series(self):
+        log = Log()
+        unwanted = helper.UnwantedSeries([r'^Roman$'])
+        self.assertEqual(helper.clean_series(log, 'Die Chroniken', 'Bastei Lübbe', unwanted), 'Die Chroniken')
+        self.assertIsNone(helper.clean_series(log, 'Roman', None, unwanted))
+        self.assertIsNone(helper.clean_series(log, 'Bastei-Lübbe-Taschenbuch', 'Bastei Lübbe', unwanted))
+        self.assertIsNone(helper.clean_series(log, ' ', None, unwanted))
+        self.assertEqual(len(log.messages), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests of the MARC21 reader, run in the plugin's directory with:
+#   python -m unittest discover -p 'test_*.py'
+
+import unicodedata
+import unittest
+
+try:
+    from lxml import etree
+except ImportError:
+    # comes with calibre
+    etree = None
+
+try:
+    from calibre_plugins.DNB_DE.marc import MarcRecord, nfc
+except ImportError:
+    # run outside of calibre
+    from marc import MarcRecord, nfc
+
+
+RECORD = '''<record xmlns="http://www.loc.gov/MARC21/slim" type="Bibliographic">
+  <leader>00000nam a2200000 c 4500</leader>
+  <controlfield tag="001">1207331961</controlfield>
+  <datafield tag="016" ind1="7" ind2=" ">
+    <subfield code="a">1207331961</subfield>
+    <subfield code="2">DE-101</subfield>
+  </datafield>
+  <datafield tag="020" ind1=" " ind2=" ">
+    <subfield code="a">9783404285266</subfield>
+    <subfield code="c">kart. : EUR 10.00 (DE)</subfield>
+  </datafield>
+  <datafield tag="020" ind1=" " ind2=" ">
+    <subfield code="9">978-3-404-28526-6</subfield>
+  </datafield>
+  <datafield tag="245" ind1="1" ind2="0">
+    <subfield code="a"> Der Goblin-Held </subfield>
+    <subfield code="b">Roman</subfield>
+    <subfield code="n">1</subfield>
+    <subfield code="n">2</subfield>
+    <subfield code="p"></subfield>
+  </datafield>
+  <!-- decomposed characters, as DNB sends them -->
+  <datafield tag="264" ind1=" " ind2="1">
+    <subfield code="a">Ko\u0308ln</subfield>
+    <subfield code="b">Bastei Lu\u0308bbe</subfield>
+  </datafield>
+  <datafield tag="689" ind1="0" ind2="0"><subfield code="a">Goblin</subfield></datafield>
+  <datafield tag="650" ind1=" " ind2="7"><subfield code="a">Fantasy</subfield></datafield>
+  <datafield tag="776" ind1="0" ind2="8"><subfield code="w">(DE-101)1207332054</subfield></datafield>
+</record>'''
+
+
+@unittest.skipIf(etree is None, 'lxml is not installed')
+class MarcRecordTest(unittest.TestCase):
+    def setUp(self):
+        self.record = MarcRecord(etree.XML(RECORD.encode('utf-8')))
+
+    def test_value(self):
+        self.assertEqual(self.record.value('016', 'a'), '1207331961')
+        # of the first field having the subfield
+        self.assertEqual(self.record.value('020', '9'), '978-3-404-28526-6')
+        self.assertIsNone(self.record.value('020', 'x'))
+        self.assertIsNone(self.record.value('999', 'a'))
+
+    def test_values(self):
+        self.assertEqual(self.record.values('245', 'n'), ['1', '2'])
+        self.assertEqual(self.record.values('020', 'a'), ['9783404285266'])
+        self.assertEqual(self.record.values('999', 'a'), [])
+        # a new list every time
+        self.record.values('245', 'n').append('3')
+        self.assertEqual(self.record.values('245', 'n'), ['1', '2'])
+
+    def test_fields(self):
+        fields = self.record.fields('020')
+        self.assertEqual(len(fields), 2)
+        self.assertEqual(fields[0], {'a': ['9783404285266'], 'c': ['kart. : EUR 10.00 (DE)']})
+        self.assertEqual(self.record.fields('999'), [])
+
+    def test_texts_stripped_and_empty_subfields_left_out(self):
+        self.assertEqual(self.record.value('245', 'a'), 'Der Goblin-Held')
+        self.assertNotIn('p', self.record.fields('245')[0])
+
+    def test_texts_composed(self):
+        self.assertEqual(self.record.value('264', 'a'), 'Köln')
+        self.assertEqual(self.record.value('264', 'b'), 'Bastei Lübbe')
+
+    def test_control_fields_ignored(self):
+        self.assertEqual(self.record.fields('001'), [])
+
+    def test_tags(self):
+        self.assertEqual(self.record.tags('600', '699'), ['650', '689'])
+        self.assertEqual(self.record.tags('700', '799'), ['776'])
+
+
+class NfcTest(unittest.TestCase):
+    def test_nfc(self):
+        for text in ['Goblin', 'Köln', 'Ko\u0308ln', 'Bišický-Ehrlich', 'Bis\u030cicky\u0301-Ehrlich', '']:
+            self.assertEqual(nfc(text), unicodedata.normalize('NFC', text))
+
+
+if __name__ == '__main__':
+    unittest.main()
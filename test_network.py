@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests of the rate limiter and of streamed responses, run in the plugin's directory with:
+#   python -m unittest discover -p 'test_*.py'
+
+import time
+import gzip
+import socket
+import unittest
+from io import BytesIO
+
+try:
+    from calibre_plugins.DNB_DE.network import RateLimiter, StreamingResponse
+except ImportError:
+    # run outside of calibre
+    from network import RateLimiter, StreamingResponse
+
+
+class RateLimiterTest(unittest.TestCase):
+    def respond(self, limiter, latency, healthy):
+        """
+        Let a request finish, without waiting for the rate limit
+        """
+        limiter.active += 1
+        limiter.release(latency, healthy)
+
+    def test_additive_increase(self):
+        limiter = RateLimiter(10, 4)
+        limiter.rate = 2.0
+        limiter.concurrency = 1.0
+        for i in range(3):
+            self.respond(limiter, 0.1, True)
+        self.assertEqual(limiter.rate, 3.5)
+        self.assertEqual(limiter.limits()['concurrency'], 2)
+
+        # never beyond the configured limits
+        for i in range(40):
+            self.respond(limiter, 0.1, True)
+        self.assertEqual(limiter.limits(), {'rate': 10, 'concurrency': 4, 'active': 0})
+
+    def test_multiplicative_decrease(self):
+        limiter = RateLimiter(10, 4)
+        self.respond(limiter, 0.1, False)
+        self.assertEqual(limiter.limits(), {'rate': 5, 'concurrency': 2, 'active': 0})
+
+        # slow responses count as a sign of overload, too
+        limiter.last_backoff = 0
+        self.respond(limiter, RateLimiter.SLOW_RESPONSE + 1, True)
+        self.assertEqual(limiter.limits(), {'rate': 2.5, 'concurrency': 1, 'active': 0})
+
+    def test_backoff_once_per_interval(self):
+        limiter = RateLimiter(10, 4)
+        limiter.report_problem()
+        limiter.report_problem()
+        self.assertEqual(limiter.rate, 5)
+
+    def test_lower_limits(self):
+        limiter = RateLimiter(1, 1)
+        for i in range(5):
+            limiter.last_backoff = 0
+            limiter.report_problem()
+        self.assertEqual(limiter.limits(), {'rate': RateLimiter.MIN_RATE, 'concurrency': 1, 'active': 0})
+
+    def test_configure_lowers_rate(self):
+        limiter = RateLimiter(10, 4)
+        limiter.configure(3)
+        self.assertEqual(limiter.rate, 3)
+        limiter.configure(20)
+        self.assertEqual(limiter.rate, 3)
+        self.assertEqual(limiter.max_rate, 20)
+
+    def test_concurrency_limit(self):
+        limiter = RateLimiter(100, 2)
+        limiter.acquire(1)
+        limiter.acquire(1)
+        self.assertRaises(socket.timeout, limiter.acquire, 0.05)
+        limiter.release(0.1, True)
+        limiter.acquire(1)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(20, 100)
+        start = time.time()
+        # the bucket starts full with one second worth of tokens
+        for i in range(30):
+            limiter.acquire(5)
+            limiter.active -= 1
+        self.assertGreater(time.time() - start, 0.4)
+
+
+class StreamingResponseTest(unittest.TestCase):
+    DATA = b'<searchRetrieveResponse>' + b'<record/>' * 10000 + b'</searchRetrieveResponse>'
+
+    def response(self, data, gzipped=False):
+        self.released = []
+        return StreamingResponse('http://example.com/', 200, 'OK', {}, BytesIO(data), gzipped, self.released.append)
+
+    def test_read_in_chunks(self):
+        response = self.response(self.DATA)
+        response.keep_data()
+        chunks = []
+        while True:
+            chunk = response.read(1000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), self.DATA)
+        self.assertEqual(response.data, self.DATA)
+        # the connection can be used again
+        self.assertEqual(self.released, [True])
+
+    def test_gzipped(self):
+        compressed = BytesIO()
+        with gzip.GzipFile(fileobj=compressed, mode='wb') as f:
+            f.write(self.DATA)
+        response = self.response(compressed.getvalue(), True)
+        self.assertEqual(response.read(), self.DATA)
+
+    def test_closed_before_end(self):
+        response = self.response(self.DATA)
+        response.keep_data()
+        response.read(1000)
+        response.close()
+        self.assertEqual(response.read(), b'')
+        self.assertIsNone(response.data)
+        self.assertEqual(self.released, [False])
+
+    def test_buffered(self):
+        response = self.response(self.DATA)
+        response.buffer()
+        self.assertEqual(self.released, [True])
+        self.assertEqual(response.read(24), b'<searchRetrieveResponse>')
+        response.close()
+        self.assertEqual(self.released, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,618 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Unit tests of the plugin class, they need calibre:
+#   calibre-debug -e test_plugin.py
+# Without calibre (python -m unittest discover -p 'test_*.py') they are skipped.
+
+import os
+import re
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from io import BytesIO
+
+try:
+    # Python 2
+    from urllib import quote
+    from Queue import Queue
+except ImportError:
+    # Python3
+    from urllib.parse import quote
+    from queue import Queue
+
+try:
+    from calibre_plugins.DNB_DE import DNB_DE
+    from calibre_plugins.DNB_DE.cache import open_cache, open_file_cache
+    from calibre_plugins.DNB_DE.network import Response, StreamingResponse, HTTPError
+    from calibre_plugins.DNB_DE.marc import MarcRecord
+    import calibre_plugins.DNB_DE.config as cfg
+except ImportError:
+    DNB_DE = None
+
+
+class Log(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+    warn = error = info
+
+    def __call__(self, *args):
+        self.messages.append(' '.join('%s' % arg for arg in args))
+
+
+def marc_record(idn, title, isbn=None, others=(), comments_url=None, content_type=None):
+    """
+    Get a MARC21 record as XML
+    """
+    fields = [('016', 'a', idn)]
+    if isbn:
+        fields.append(('020', 'a', isbn + ' kart. : EUR 10.00'))
+    fields.append(('100', 'a', 'Hines, Jim C.'))
+    fields.append(('245', 'a', title))
+    if content_type:
+        fields.append(('336', 'a', content_type))
+    for other in others:
+        fields.append(('776', 'w', '(DE-101)' + other))
+    if comments_url:
+        fields.append(('856', 'u', comments_url))
+    return '<record xmlns="http://www.loc.gov/MARC21/slim" type="Bibliographic">%s</record>' % ''.join(
+        '<datafield tag="%s" ind1=" " ind2=" "><subfield code="%s">%s</subfield></datafield>' % field for field in fields)
+
+
+def sru_response(records, number_of_records=None, next_record_position=None):
+    """
+    Get an SRU response with MARC21 records
+    """
+    body = '<searchRetrieveResponse xmlns="http://www.loc.gov/zing/srw/"><version>1.1</version>'
+    body += '<numberOfRecords>%s</numberOfRecords><records>' % (len(records) if number_of_records is None else number_of_records)
+    for position, record in enumerate(records, 1):
+        body += '<record><recordSchema>MARC21-xml</recordSchema><recordPacking>xml</recordPacking>'
+        body += '<recordData>%s</recordData><recordPosition>%s</recordPosition></record>' % (record, position)
+    body += '</records>'
+    if next_record_position:
+        body += '<nextRecordPosition>%s</nextRecordPosition>' % next_record_position
+    return (body + '</searchRetrieveResponse>').encode('utf-8')
+
+
+class Body(object):
+    """
+    Body of a streamed response: "head" can be read right away, "tail" only once "event" is set
+    """
+    def __init__(self, head, tail):
+        self.parts = [BytesIO(head), BytesIO(tail)]
+        self.event = threading.Event()
+
+    def read(self, size=-1):
+        data = self.parts[0].read(size)
+        if not data and len(self.parts) > 1:
+            self.parts.pop(0)
+            self.event.wait(10)
+            data = self.parts[0].read(size)
+        return data
+
+    def close(self):
+        pass
+
+
+class Client(object):
+    """
+    Stand-in for the HTTP client answering with the responses set in "responses" (URL -> Response)
+    Bodies of streamed responses are read from "bodies" (URL -> file-like object), if set there.
+    All requests are recorded as (method, URL, headers).
+    """
+    def __init__(self):
+        self.responses = {}
+        self.bodies = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, headers=None, timeout=30):
+        with self._lock:
+            self.requests.append((method, url, headers or {}))
+        response = self.responses.get(url) or Response(url, 404, 'Not Found', {}, b'')
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response)
+        return response
+
+    def get(self, url, headers=None, timeout=30):
+        return self.request('GET', url, headers, timeout)
+
+    def head(self, url, headers=None, timeout=30):
+        return self.request('HEAD', url, headers, timeout)
+
+    def open(self, url, headers=None, timeout=30):
+        response = self.request('GET', url, headers, timeout)
+        body = self.bodies.get(url) or BytesIO(response.data)
+        return StreamingResponse(url, response.status, response.reason, response.headers, body, False, lambda reusable: None)
+
+    def report_problem(self, url):
+        pass
+
+    def get_limits(self):
+        return {}
+
+
+if DNB_DE is not None:
+    class Plugin(DNB_DE):
+        """
+        Plugin with the default settings (changed by "settings"), its caches in "directory" and a stand-in HTTP client
+        """
+        def __init__(self, directory, client, settings=None):
+            DNB_DE.__init__(self, None)
+            self.directory = directory
+            self.client = client
+            self.settings = settings or {}
+            self.load_config()
+
+        def load_config(self):
+            # the settings of the user are not touched
+            plugin_prefs = cfg.plugin_prefs
+            cfg.plugin_prefs = {cfg.STORE_NAME: self.settings}
+            try:
+                DNB_DE.load_config(self)
+            finally:
+                cfg.plugin_prefs = plugin_prefs
+
+        def get_ignored_fields(self):
+            return frozenset()
+
+        def get_cache(self, table, ttl, max_size):
+            if not ttl or not max_size:
+                return None
+            return open_cache(os.path.join(self.directory, 'cache.sqlite'), table, ttl * 3600, max_size * 1024 * 1024)
+
+        def get_cover_files(self):
+            if not self.cfg_cover_image_cache_size:
+                return None
+            return open_file_cache(os.path.join(self.directory, 'covers'), self.cfg_cover_image_cache_size * 1024 * 1024)
+
+        def get_http_client(self):
+            return self.client
+
+
+class PluginTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = Client()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def create_plugin(self, settings=None):
+        return Plugin(self.directory, self.client, settings)
+
+    def respond(self, url, data, status=200, headers=None):
+        self.client.responses[url] = Response(url, status, 'OK' if status < 400 else 'Error', headers or {}, data)
+
+    def query_url(self, query, maximum_records, start_record=1):
+        return DNB_DE.QUERYURL % (maximum_records, start_record, quote(query.encode('utf-8')))
+
+    def requests(self, part):
+        """
+        Get the URLs requested containing "part"
+        """
+        return [url for method, url, headers in self.client.requests if part in url]
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class PageSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin = DNB_DE(None)
+
+    def test_identifier_lookups(self):
+        self.assertEqual(self.plugin.page_size('num=1207331961'), 1)
+        self.assertEqual(self.plugin.page_size(self.plugin.exclude_media('num=1207331961')), 1)
+        # an ISBN is searched for as "num=<ISBN> AND num=<ISBN>"
+        for query in self.plugin.create_query_variations(None, isbn='9783404285266'):
+            self.assertEqual(self.plugin.page_size(query), 1, query)
+        for query in self.plugin.create_query_variations(None, idn='1207331961', isbn='9783404285266'):
+            self.assertEqual(self.plugin.page_size(query), 1, query)
+
+    def test_author_searches(self):
+        query = self.plugin.exclude_media('per="Hines" AND per="Jim C."')
+        self.assertEqual(self.plugin.page_size(query), DNB_DE.MAXIMUMAUTHORRECORDS)
+        self.assertEqual(self.plugin.maximum_results(query), DNB_DE.MAXIMUMRESULTS)
+
+    def test_other_searches(self):
+        for query in ['tit="Der Goblin-Held"', 'tit="Der Goblin-Held" AND per="Hines"', '"Goblin" AND "Hines"',
+                      'per="Hines" AND num=9783404285266']:
+            query = self.plugin.exclude_media(query)
+            self.assertEqual(self.plugin.page_size(query), DNB_DE.MAXIMUMRECORDS, query)
+            # only searches for authors are paged through
+            self.assertEqual(self.plugin.maximum_results(query), DNB_DE.MAXIMUMRECORDS, query)
+
+    def test_query_terms(self):
+        self.assertEqual(self.plugin.query_terms(self.plugin.exclude_media('tit="a" AND per="b"')), ['tit="a"', 'per="b"'])
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class RunQueriesTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin = DNB_DE(None)
+        self.plugin.start_query = self.start_query
+        # seconds each query takes
+        self.delays = {}
+        self.started = []
+        self.threads = set()
+        self.prefetched = set()
+
+    def start_query(self, log, query, timeout=30, prefetch=False):
+        self.started.append(query)
+        if prefetch:
+            self.prefetched.add(query)
+        self.threads.add(threading.current_thread().ident)
+        time.sleep(self.delays.get(query, 0))
+        return iter(['page of ' + query])
+
+    def run_queries(self, queries, window, abort=None):
+        return self.plugin.run_queries(Log(), queries, abort or threading.Event(), 30, window)
+
+    def test_order_of_queries_is_kept(self):
+        # the later queries are answered first
+        self.delays = {'a': 0.3, 'b': 0.2, 'c': 0.1}
+        start = time.time()
+        results = [(query, list(pages)) for query, pages in self.run_queries(['a', 'b', 'c', 'd'], 3)]
+        self.assertEqual(results, [('a', ['page of a']), ('b', ['page of b']), ('c', ['page of c']), ('d', ['page of d'])])
+        # a, b and c ran at the same time
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_one_query_at_a_time_in_calling_thread(self):
+        self.delays = {'a': 0.1, 'b': 0.1}
+        queries = self.run_queries(['a', 'b', 'c'], 1)
+        self.assertEqual(next(queries)[0], 'a')
+        self.assertEqual(self.started, ['a'])
+        self.assertEqual([query for query, pages in queries], ['b', 'c'])
+        self.assertEqual(self.threads, {threading.current_thread().ident})
+
+    def test_first_query_of_window_read_by_caller(self):
+        queries = self.run_queries(['a', 'b', 'c'], 2)
+        self.assertEqual([query for query, pages in queries], ['a', 'b', 'c'])
+        # b and c ran in the background
+        self.assertEqual(self.prefetched, {'b', 'c'})
+
+    def test_stopping_early_starts_no_further_queries(self):
+        self.delays = dict((query, 0.1) for query in 'abcdef')
+        queries = self.run_queries(list('abcdef'), 2)
+        self.assertEqual(next(queries)[0], 'a')
+        # the caller got enough results
+        queries.close()
+        time.sleep(0.3)
+        self.assertEqual(sorted(self.started), ['a', 'b'])
+
+    def test_abort(self):
+        abort = threading.Event()
+        abort.set()
+        self.assertEqual(list(self.run_queries(['a', 'b'], 2, abort)), [])
+        self.assertEqual(self.started, [])
+
+        abort = threading.Event()
+        queries = self.run_queries(['a', 'b', 'c'], 1, abort)
+        self.assertEqual(next(queries)[0], 'a')
+        abort.set()
+        self.assertEqual(list(queries), [])
+        self.assertEqual(self.started, ['a'])
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class LoadConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin_prefs = cfg.plugin_prefs
+
+    def tearDown(self):
+        cfg.plugin_prefs = self.plugin_prefs
+
+    def test_settings_missing_in_saved_configuration(self):
+        # saved by a version without the newer settings
+        cfg.plugin_prefs = {cfg.STORE_NAME: {cfg.KEY_GUESS_SERIES: False, cfg.KEY_FETCH_SUBJECTS: 0}}
+        plugin = DNB_DE(None)
+        plugin.load_config()
+        self.assertFalse(plugin.cfg_guess_series)
+        self.assertEqual(plugin.cfg_fetch_subjects, 0)
+        for attribute, key in [
+                ('cfg_parallel_queries', cfg.KEY_PARALLEL_QUERIES), ('cfg_query_cache_ttl', cfg.KEY_QUERY_CACHE_TTL),
+                ('cfg_query_cache_size', cfg.KEY_QUERY_CACHE_SIZE), ('cfg_cover_cache_ttl', cfg.KEY_COVER_CACHE_TTL),
+                ('cfg_comments_cache_ttl', cfg.KEY_COMMENTS_CACHE_TTL), ('cfg_record_cache_ttl', cfg.KEY_RECORD_CACHE_TTL),
+                ('cfg_cover_image_cache_size', cfg.KEY_COVER_IMAGE_CACHE_SIZE),
+                ('cfg_max_requests_per_second', cfg.KEY_MAX_REQUESTS_PER_SECOND)]:
+            self.assertEqual(getattr(plugin, attribute), cfg.DEFAULT_STORE_VALUES[key], attribute)
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class CommentsCacheTest(PluginTestCase):
+    URL = 'https://deposit.dnb.de/cgi-bin/dokserv?id=1234'
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.client.responses[self.URL] = Response(self.URL, 200, 'OK', {'etag': '"1"'}, b'<p>Der Goblin-Held</p>')
+
+    def test_cached(self):
+        plugin = self.create_plugin()
+        comments = plugin.fetch_comments(Log(), self.URL)
+        self.assertIn('Der Goblin-Held', comments)
+        self.assertEqual(plugin.fetch_comments(Log(), self.URL), comments)
+        self.assertEqual(len(self.client.requests), 1)
+
+    def test_revalidated(self):
+        plugin = self.create_plugin()
+        comments = plugin.fetch_comments(Log(), self.URL)
+        plugin.cfg_comments_cache_ttl = 0.00001
+        time.sleep(0.1)
+        self.client.responses[self.URL] = Response(self.URL, 304, 'Not Modified', {}, b'')
+        self.assertEqual(plugin.fetch_comments(Log(), self.URL), comments)
+        self.assertEqual(self.client.requests[1][2], {'If-None-Match': '"1"'})
+
+    def test_not_cached_with_ttl_0(self):
+        plugin = self.create_plugin({cfg.KEY_COMMENTS_CACHE_TTL: 0})
+        plugin.fetch_comments(Log(), self.URL)
+        plugin.fetch_comments(Log(), self.URL)
+        self.assertEqual([headers for method, url, headers in self.client.requests], [{}, {}])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'cache.sqlite')))
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class ExecuteQueryTest(PluginTestCase):
+    QUERY = 'tit="Goblin" NOT (mat=film OR mat=music OR mat=microfiches OR cod=tt)'
+
+    def pages(self, plugin):
+        return plugin.execute_query(Log(), self.QUERY, maximum_records=3)
+
+    def test_cached_when_caller_stops_early(self):
+        self.respond(self.query_url(self.QUERY, 3), sru_response([marc_record(str(i), 'Goblin %s' % i) for i in range(3)]))
+        plugin = self.create_plugin()
+        pages = self.pages(plugin)
+        self.assertIsNotNone(next(next(pages)))
+        # the caller has enough
+        pages.close()
+
+        records = [plugin.get_idn(MarcRecord(element)) for page in self.pages(plugin) for element in page]
+        self.assertEqual(records, ['0', '1', '2'])
+        self.assertEqual(len(self.client.requests), 1)
+
+    def test_invalid_response_not_cached(self):
+        self.respond(self.query_url(self.QUERY, 3), sru_response([marc_record('1', 'Goblin')])[:-50])
+        plugin = self.create_plugin()
+        for i in range(2):
+            pages = self.pages(plugin)
+            next(next(pages))
+            pages.close()
+        self.assertEqual(len(self.client.requests), 2)
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class IdentifyTest(PluginTestCase):
+    def identify(self, plugin, **kwargs):
+        results = Queue()
+        plugin.identify(Log(), results, threading.Event(), **kwargs)
+        return [results.get() for i in range(results.qsize())]
+
+    def test_enrichment_limited_for_broad_searches(self):
+        plugin = self.create_plugin()
+        query = plugin.create_query_variations(Log(), authors=['Hines'])[0]
+        records = [marc_record(str(i), 'Goblin %s' % i, '97834042%05d' % i, comments_url='http://deposit.dnb.de/cgi-bin/dokserv?id=%s' % i)
+                   for i in range(15)]
+        self.respond(self.query_url(query, plugin.page_size(query)), sru_response(records))
+
+        results = self.identify(plugin, authors=['Hines'])
+        self.assertEqual(len(results), 15)
+        self.assertEqual(len(self.requests('cover?isbn')), DNB_DE.MAXIMUMENRICHEDRESULTS)
+        self.assertEqual(len(self.requests('dokserv')), DNB_DE.MAXIMUMENRICHEDRESULTS)
+
+    def test_records_handed_out_while_response_is_read(self):
+        plugin = self.create_plugin()
+        query = plugin.create_query_variations(Log(), title='Goblin')[0]
+        url = self.query_url(query, plugin.page_size(query))
+        data = sru_response([marc_record('1', 'Goblin 1'), marc_record('2', 'Goblin 2')])
+        self.respond(url, data)
+        split = data.index(b'</record>', data.index(b'Goblin 1')) + len(b'</record>')
+        self.client.bodies[url] = body = Body(data[:split], data[split:])
+
+        results = Queue()
+        thread = threading.Thread(target=plugin.identify, args=(Log(), results, threading.Event()), kwargs={'title': 'Goblin'})
+        thread.start()
+        try:
+            self.assertEqual(results.get(timeout=5).title, 'Goblin 1')
+        finally:
+            body.event.set()
+            thread.join()
+        self.assertEqual(results.get().title, 'Goblin 2')
+
+    def test_comments_of_other_issues(self):
+        plugin = self.create_plugin()
+        url = 'http://deposit.dnb.de/cgi-bin/dokserv?id=2'
+        self.client.responses[url] = Response(url, 200, 'OK', {}, b'<p>Der Goblin-Held</p>')
+        query = plugin.create_query_variations(Log(), idn='1')[0]
+        self.respond(self.query_url(query, plugin.page_size(query)), sru_response([marc_record('1', 'Goblin', others=['2'])]))
+        query = plugin.batch_query(['num=2'])
+        self.respond(self.query_url(query, 1), sru_response([marc_record('2', 'Goblin', comments_url=url)]))
+
+        results = self.identify(plugin, identifiers={'dnb-idn': '1'})
+        self.assertEqual(len(results), 1)
+        self.assertIn('Der Goblin-Held', results[0].comments)
+
+    def test_records_of_several_variations_parsed_once(self):
+        plugin = self.create_plugin()
+        parsed = []
+        parse_record = plugin.parse_record
+
+        def count_parse_record(log, record, *args):
+            parsed.append(plugin.get_idn(record))
+            return parse_record(log, record, *args)
+        plugin.parse_record = count_parse_record
+
+        audio_book = marc_record('1', 'Goblin', content_type='Gesprochenes Wort')
+        book = marc_record('2', 'Goblin', '9783404285266')
+        queries = plugin.create_query_variations(Log(), title='Goblin')
+        # the first variation only finds the audio book, so the next one is tried
+        self.respond(self.query_url(queries[0], plugin.page_size(queries[0])), sru_response([audio_book]))
+        # the book comes again on the second page, e.g. because a record was added in the meantime
+        self.respond(self.query_url(queries[1], plugin.page_size(queries[1])),
+                     sru_response([audio_book, book], number_of_records=3, next_record_position=3))
+        self.respond(self.query_url(queries[1], 1, 3), sru_response([book]))
+
+        log = Log()
+        results = Queue()
+        plugin.identify(log, results, threading.Event(), title='Goblin')
+        self.assertEqual(results.qsize(), 1)
+        self.assertEqual(parsed, ['2'])
+        self.assertTrue([message for message in log.messages if 'IDN 1 was already parsed' in message])
+        self.assertTrue([message for message in log.messages if 'IDN 2 was already parsed' in message])
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class IdentifyManyTest(PluginTestCase):
+    def test_batches_mapped_back_to_books(self):
+        plugin = self.create_plugin()
+        # two terms per query
+        plugin.MAXIMUMQUERYURLLENGTH = len(plugin.batch_query_url(['num=1', 'num=9783404285266']))
+        identifiers = [
+            {'dnb-idn': '1'},
+            {'isbn': '9783404285266'},
+            # the same book by its ISBN-10
+            {'isbn': '3404285263'},
+            {'dnb-idn': '1', 'isbn': '9783404200005'},
+            {'isbn': '9783404200005'},
+            {},
+        ]
+        query = plugin.batch_query(['num=1', 'num=9783404285266'])
+        self.respond(self.query_url(query, 2), sru_response([
+            marc_record('1', 'Goblin 1', '9783404200012'),
+            marc_record('2', 'Goblin 2', '9783404285266'),
+            # matches none of the books
+            marc_record('9', 'Goblin 9', '9783404299999')]))
+        query = plugin.batch_query(['num=9783404200005'])
+        self.respond(self.query_url(query, 1), sru_response([marc_record('3', 'Goblin 3', '9783404200005')]))
+
+        log = Log()
+        found = plugin.identify_many(log, identifiers, threading.Event())
+        self.assertEqual([[mi.title for mi in books] for books in found],
+                         [['Goblin 1'], ['Goblin 2'], ['Goblin 2'], ['Goblin 1'], ['Goblin 3'], []])
+        self.assertEqual(len(self.requests('searchRetrieve')), 2)
+        # every book gets Metadata objects of its own
+        self.assertIsNot(found[0][0], found[3][0])
+        self.assertIsNot(found[1][0], found[2][0])
+        self.assertTrue([message for message in log.messages if 'IDN 9 ' in message])
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class ResolveCoverUrlTest(PluginTestCase):
+    ISBN = '9783404285266'
+    OTHER_ISBN = '9783838700000'
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.plugin = self.create_plugin()
+
+    def cover(self, isbn):
+        return DNB_DE.COVERURL % isbn
+
+    def has_cover(self, isbn):
+        self.respond(self.cover(isbn), b'\xff\xd8\xff\xe0 JFIF', headers={'content-type': 'image/jpeg'})
+
+    def resolve(self, **identifiers):
+        return self.plugin.resolve_cover_url(Log(), identifiers, threading.Event())
+
+    def respond_record(self):
+        # the record of the paperback only knows the IDN of the e-book, which has the cover
+        query = self.plugin.exclude_media('num=1')
+        self.respond(self.query_url(query, self.plugin.page_size(query)), sru_response([marc_record('1', 'Goblin', self.ISBN, others=['2'])]))
+        self.respond(self.query_url(self.plugin.batch_query(['num=2']), 1), sru_response([marc_record('2', 'Goblin', self.OTHER_ISBN)]))
+        self.has_cover(self.OTHER_ISBN)
+
+    def test_record_cache(self):
+        self.respond_record()
+        results = Queue()
+        self.plugin.identify(Log(), results, threading.Event(), identifiers={'dnb-idn': '1'})
+        del self.client.requests[:]
+
+        self.assertEqual(self.resolve(**{'dnb-idn': '1'}), self.cover(self.OTHER_ISBN))
+        self.assertEqual(self.requests(''), [])
+
+    def test_own_isbn(self):
+        self.has_cover(self.ISBN)
+        self.assertEqual(self.resolve(**{'dnb-idn': '1', 'isbn': self.ISBN}), self.cover(self.ISBN))
+        self.assertEqual(self.requests(''), [self.cover(self.ISBN)])
+
+    def test_isbns_of_other_issues(self):
+        # known from an earlier search
+        self.plugin.remember_issues('1', [self.ISBN], [self.ISBN, self.OTHER_ISBN])
+        self.has_cover(self.OTHER_ISBN)
+        self.assertEqual(self.resolve(isbn=self.ISBN), self.cover(self.OTHER_ISBN))
+        self.assertEqual(self.requests(''), [self.cover(self.ISBN), self.cover(self.OTHER_ISBN)])
+
+    def test_record_looked_up(self):
+        self.respond_record()
+        self.assertEqual(self.resolve(**{'dnb-idn': '1'}), self.cover(self.OTHER_ISBN))
+        requests = self.requests('')
+        self.assertEqual(len(requests), 4)
+        self.assertIn('num%3D1', requests[0])
+        self.assertIn('num%3D2', requests[1])
+        # the book's own ISBN first
+        self.assertEqual(requests[2:], [self.cover(self.ISBN), self.cover(self.OTHER_ISBN)])
+
+        # found by the IDN next time
+        del self.client.requests[:]
+        self.assertEqual(self.resolve(**{'dnb-idn': '1'}), self.cover(self.OTHER_ISBN))
+        self.assertEqual(self.requests(''), [])
+
+    def test_no_identifiers(self):
+        self.assertIsNone(self.resolve(title='Goblin'))
+        self.assertEqual(self.requests(''), [])
+
+
+@unittest.skipIf(DNB_DE is None, 'calibre is not available')
+class DownloadCoverTest(PluginTestCase):
+    ISBN = '9783404285266'
+    IMAGE = b'\xff\xd8\xff\xe0 JFIF'
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.url = DNB_DE.COVERURL % self.ISBN
+        self.respond(self.url, self.IMAGE, headers={'content-type': 'image/jpeg'})
+        query = Plugin(self.directory, self.client).create_query_variations(Log(), idn='1')[0]
+        self.respond(self.query_url(query, 1), sru_response([marc_record('1', 'Goblin', self.ISBN, others=['2'])]))
+
+    def download_cover(self, plugin, **identifiers):
+        results = Queue()
+        plugin.download_cover(Log(), results, threading.Event(), identifiers=identifiers)
+        return [results.get() for i in range(results.qsize())]
+
+    def test_downloaded_by_probe(self):
+        plugin = self.create_plugin()
+        plugin.identify(Log(), Queue(), threading.Event(), identifiers={'dnb-idn': '1'})
+        self.assertIn(('GET', self.url), [(method, url) for method, url, headers in self.client.requests])
+        del self.client.requests[:]
+
+        self.assertEqual(self.download_cover(plugin, **{'dnb-idn': '1'}), [(plugin, self.IMAGE)])
+        self.assertEqual(self.client.requests, [])
+
+    def test_other_issues_only_checked(self):
+        plugin = self.create_plugin()
+        del self.client.responses[self.url]
+        other_url = DNB_DE.COVERURL % '9783838700000'
+        self.respond(other_url, self.IMAGE, headers={'content-type': 'image/jpeg'})
+        self.respond(self.query_url(plugin.batch_query(['num=2']), 1), sru_response([marc_record('2', 'Goblin', '9783838700000')]))
+        plugin.identify(Log(), Queue(), threading.Event(), identifiers={'dnb-idn': '1'})
+        methods = dict((url, method) for method, url, headers in self.client.requests)
+        self.assertEqual(methods[self.url], 'GET')
+        self.assertEqual(methods[other_url], 'HEAD')
+
+    def test_without_cover_cache(self):
+        plugin = self.create_plugin({cfg.KEY_COVER_IMAGE_CACHE_SIZE: 0})
+        self.assertEqual(self.download_cover(plugin, isbn=self.ISBN), [(plugin, self.IMAGE)])
+        # only checked first
+        self.assertEqual([method for method, url, headers in self.client.requests], ['HEAD', 'GET'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (unicode_literals, division,
+                        absolute_import, print_function)
+
+__license__ = 'agpl-3.0'
+__copyright__ = '2017, Bernhard Geier <geierb@geierb.de>'
+__docformat__ = 'restructuredtext en'
+
+# Timing spans of identify(), exported in Chrome's trace event format.
+# Open the files with chrome://tracing or https://ui.perfetto.dev
+
+import os
+import json
+import time
+import threading
+
+
+class Tracer(object):
+    """
+    Collects spans (name, start, end) of all threads working on a single identify() call
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, args=None):
+        """
+        Add a span that started and ended at the given times (as returned by time.time())
+        """
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': 'DNB_DE',
+            'ph': 'X',
+            'ts': int((start - self.origin) * 1000000),
+            'dur': int((end - start) * 1000000),
+            'pid': os.getpid(),
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = dict((k, '%s' % v) for k, v in args.items())
+        with self._lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def span(self, name, **args):
+        """
+        Context manager timing the code inside it
+        """
+        return Span(self, name, args)
+
+    def export(self, path):
+        """
+        Write all spans as Chrome trace event JSON
+        """
+        with self._lock:
+            events = list(self.events)
+            events.extend({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}}
+                          for ident, name in self.threads.items())
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'wb') as f:
+            f.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}).encode('utf-8'))
+
+
+class Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add(self.name, self.start, time.time(), self.args)
+        return False
+
+
+class NoSpan(object):
+    """
+    Stand-in for Span if tracing is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = NoSpan()
+
+
+class Phases(object):
+    """
+    Consecutive spans: each call of start() ends the previous phase, end() ends the last one
+    """
+    def __init__(self, tracer, prefix=''):
+        self.tracer = tracer
+        self.prefix = prefix
+        self.name = None
+        self.started = None
+
+    def start(self, name):
+        now = time.time()
+        if self.tracer and self.name:
+            self.tracer.add(self.prefix + self.name, self.started, now)
+        self.name = name
+        self.started = now
+
+    def end(self):
+        self.start(None)
+
+
+class TracingLog(object):
+    """
+    Log of identify() carrying the tracer along, to every function and background job the log is passed to
+    """
+    def __init__(self, log, tracer):
+        self.log = log
+        self.tracer = tracer
+
+    def __call__(self, *args, **kwargs):
+        return self.log(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+
+def remove_old_traces(directory, keep):
+    """
+    Remove all but the newest "keep" trace files of a directory
+    """
+    try:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json')]
+    except OSError:
+        return
+    traces = []
+    for path in paths:
+        try:
+            traces.append((os.path.getmtime(path), path))
+        except OSError:
+            # removed by another process in the meantime
+            continue
+    traces.sort(reverse=True)
+    for mtime, path in traces[keep:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_tracer(log):
+    """
+    Get the tracer of a log, None if tracing is disabled
+    """
+    return getattr(log, 'tracer', None)
+
+
+def span(log, name, **args):
+    """
+    Context manager timing the code inside it, if the log has a tracer
+    """
+    tracer = getattr(log, 'tracer', None)
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, **args)
+
+
+def phases(log, prefix=''):
+    return Phases(getattr(log, 'tracer', None), prefix)